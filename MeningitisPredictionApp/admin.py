@@ -1,5 +1,9 @@
 from django.contrib import admin
-from .models import Article
+from .models import Article, RiskRuleSet, RiskMap, ZonalRiskStatistics, PipelineRun
 # Register your models here.
 
 admin.site.register(Article)
+admin.site.register(RiskRuleSet)
+admin.site.register(RiskMap)
+admin.site.register(ZonalRiskStatistics)
+admin.site.register(PipelineRun)
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class MeningitispredictionappConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'MeningitisPredictionApp'
+
+    def ready(self):
+        # cache invalidation of the rendered pages
+        from . import signals
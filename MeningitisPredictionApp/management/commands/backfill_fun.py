@@ -0,0 +1,125 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import json
+import os
+
+from .data_acquisition_fun import fetch_geos_daily_sums, geos_days_mean, geos_day_file
+from .data_processing_fun import (dataarray_to_raster, clip_raster_to_shapefile, multiply_array_by_scalar, subtract_scalar_from_array, regrid,
+                                  write_risk_inputs, compute_risk_map_windowed, get_risk_classifier)
+from .workspace_fun import run_workspace, temporary_path
+
+
+# Backfill of the week 1 risk maps of past dates (see backfill_risk_maps). The map of a date is computed from the
+# GEOS-FP assimilation of the 7 days before it, like generate_risk_map does for today, so the dates of a range share
+# most of their days: every day is downloaded and summed once (data_acquisition_fun.fetch_geos_daily_sums) and the
+# weekly means of a date are added up from the daily sums. The dates are then classified independently in a process
+# pool, every completed date is checkpointed, so an interrupted backfill only computes the dates that are missing
+#   <backfill_dir>/days/<variable>/<YYYYmmdd>.npz        daily sums of the assimilation
+#   <backfill_dir>/maps/Risk_map_week1_<dates>.tif       risk maps and their classification inputs
+#   <backfill_dir>/checkpoints/<YYYYmmdd>.json           files and rule set of a completed date, and if it is archived
+
+# GEOS-FP assimilation datasets of the week 1 maps as (variable, dataset, level), the same as in generate_risk_map
+GEOS_WEEK1_VARIABLES = [
+    ('rh', 'assim/tavg3_3d_asm_Nv', 72),
+    ('dusmass', 'assim/tavg3_2d_aer_Nx', None),
+    ('t2m', 'assim/inst3_2d_asm_Nx', None),
+]
+
+
+def parse_backfill_date(value):
+    if isinstance(value, str):
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    return value
+
+
+def backfill_dates(start, end):
+    return [start + timedelta(days=offset) for offset in range((end - start).days + 1)]
+
+
+# the days of the assimilation the week 1 map of a date is computed from: the 7 days before it
+def assimilation_days(day):
+    return [day - timedelta(days=offset) for offset in range(7, 0, -1)]
+
+
+# Function that returns the classification inputs and the risk map file of the week 1 map of a date, named like the
+# ones of generate_risk_map so they can be archived and recomputed the same way
+def week1_files(day, folder):
+    name = 'Risk_map_week1_{}-{}'.format(day.strftime('%Y%m%d'), (day + timedelta(days=6)).strftime('%Y%m%d'))
+    return os.path.join(folder, name + '_inputs.tif'), os.path.join(folder, name + '.tif')
+
+
+def days_folder(backfill_dir, variable):
+    return os.path.join(backfill_dir, 'days', variable)
+
+
+def checkpoint_file(backfill_dir, day):
+    return os.path.join(backfill_dir, 'checkpoints', '{}.json'.format(day.strftime('%Y%m%d')))
+
+
+# Function that returns the checkpoint of a date, None when the date was not completed (with this rule set) or its
+# files are gone
+def read_checkpoint(backfill_dir, day, rule_set_version=None):
+    try:
+        with open(checkpoint_file(backfill_dir, day)) as checkpoint_input:
+            checkpoint = json.load(checkpoint_input)
+    except (OSError, ValueError):
+        return None
+    if rule_set_version is not None and checkpoint['ruleSet'] != rule_set_version:
+        return None
+    if not all(os.path.exists(checkpoint[key]) for key in ('inputs', 'map')):
+        return None
+    return checkpoint
+
+
+def write_checkpoint(backfill_dir, day, checkpoint):
+    path = checkpoint_file(backfill_dir, day)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_file = temporary_path(path)
+    with open(temporary_file, 'w') as checkpoint_output:
+        json.dump(checkpoint, checkpoint_output)
+    os.replace(temporary_file, path)
+
+
+# Function that returns the assimilation days of the dates whose daily sums are not (all) stored yet
+def missing_assimilation_days(backfill_dir, dates):
+    days = sorted(set(day for date in dates for day in assimilation_days(date)))
+    return [day for day in days if not all(os.path.exists(geos_day_file(days_folder(backfill_dir, variable), day))
+                                           for variable, _, _ in GEOS_WEEK1_VARIABLES)]
+
+
+# Function that downloads and sums every assimilation day the dates need once, the three variables at the same time
+def fetch_assimilation_days(geos_url, dates, backfill_dir, time_block=1):
+    days = sorted(set(day for date in dates for day in assimilation_days(date)))
+    with ThreadPoolExecutor(max_workers=len(GEOS_WEEK1_VARIABLES)) as executor:
+        downloads = [executor.submit(fetch_geos_daily_sums, '{}/{}'.format(geos_url, dataset), variable, days,
+                                     days_folder(backfill_dir, variable), lev=lev, time_block=time_block)
+                     for variable, dataset, lev in GEOS_WEEK1_VARIABLES]
+        return [download.result() for download in downloads]
+
+
+# Function that computes the week 1 map of one date from the daily sums of its assimilation days, runs in the process
+# pool of backfill_risk_maps. options are the settings of the processing (cache folders, memory budget, compression,
+# workspace root). Returns the checkpoint of the date
+def compute_week1_map(day, backfill_dir, shapefile_filepath, target_grid, rule_set, options):
+    days = assimilation_days(day)
+
+    def weekly_mean(variable):
+        return clip_raster_to_shapefile(shapefile_filepath, dataarray_to_raster(geos_days_mean(days_folder(backfill_dir, variable), days, variable)),
+                                        cache_dir=options['mask_cache_dir'])
+
+    def regrid_to_target(raster):
+        return regrid(raster, target_grid, cache_dir=options['regrid_cache_dir'])
+
+    # the same units and grid as the week 1 map of generate_risk_map
+    rh = regrid_to_target(multiply_array_by_scalar(weekly_mean('rh'), 100))
+    dust = regrid_to_target(multiply_array_by_scalar(weekly_mean('dusmass'), 10**9))
+    twomt = regrid_to_target(subtract_scalar_from_array(weekly_mean('t2m'), 273.15))
+
+    version, rules = rule_set
+    inputs_file, map_file = week1_files(day, os.path.join(backfill_dir, 'maps'))
+    os.makedirs(os.path.dirname(map_file), exist_ok=True)
+    with run_workspace(options['workspace_root'], 'backfill_{}'.format(day.strftime('%Y%m%d'))) as workspace:
+        write_risk_inputs(twomt, rh, dust, inputs_file)
+        compute_risk_map_windowed([(inputs_file, 1), (inputs_file, 2), (inputs_file, 3)], map_file, classifier=get_risk_classifier(version, rules),
+                                  memory_budget=options['memory_budget'], compress=options['compress'], workspace=workspace)
+    return {'day': day.isoformat(), 'inputs': inputs_file, 'map': map_file, 'ruleSet': version, 'archived': False}
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from raster.models import RasterLayer
+import os
+
+from .data_processing_fun import clip_grid, global_grid
+from .risk_archive_fun import append_risk_map, parse_risk_map_file_name
+
+
+class Command(BaseCommand):
+    help = 'Import the risk map GeoTIFFs in rasters/ into the risk map archive'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--directory', default=os.path.join(os.getcwd(), "rasters"), help='Folder with the risk map GeoTIFFs')
+        parser.add_argument('--shapefile', default=os.path.join(os.getcwd(), "AfricaOutlines", "Africa_Boundaries.shp"),
+                            help='Extent of the archive grid (if the archive does not exist yet)')
+
+    def handle(self, *args, **kwargs):
+        directory = kwargs['directory']
+
+        # one map per product and week: of duplicates the one of a raster layer wins, otherwise the newest file
+        layer_files = set(os.path.realpath(raster_layer.rasterfile.path) for raster_layer in RasterLayer.objects.all() if raster_layer.rasterfile)
+        maps = {}
+        for file_name in os.listdir(directory):
+            parsed = parse_risk_map_file_name(file_name)
+            if parsed is None:
+                continue
+            path = os.path.join(directory, file_name)
+            rank = (os.path.realpath(path) in layer_files, os.path.getmtime(path))
+            if parsed not in maps or rank > maps[parsed][0]:
+                maps[parsed] = (rank, path)
+
+        # the archive is on the grid the risk maps are computed on now
+        grid = clip_grid(kwargs['shapefile'], global_grid(settings.RISK_MAP_GRID_RESOLUTION), cache_dir=settings.MASK_CACHE_DIR)
+        for (product, first_day), (_, path) in sorted(maps.items(), key=lambda item: (item[0][1], item[0][0])):
+            append_risk_map(settings.RISK_ARCHIVE_FILE, product, first_day, path, grid, settings.REGRID_CACHE_DIR)
+            print('archived {} map of {} from {}'.format(product, first_day, os.path.basename(path)))
+
+        self.stdout.write(self.style.SUCCESS('Archived {} risk maps in {}'.format(len(maps), settings.RISK_ARCHIVE_FILE)))
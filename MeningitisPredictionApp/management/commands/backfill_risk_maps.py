@@ -0,0 +1,133 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import time
+import os
+
+from MeningitisPredictionApp.models import RiskRuleSet
+from .backfill_fun import (parse_backfill_date, backfill_dates, assimilation_days, missing_assimilation_days, fetch_assimilation_days,
+                           compute_week1_map, read_checkpoint, write_checkpoint)
+from .data_processing_fun import clip_grid, global_grid
+from .risk_archive_fun import append_risk_map
+from .workspace_fun import evict_workspaces
+
+
+class Command(BaseCommand):
+    help = 'Compute the week 1 risk maps of a range of past dates in parallel and add them to the risk map archive'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', required=True, help='First date, YYYY-MM-DD')
+        parser.add_argument('--end', required=True, help='Last date (inclusive), YYYY-MM-DD')
+        parser.add_argument('--workers', type=int, default=settings.RISK_MAP_BACKFILL_WORKERS,
+                            help='Processes that compute the maps (1 when run inside a celery worker)')
+        parser.add_argument('--phase', choices=['all', 'fetch', 'classify', 'archive'], default='all',
+                            help='fetch: download and sum the assimilation days, classify: compute the maps, archive: add them to the archive')
+        parser.add_argument('--force', action='store_true', help='Compute the maps again, also of the dates that were completed before')
+        parser.add_argument('--shapefile', default=os.path.join(os.getcwd(), "AfricaOutlines", "Africa_Boundaries.shp"))
+
+    def handle(self, *args, **kwargs):
+        start = parse_backfill_date(kwargs['start'])
+        end = parse_backfill_date(kwargs['end'])
+        if end < start:
+            raise CommandError('--end is before --start')
+        dates = backfill_dates(start, end)
+        self.backfill_dir = settings.RISK_MAP_BACKFILL_DIR
+        self.shapefile = kwargs['shapefile']
+        # the risk maps are computed on the same grid as the ones of generate_risk_map
+        self.target_grid = clip_grid(self.shapefile, global_grid(settings.RISK_MAP_GRID_RESOLUTION), cache_dir=settings.MASK_CACHE_DIR)
+        evict_workspaces(settings.RISK_MAP_WORKSPACE_ROOT, settings.RISK_MAP_WORKSPACE_MAX_AGE_HOURS)
+
+        if kwargs['phase'] in ('all', 'fetch'):
+            self.fetch(dates)
+        if kwargs['phase'] in ('all', 'classify'):
+            self.classify(dates, kwargs['workers'], kwargs['force'])
+        if kwargs['phase'] in ('all', 'archive'):
+            self.archive(dates, kwargs['force'])
+
+    # download and sum every assimilation day of the range once
+    def fetch(self, dates):
+        days = set(day for date in dates for day in assimilation_days(date))
+        started = time.monotonic()
+        fetch_assimilation_days(settings.GEOS_FP_OPENDAP_URL, dates, self.backfill_dir, settings.GEOS_FP_TIME_BLOCK)
+        print('{} dates need {} assimilation days instead of {} ({:.1f} s)'.format(
+            len(dates), len(days), 7 * len(dates), time.monotonic() - started))
+
+    # compute the maps of the dates that have no checkpoint (with the active rule set) in a process pool
+    def classify(self, dates, workers, force):
+        rule_set = RiskRuleSet.active()
+        pending = [date for date in dates if force or read_checkpoint(self.backfill_dir, date, rule_set.version) is None]
+        print('{} of {} dates were completed before'.format(len(dates) - len(pending), len(dates)))
+        if not pending:
+            return
+
+        missing = missing_assimilation_days(self.backfill_dir, pending)
+        if missing:
+            raise CommandError('{} assimilation days are not summed ({} - {}), run the fetch phase first or leave out the dates that need them'.format(
+                len(missing), missing[0], missing[-1]))
+
+        workers = max(1, min(workers, len(pending)))
+        options = {
+            'mask_cache_dir': settings.MASK_CACHE_DIR,
+            'regrid_cache_dir': settings.REGRID_CACHE_DIR,
+            # the memory budget is shared by the workers
+            'memory_budget': settings.RISK_MAP_MEMORY_BUDGET_MB * 1024**2 // workers,
+            'compress': settings.RISK_MAP_COMPRESSION,
+            'workspace_root': settings.RISK_MAP_WORKSPACE_ROOT,
+        }
+        args = (self.backfill_dir, self.shapefile, self.target_grid, (rule_set.version, rule_set.rules), options)
+
+        started = time.monotonic()
+        remaining = set(pending)
+        failed = []
+
+        # every date is checkpointed as soon as its map is written
+        def completed(date, checkpoint):
+            write_checkpoint(self.backfill_dir, date, checkpoint)
+            done = len(pending) - len(remaining) - len(failed)
+            elapsed = time.monotonic() - started
+            print('[{}/{}] computed the week 1 map of {} ({:.0f} s, about {:.0f} s left)'.format(
+                done, len(pending), date, elapsed, elapsed / done * len(remaining)))
+
+        if workers == 1:
+            for date in pending:
+                remaining.discard(date)
+                try:
+                    checkpoint = compute_week1_map(date, *args)
+                except Exception as error:
+                    failed.append(date)
+                    self.stderr.write('computing the week 1 map of {} failed: {!r}'.format(date, error))
+                    continue
+                completed(date, checkpoint)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(compute_week1_map, date, *args): date for date in pending}
+                for future in as_completed(futures):
+                    date = futures[future]
+                    remaining.discard(date)
+                    try:
+                        checkpoint = future.result()
+                    except Exception as error:
+                        failed.append(date)
+                        self.stderr.write('computing the week 1 map of {} failed: {!r}'.format(date, error))
+                        continue
+                    completed(date, checkpoint)
+
+        if failed:
+            raise CommandError('the week 1 maps of {} dates failed ({}), run the backfill again to compute them'.format(
+                len(failed), ', '.join(str(date) for date in sorted(failed))))
+        self.stdout.write(self.style.SUCCESS('Computed {} week 1 maps with {} workers in {:.0f} s'.format(
+            len(pending), workers, time.monotonic() - started)))
+
+    # add the completed maps to the archive, in date order from this process only (the archive is one netCDF file)
+    def archive(self, dates, force):
+        archived = 0
+        for date in dates:
+            checkpoint = read_checkpoint(self.backfill_dir, date)
+            if checkpoint is None or (checkpoint['archived'] and not force):
+                continue
+            append_risk_map(settings.RISK_ARCHIVE_FILE, 'week1', date, checkpoint['map'], self.target_grid, settings.REGRID_CACHE_DIR)
+            checkpoint['archived'] = True
+            write_checkpoint(self.backfill_dir, date, checkpoint)
+            archived += 1
+
+        self.stdout.write(self.style.SUCCESS('Archived {} week 1 maps in {}'.format(archived, settings.RISK_ARCHIVE_FILE)))
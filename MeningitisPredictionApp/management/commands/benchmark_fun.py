@@ -0,0 +1,172 @@
+from eccodes import codes_grib_new_from_samples, codes_set, codes_set_long, codes_set_values, codes_write, codes_release
+import rasterio
+from rasterio.transform import from_origin
+import numpy as np
+import xarray as xr
+import os
+
+from .data_processing_fun import (dataarray_to_raster, clip_raster_to_shapefile, multiply_array_by_scalar, subtract_scalar_from_array,
+                                  regrid, global_grid, clip_grid, grib_ensemble_means, write_risk_inputs, compute_risk_map_windowed,
+                                  compute_risk_array, ensemble_statistics, ensemble_agreement, rule_conditions, write_layers, DIONE_RULES)
+
+
+# Synthetic inputs of the benchmarks, so they run offline: smooth random fields over the bounding box of africa that the
+# risk map job downloads (AFRICA_LAT / AFRICA_LON of data_acquisition_fun), on grids of the given resolution
+#   GeoTIFFs in the units of the rules (t2m C, rh %, dust ug/m3), t2m in K and rh as a fraction for the unit conversions,
+#   dust on a GEOS-FP like grid (1.25 times wider pixels) for the regridding
+#   a GEOS-FP like netCDF file with hourly rh, dusmass and t2m in their source units
+#   ECMWF like ensemble GRIB files (2t in K, r in %) packed with CCSDS like the open data, one CCSDS message and a simple
+#   packed file for the GRIB conversions
+AFRICA_WEST, AFRICA_SOUTH, AFRICA_EAST, AFRICA_NORTH = -26, -51, 78, 38
+
+# lat/lon pixel size ratio of the GEOS-FP grid (0.3125 x 0.25 degrees)
+GEOS_LON_RATIO = 1.25
+
+
+# Function that returns the transform and shape of the africa bounding box at a resolution, pixel centres on
+# multiples of the resolution like the global ECMWF grid
+def africa_grid(lon_resolution, lat_resolution):
+    width = int(round((AFRICA_EAST - AFRICA_WEST) / lon_resolution)) + 1
+    height = int(round((AFRICA_NORTH - AFRICA_SOUTH) / lat_resolution)) + 1
+    transform = from_origin(AFRICA_WEST - lon_resolution / 2, AFRICA_NORTH + lat_resolution / 2, lon_resolution, lat_resolution)
+    return transform, (height, width)
+
+
+# Function that returns a smooth random field between low and high: a few random waves plus a little noise,
+# so the values change gradually like the weather fields (and compress like them)
+def smooth_field(rng, shape, low, high, waves=6):
+    rows = np.linspace(0, 1, shape[0], dtype=np.float32)[:, np.newaxis]
+    cols = np.linspace(0, 1, shape[1], dtype=np.float32)[np.newaxis, :]
+    field = np.zeros(shape, dtype=np.float32)
+    for _ in range(waves):
+        row_frequency, col_frequency = rng.uniform(0.5, 4, 2)
+        field += np.sin(2 * np.pi * (row_frequency * rows + rng.random())) * np.cos(2 * np.pi * (col_frequency * cols + rng.random()))
+    field += rng.normal(0, 0.05 * waves, shape).astype(np.float32)
+    field = (field - field.min()) / (field.max() - field.min())
+    return low + (high - low) * field
+
+
+def write_fixture_raster(array, transform, output_file):
+    with rasterio.open(output_file, 'w', driver='GTiff', width=array.shape[1], height=array.shape[0], count=1, dtype=array.dtype,
+                       nodata=np.nan, crs='EPSG:4326', transform=transform) as dst:
+        dst.write(array, 1)
+
+
+# Function that writes GRIB2 messages on the africa grid, one per (member, step, values)
+def write_fixture_grib(fields, short_name, transform, shape, output_file, packing='grid_ccsds', level=None):
+    height, width = shape
+    resolution = transform.a
+    with open(output_file, 'wb') as output:
+        for member, step, values in fields:
+            gid = codes_grib_new_from_samples('regular_ll_pl_grib2' if level is not None else 'regular_ll_sfc_grib2')
+            # ensemble forecast product, member 0 is the control forecast
+            codes_set(gid, 'productDefinitionTemplateNumber', 1)
+            codes_set(gid, 'typeOfGeneratingProcess', 4)
+            codes_set(gid, 'perturbationNumber', member)
+            codes_set(gid, 'shortName', short_name)
+            if level is not None:
+                codes_set(gid, 'level', level)
+            codes_set(gid, 'stepRange', str(step))
+            codes_set_long(gid, 'Ni', width)
+            codes_set_long(gid, 'Nj', height)
+            codes_set(gid, 'latitudeOfFirstGridPointInDegrees', float(AFRICA_NORTH))
+            codes_set(gid, 'latitudeOfLastGridPointInDegrees', AFRICA_NORTH - (height - 1) * resolution)
+            codes_set(gid, 'longitudeOfFirstGridPointInDegrees', float(AFRICA_WEST % 360))
+            codes_set(gid, 'longitudeOfLastGridPointInDegrees', (AFRICA_WEST + (width - 1) * resolution) % 360)
+            codes_set(gid, 'iDirectionIncrementInDegrees', resolution)
+            codes_set(gid, 'jDirectionIncrementInDegrees', resolution)
+            codes_set(gid, 'packingType', packing)
+            codes_set_values(gid, values.astype(np.float64).ravel())
+            codes_write(gid, output)
+            codes_release(gid)
+
+
+# Function that writes the synthetic inputs of one resolution to folder and returns their paths
+def write_fixtures(folder, resolution, seed=0, members=5, steps=4, timesteps=8):
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    transform, shape = africa_grid(resolution, resolution)
+    fixtures = {'resolution': resolution, 'shape': list(shape)}
+
+    rasters = {
+        'twomt': smooth_field(rng, shape, 15, 40),
+        'rh': smooth_field(rng, shape, 0, 100),
+        'dust': smooth_field(rng, shape, 0, 800),
+    }
+    rasters['twomt_kelvin'] = rasters['twomt'] + np.float32(273.15)
+    rasters['rh_fraction'] = rasters['rh'] / np.float32(100)
+    for name, array in rasters.items():
+        fixtures[name] = os.path.join(folder, name + '.tif')
+        write_fixture_raster(array, transform, fixtures[name])
+
+    geos_transform, geos_shape = africa_grid(resolution * GEOS_LON_RATIO, resolution)
+    fixtures['dust_geos'] = os.path.join(folder, 'dust_geos.tif')
+    write_fixture_raster(smooth_field(rng, geos_shape, 0, 800), geos_transform, fixtures['dust_geos'])
+
+    # hourly GEOS-FP like fields in their source units, latitudes ascending like the OPeNDAP datasets
+    lats = AFRICA_SOUTH + resolution * np.arange(geos_shape[0])
+    lons = AFRICA_WEST + resolution * GEOS_LON_RATIO * np.arange(geos_shape[1])
+    times = np.datetime64('2024-01-01T01:30') + np.arange(timesteps) * np.timedelta64(3, 'h')
+    coords = {'time': times, 'lat': lats, 'lon': lons}
+    variables = {
+        'rh': (0.0, 1.0),
+        'dusmass': (0.0, 800e-9),
+        't2m': (288.0, 313.0),
+    }
+    dataset = xr.Dataset({name: (('time', 'lat', 'lon'), np.stack([smooth_field(rng, geos_shape, low, high) for _ in range(timesteps)]))
+                          for name, (low, high) in variables.items()}, coords=coords)
+    fixtures['geos'] = os.path.join(folder, 'geos.nc')
+    dataset.to_netcdf(fixtures['geos'])
+
+    # ECMWF like ensembles, every member a little off the control forecast
+    for short_name, file_name, low, high, level in (('2t', 'ensemble_2t.grib2', 288, 313, None), ('r', 'ensemble_r.grib2', 0, 100, 1000)):
+        base = smooth_field(rng, shape, low, high)
+        # generated one message at a time, the fields of all members never have to fit in memory
+        fields = ((member, 24 + 3 * step, base + rng.normal(0, (high - low) / 50, shape).astype(np.float32))
+                  for member in range(members) for step in range(steps))
+        fixtures[file_name.split('.')[0]] = os.path.join(folder, file_name)
+        write_fixture_grib(fields, short_name, transform, shape, fixtures[file_name.split('.')[0]], level=level)
+
+    fixtures['field_ccsds'] = os.path.join(folder, 'field_ccsds.grib2')
+    write_fixture_grib([(0, 24, smooth_field(rng, shape, 288, 313))], '2t', transform, shape, fixtures['field_ccsds'])
+    fixtures['field_simple'] = os.path.join(folder, 'field_simple.grib2')
+    write_fixture_grib(((0, 24 + 3 * step, smooth_field(rng, shape, 288, 313)) for step in range(steps)), '2t', transform, shape,
+                       fixtures['field_simple'], packing='grid_simple')
+    return fixtures
+
+
+# Function that runs the risk map job offline on the fixtures: the same chain of functions as generate_risk_map from
+# the weekly means to the risk maps of both weeks and the ensemble statistics, without downloads and database
+def offline_pipeline(fixtures, shapefile_filepath, work_dir, cache_dir=None):
+    target_grid = clip_grid(shapefile_filepath, global_grid(fixtures['resolution']), cache_dir=cache_dir)
+
+    def clip(raster):
+        return clip_raster_to_shapefile(shapefile_filepath, raster, cache_dir=cache_dir)
+
+    # week 1: weekly means of the GEOS-FP like fields
+    with xr.open_dataset(fixtures['geos']) as geos:
+        rh, dust, twomt = (dataarray_to_raster(geos[name].mean('time').astype(np.float32)) for name in ('rh', 'dusmass', 't2m'))
+    rh = regrid(multiply_array_by_scalar(clip(rh), 100), target_grid, cache_dir=cache_dir)
+    dust = regrid(multiply_array_by_scalar(clip(dust), 10**9), target_grid, cache_dir=cache_dir)
+    twomt = regrid(subtract_scalar_from_array(clip(twomt), 273.15), target_grid, cache_dir=cache_dir)
+
+    inputs_week1 = os.path.join(work_dir, 'week1_inputs.tif')
+    write_risk_inputs(twomt, rh, dust, inputs_week1)
+    compute_risk_map_windowed([(inputs_week1, 1), (inputs_week1, 2), (inputs_week1, 3)], os.path.join(work_dir, 'week1.tif'))
+
+    # week 2: ensemble means of the ECMWF like forecasts, with the dust of week 1 as the dust forecast
+    twomt_members, twomt_fc, _ = grib_ensemble_means(fixtures['ensemble_2t'], target_grid)
+    rh_members, rh_fc, _ = grib_ensemble_means(fixtures['ensemble_r'], target_grid)
+    twomt_members = subtract_scalar_from_array(twomt_members, 273.15)
+    twomt_fc = clip(subtract_scalar_from_array(twomt_fc, 273.15))
+    rh_fc = clip(rh_fc)
+
+    inputs_week2 = os.path.join(work_dir, 'week2_inputs.tif')
+    write_risk_inputs(twomt_fc, rh_fc, dust, inputs_week2)
+    compute_risk_map_windowed([(inputs_week2, 1), (inputs_week2, 2), (inputs_week2, 3)], os.path.join(work_dir, 'week2.tif'))
+
+    risk_map = compute_risk_array(twomt_fc, rh_fc, dust)
+    layers = [('risk level agreement', ensemble_agreement(twomt_members, rh_members, dust, risk_map))]
+    layers += ensemble_statistics(twomt_members, 't2m', (10, 50, 90), rule_conditions(DIONE_RULES, 0))
+    layers += ensemble_statistics(rh_members, 'rh', (10, 50, 90), rule_conditions(DIONE_RULES, 1))
+    write_layers([(name, clip(layer)) for name, layer in layers], os.path.join(work_dir, 'week2_ensemble.tif'))
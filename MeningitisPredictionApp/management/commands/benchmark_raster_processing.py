@@ -0,0 +1,149 @@
+from django.core.management.base import BaseCommand, CommandError
+from datetime import datetime, timezone
+import numpy as np
+import rasterio
+import subprocess
+import tempfile
+import platform
+import shutil
+import json
+import time
+import os
+
+from .benchmark_fun import write_fixtures, offline_pipeline
+from .instrumentation_fun import rss_counters, reset_peak_rss
+from .data_processing_fun import (create_mask_from_shapefile, multiply_raster_by_scalar, subtract_scalar_from_raster, resample_resolution,
+                                  transform_grib2_to_TIFF, ccds_to_simple, compute_risk_map)
+
+
+# Function that returns the benchmarks of one resolution as (name, function), every function writes into work_dir
+def raster_benchmarks(fixtures, shapefile_filepath, work_dir):
+    def output(name):
+        return os.path.join(work_dir, name)
+
+    return [
+        ('create_mask_from_shapefile', lambda: create_mask_from_shapefile(shapefile_filepath, fixtures['twomt'], output('mask.tif'))),
+        ('multiply_raster_by_scalar', lambda: multiply_raster_by_scalar(fixtures['rh_fraction'], output('rh_percent.tif'), 100)),
+        ('subtract_scalar_from_raster', lambda: subtract_scalar_from_raster(fixtures['twomt_kelvin'], output('twomt_celsius.tif'), 273.15)),
+        ('resample_resolution', lambda: resample_resolution(fixtures['dust_geos'], output('dust_resampled.tif'), fixtures['twomt'])),
+        ('transform_grib2_to_TIFF', lambda: transform_grib2_to_TIFF(fixtures['field_simple'], output('field.tif'))),
+        ('ccds_to_simple', lambda: ccds_to_simple(fixtures['field_ccsds'], output('field_simple.grib2'))),
+        ('compute_risk_map', lambda: compute_risk_map(fixtures['twomt'], fixtures['rh'], fixtures['dust'], output('risk_map.tif'))),
+        ('offline_pipeline', lambda: offline_pipeline(fixtures, shapefile_filepath, work_dir, cache_dir=output('cache'))),
+    ]
+
+
+# Function that runs a benchmark once to warm up (measuring how far the resident memory rises above where it started),
+# then repeat times, and returns the timings
+def run_benchmark(function, repeat):
+    reset_peak_rss()
+    rss, _ = rss_counters()
+    started = time.perf_counter()
+    function()
+    first = time.perf_counter() - started
+    _, peak = rss_counters()
+
+    seconds = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - started)
+    return {'first_seconds': first, 'seconds': seconds, 'median_seconds': float(np.median(seconds)), 'min_seconds': min(seconds),
+            'peak_rss_increase_bytes': peak - rss if rss is not None else None}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+class Command(BaseCommand):
+    help = 'Time the raster processing functions and the offline risk map pipeline on synthetic inputs and store the results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--resolutions', type=float, nargs='+', default=[0.25, 0.1, 0.05], help='Grid resolutions (degrees) of the inputs')
+        parser.add_argument('--repeat', type=int, default=3, help='Timed runs of every benchmark after the warm up run')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--members', type=int, default=5, help='Ensemble members of the synthetic GRIB files')
+        parser.add_argument('--steps', type=int, default=4, help='Forecast steps of the synthetic GRIB files')
+        parser.add_argument('--only', nargs='+', help='Only run these benchmarks')
+        parser.add_argument('--shapefile', default=os.path.join(os.getcwd(), "AfricaOutlines", "Africa_Boundaries.shp"))
+        parser.add_argument('--work-dir', help='Folder for the inputs and outputs, a temporary folder that is removed afterwards by default')
+        parser.add_argument('--output', help='Results file, benchmarks/raster_processing_<commit>.json by default')
+        parser.add_argument('--compare', help='Results file of an earlier run to compare with')
+        parser.add_argument('--max-slowdown', type=float,
+                            help='Fail when a benchmark is slower than in the compared results by more than this factor (e.g. 1.2)')
+
+    def handle(self, *args, **kwargs):
+        commit = git_commit()
+        work_dir = kwargs['work_dir'] or tempfile.mkdtemp(prefix='risk_map_benchmark_')
+        results = {
+            'commit': commit,
+            'created': datetime.now(timezone.utc).isoformat(),
+            'machine': {'python': platform.python_version(), 'platform': platform.platform(), 'processor': platform.processor(),
+                        'cpus': os.cpu_count(), 'numpy': np.__version__, 'rasterio': rasterio.__version__, 'gdal': rasterio.__gdal_version__},
+            'settings': {key: kwargs[key] for key in ('repeat', 'seed', 'members', 'steps')},
+            'benchmarks': [],
+        }
+
+        try:
+            for resolution in kwargs['resolutions']:
+                folder = os.path.join(work_dir, str(resolution))
+                started = time.perf_counter()
+                fixtures = write_fixtures(os.path.join(folder, 'inputs'), resolution, kwargs['seed'], kwargs['members'], kwargs['steps'])
+                self.stdout.write('{} deg: wrote synthetic inputs of {}x{} pixels in {:.1f} s'.format(
+                    resolution, fixtures['shape'][0], fixtures['shape'][1], time.perf_counter() - started))
+
+                output_dir = os.path.join(folder, 'outputs')
+                os.makedirs(output_dir, exist_ok=True)
+                for name, function in raster_benchmarks(fixtures, kwargs['shapefile'], output_dir):
+                    if kwargs['only'] and name not in kwargs['only']:
+                        continue
+                    result = {'benchmark': name, 'resolution': resolution, 'shape': fixtures['shape']}
+                    try:
+                        result.update(run_benchmark(function, kwargs['repeat']))
+                        self.stdout.write('  {:<28} {:8.3f} s median {:8.3f} s first {:8.1f} MB peak'.format(
+                            name, result['median_seconds'], result['first_seconds'], (result['peak_rss_increase_bytes'] or 0) / 10**6))
+                    except Exception as error:
+                        # e.g. GDAL without the GRIB driver, the other benchmarks still run
+                        result['error'] = repr(error)
+                        self.stderr.write('  {:<28} failed: {!r}'.format(name, error))
+                    results['benchmarks'].append(result)
+        finally:
+            if not kwargs['work_dir']:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+        output_file = kwargs['output'] or os.path.join('benchmarks', 'raster_processing_{}.json'.format(commit))
+        os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+        with open(output_file, 'w') as output:
+            json.dump(results, output, indent=2)
+        self.stdout.write('results written to {}'.format(output_file))
+
+        if kwargs['compare']:
+            self.compare(results, kwargs['compare'], kwargs['max_slowdown'])
+
+        self.stdout.write(self.style.SUCCESS('Benchmark completed'))
+
+    # print the median time of every benchmark relative to an earlier results file
+    def compare(self, results, baseline_file, max_slowdown):
+        with open(baseline_file) as baseline_input:
+            baseline = json.load(baseline_input)
+        baseline_times = {(result['benchmark'], result['resolution']): result['median_seconds']
+                          for result in baseline['benchmarks'] if 'median_seconds' in result}
+
+        slower = []
+        self.stdout.write('compared with {} ({}):'.format(baseline_file, baseline['commit']))
+        for result in results['benchmarks']:
+            key = (result['benchmark'], result['resolution'])
+            if key not in baseline_times or 'median_seconds' not in result:
+                continue
+            ratio = result['median_seconds'] / baseline_times[key]
+            self.stdout.write('  {:<28} {:5} deg {:8.3f} s -> {:8.3f} s  x{:.2f}'.format(
+                key[0], key[1], baseline_times[key], result['median_seconds'], ratio))
+            if max_slowdown is not None and ratio > max_slowdown:
+                slower.append('{} at {} deg (x{:.2f})'.format(key[0], key[1], ratio))
+
+        if slower:
+            raise CommandError('slower than {}: {}'.format(baseline['commit'], ', '.join(slower)))
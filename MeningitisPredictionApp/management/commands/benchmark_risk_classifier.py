@@ -0,0 +1,64 @@
+from django.core.management.base import BaseCommand
+import numpy as np
+import time
+import tracemalloc
+
+from .data_processing_fun import Raster, DIONE_RULES, compute_risk_array, compute_risk_array_by_masks
+
+
+# Africa bounding box used by the risk map job (lat -51 to 38, lon -26 to 78)
+AFRICA_HEIGHT_DEGREES = 89
+AFRICA_WIDTH_DEGREES = 104
+
+
+# Function that generates a random input raster: uniform values, values exactly on the thresholds and nan
+def random_raster(rng, shape, thresholds, low, high):
+    values = rng.uniform(low, high, shape).astype(np.float32)
+    pick = rng.random(shape)
+    on_threshold = pick < 0.2
+    values[on_threshold] = rng.choice(thresholds, on_threshold.sum())
+    values[pick > 0.95] = np.nan
+    return Raster(values, None, None, np.nan)
+
+
+# Function that generates random 2mt, RH and sdc rasters
+def random_inputs(rng, shape):
+    thresholds = [sorted({threshold for _, conditions in DIONE_RULES for variable, _, threshold in conditions if variable == index})
+                  for index in range(3)]
+    return (random_raster(rng, shape, thresholds[0], -10, 50),
+            random_raster(rng, shape, thresholds[1], 0, 100),
+            random_raster(rng, shape, thresholds[2], 0, 1000))
+
+
+# Function that runs a classification and returns its result, wall time and peak of newly allocated memory
+def measure(function, inputs):
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = function(*inputs)
+    seconds = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+class Command(BaseCommand):
+    help = 'Compare the speed and memory of the single pass risk classifier and the mask based one (the tests check they give the same levels)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--resolutions', type=float, nargs='+', default=[0.25, 0.05], help='Grid resolutions (degrees) to benchmark')
+
+    def handle(self, *args, **kwargs):
+        rng = np.random.default_rng(kwargs['seed'])
+
+        # benchmark on continental grids
+        for resolution in kwargs['resolutions']:
+            shape = (int(AFRICA_HEIGHT_DEGREES / resolution), int(AFRICA_WIDTH_DEGREES / resolution))
+            inputs = random_inputs(rng, shape)
+            _, mask_seconds, mask_peak = measure(compute_risk_array_by_masks, inputs)
+            _, lookup_seconds, lookup_peak = measure(compute_risk_array, inputs)
+
+            self.stdout.write('{} deg {}x{}: masks {:.3f} s / {:.1f} MB peak, single pass {:.3f} s / {:.1f} MB peak'.format(
+                resolution, shape[0], shape[1], mask_seconds, mask_peak / 10**6, lookup_seconds, lookup_peak / 10**6))
+
+        self.stdout.write(self.style.SUCCESS('Risk classifier benchmark completed'))
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+import os
+
+from MeningitisPredictionApp.models import RiskRuleSet
+from .data_processing_fun import compute_risk_map_windowed, get_risk_classifier
+
+
+class Command(BaseCommand):
+    help = 'Compute a risk map window by window from 2mt, RH and sdc rasters on the same grid (e.g. finer or downscaled products)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('twomt_file')
+        parser.add_argument('rh_file')
+        parser.add_argument('sdc_file')
+        parser.add_argument('output_file')
+        # unit conversions, the defaults turn K, RH 0-1 and kg/m^3 into the units of the rules (C, %, ug/m^3)
+        parser.add_argument('--twomt-offset', type=float, default=273.15, help='Subtracted from 2mt (default: K to C)')
+        parser.add_argument('--rh-scale', type=float, default=100, help='RH is multiplied by it (default: 0-1 to %%)')
+        parser.add_argument('--sdc-scale', type=float, default=10**9, help='sdc is multiplied by it (default: kg/m^3 to ug/m^3)')
+        parser.add_argument('--shapefile', default=os.path.join(os.getcwd(), "AfricaOutlines", "Africa_Boundaries.shp"),
+                            help='Pixels outside of the shapes are masked')
+        parser.add_argument('--rule-set', help='Version of the rule set to use (default: the active one)')
+        parser.add_argument('--memory-budget-mb', type=int, default=settings.RISK_MAP_MEMORY_BUDGET_MB)
+        parser.add_argument('--workers', type=int, default=settings.RISK_MAP_WORKERS, help='Number of processes')
+        parser.add_argument('--compress', choices=['deflate', 'zstd'], default=settings.RISK_MAP_COMPRESSION)
+
+    def handle(self, *args, **kwargs):
+        if kwargs['rule_set']:
+            try:
+                rule_set = RiskRuleSet.objects.get(version=kwargs['rule_set'])
+            except RiskRuleSet.DoesNotExist:
+                raise CommandError('rule set {} does not exist'.format(kwargs['rule_set']))
+        else:
+            rule_set = RiskRuleSet.active()
+
+        inputs = [(kwargs['twomt_file'], 1), (kwargs['rh_file'], 1), (kwargs['sdc_file'], 1)]
+        conversions = [(1, kwargs['twomt_offset']), (kwargs['rh_scale'], 0), (kwargs['sdc_scale'], 0)]
+        try:
+            compute_risk_map_windowed(inputs, kwargs['output_file'], conversions=conversions, shapefile_filepath=kwargs['shapefile'],
+                                      classifier=get_risk_classifier(rule_set.version, rule_set.rules),
+                                      memory_budget=kwargs['memory_budget_mb'] * 1024**2, workers=kwargs['workers'],
+                                      mask_cache_dir=settings.MASK_CACHE_DIR, compress=kwargs['compress'])
+        except ValueError as error:
+            raise CommandError(error)
+
+        self.stdout.write(self.style.SUCCESS('Computed risk map {} with rule set {}'.format(kwargs['output_file'], rule_set.version)))
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.db import transaction
+from raster.models import RasterLayer
+import os
+
+from MeningitisPredictionApp.models import ZonalRiskStatistics
+from .zonal_stats_fun import zonal_risk_statistics
+
+
+class Command(BaseCommand):
+    help = 'Compute the statistics of the risk maps per country (pixels per level, share of high risk area, population at risk)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--layer', type=int, nargs='+', help='Ids of the raster layers (default: the two most recent)')
+        parser.add_argument('--shapefile', default=os.path.join(os.getcwd(), "AfricaOutlines", "Africa_Boundaries.shp"),
+                            help='Zones, one feature per country')
+        parser.add_argument('--population', default=settings.POPULATION_RASTER, help='Population raster (people per pixel)')
+
+    def handle(self, *args, **kwargs):
+        if kwargs['layer']:
+            raster_layers = RasterLayer.objects.filter(id__in=kwargs['layer'])
+        else:
+            raster_layers = RasterLayer.objects.order_by('-id')[:2]
+
+        for raster_layer in raster_layers:
+            statistics = zonal_risk_statistics(raster_layer.rasterfile.path, kwargs['shapefile'], cache_dir=settings.MASK_CACHE_DIR,
+                                               population_file=kwargs['population'])
+            # the statistics of a map are replaced as a whole
+            with transaction.atomic():
+                ZonalRiskStatistics.objects.filter(rasterLayer=raster_layer).delete()
+                ZonalRiskStatistics.objects.bulk_create([
+                    ZonalRiskStatistics(rasterLayer=raster_layer, zoneKey=zone['key'], zoneName=zone['name'],
+                                        levelCounts=zone['level_counts'], areaKm2=zone['area_km2'],
+                                        highRiskShare=zone['high_risk_share'], populationAtRisk=zone['population_at_risk'])
+                    for zone in statistics])
+
+            print('computed the statistics of {} in {} zones'.format(raster_layer.name, len(statistics)))
+
+        self.stdout.write(self.style.SUCCESS('Computed the zonal statistics of {} risk maps'.format(len(raster_layers))))
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from raster.models import RasterLayer
+import rasterio
+import os
+
+from .data_processing_fun import convert_risk_map_to_cog, RISK_MAP_DTYPE
+from .workspace_fun import run_workspace
+
+
+class Command(BaseCommand):
+    help = 'Rewrite the stored risk maps that are not COGs yet as uint8 COGs with overviews'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--compress', choices=['deflate', 'zstd'], default=settings.RISK_MAP_COMPRESSION)
+
+    def handle(self, *args, **kwargs):
+        before = 0
+        after = 0
+        converted = 0
+        with run_workspace(settings.RISK_MAP_WORKSPACE_ROOT, 'convert_risk_maps_to_cog') as workspace:
+            for raster_layer in RasterLayer.objects.order_by('id'):
+                if not raster_layer.rasterfile or not os.path.exists(raster_layer.rasterfile.path):
+                    continue
+                path = raster_layer.rasterfile.path
+                with rasterio.open(path) as src:
+                    if src.dtypes[0] == RISK_MAP_DTYPE and src.overviews(1):
+                        continue
+
+                size = os.path.getsize(path)
+                # the pixel values stay the same, so the tiles django-raster parsed from the file stay valid
+                convert_risk_map_to_cog(path, kwargs['compress'], settings.RISK_MAP_MEMORY_BUDGET_MB * 1024**2, workspace)
+                before += size
+                after += os.path.getsize(path)
+                converted += 1
+
+                print('converted {} ({:.1f} MB -> {:.1f} MB)'.format(raster_layer.name, size / 10**6, os.path.getsize(path) / 10**6))
+
+        self.stdout.write(self.style.SUCCESS('Converted {} risk maps to COG: {:.1f} MB -> {:.1f} MB'.format(converted, before / 10**6, after / 10**6)))
@@ -0,0 +1,348 @@
+from ecmwf.opendata import Client
+import numpy as np
+import xarray as xr
+from datetime import datetime
+import time
+import os
+
+from .instrumentation_fun import record_network
+from .workspace_fun import workspace_path, temporary_path, move_into_place
+
+
+# Geographic extend of africa used to subset the GEOS-FP datasets
+AFRICA_LAT = slice(-51, 38)
+AFRICA_LON = slice(-26, 78)
+
+
+# Function that returns the index slice of a 1D coordinate array covering the values from start to stop (inclusive)
+def coordinate_index_slice(values, start, stop):
+    indices = np.nonzero((values >= start) & (values <= stop))[0]
+    if indices.size == 0:
+        return slice(0, 0)
+    return slice(int(indices[0]), int(indices[-1]) + 1)
+
+
+# Function that opens a GEOS-FP dataset through the OPeNDAP server and selects one variable over the africa bounding box
+# Only the coordinates are downloaded here, the returned variable is still lazy
+# Returns the dataset, the variable (time, lat, lon) and the index slice of the timeframe
+def open_geos_subset(url, variable, time_start, time_end, lev=None):
+    dataset = xr.open_dataset(url, engine='netcdf4')
+
+    lat_slice = coordinate_index_slice(dataset.lat.values, AFRICA_LAT.start, AFRICA_LAT.stop)
+    lon_slice = coordinate_index_slice(dataset.lon.values, AFRICA_LON.start, AFRICA_LON.stop)
+    time_slice = coordinate_index_slice(dataset.time.values, np.datetime64(time_start), np.datetime64(time_end))
+
+    data = dataset[variable]
+    if lev is not None:
+        data = data.isel(lev=int(np.nonzero(dataset.lev.values == lev)[0][0]))
+    data = data.isel(lat=lat_slice, lon=lon_slice)
+
+    return dataset, data, time_slice
+
+
+# Function that adds a block of timesteps to a running sum and count, missing values are skipped like in xarray's mean
+def accumulate_block(value_sum, value_count, block, sign=1):
+    valid = ~np.isnan(block)
+    value_sum += sign * np.where(valid, block, 0).sum(axis=0)
+    value_count += sign * valid.sum(axis=0)
+
+
+# Function that turns a running sum and count into a (lat, lon) mean DataArray
+def running_mean_to_dataarray(value_sum, value_count, data):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(value_count > 0, value_sum / value_count, np.nan).astype(data.dtype)
+    return xr.DataArray(mean, coords={'lat': data.lat.values, 'lon': data.lon.values}, dims=('lat', 'lon'), name=data.name)
+
+
+# Function that streams one variable of a GEOS-FP dataset from the OPeNDAP server and computes its mean over time
+# The index ranges of the africa bounding box and the timeframe are computed up front from the coordinates, so every
+# request is a hyperslab of time_block timesteps that is subset on the server. A running sum and count keep the peak
+# memory at one time block instead of the whole week.
+# Returns the mean as a (lat, lon) DataArray and a report with the number of requests, bytes and seconds it cost
+def stream_geos_mean(url, variable, time_start, time_end, lev=None, time_block=1):
+    started = time.monotonic()
+    dataset, data, time_slice = open_geos_subset(url, variable, time_start, time_end, lev=lev)
+
+    value_sum = np.zeros(data.shape[1:], dtype=np.float64)
+    value_count = np.zeros(data.shape[1:], dtype=np.int64)
+    requests = 0
+    transferred = 0
+
+    for block_start in range(time_slice.start, time_slice.stop, time_block):
+        block = data.isel(time=slice(block_start, min(block_start + time_block, time_slice.stop))).values
+        requests += 1
+        transferred += block.nbytes
+        accumulate_block(value_sum, value_count, block)
+
+    data_mean = running_mean_to_dataarray(value_sum, value_count, data)
+    dataset.close()
+
+    report = {
+        'variable': variable,
+        'url': url,
+        'requests': requests,
+        'bytes': transferred,
+        'seconds': time.monotonic() - started,
+    }
+    return data_mean, report
+
+
+# name of a GEOS-FP dataset in the network metrics, e.g. geos_fp/assim/tavg3_2d_aer_Nx or geos_fp/fcast/tavg3_2d_aer_Nx
+def geos_source(url):
+    parts = url.rstrip('/').split('/')
+    return 'geos_fp/{}/{}'.format('fcast' if 'fcast' in parts else 'assim', parts[-1].split('.')[0])
+
+
+# Function that accesses a GEOS-FP dataset through the OPeNDAP server and computes the mean of one variable
+# over the geographic extend of africa and the given timeframe
+def fetch_geos_mean(url, variable, time_start, time_end, lev=None, time_block=1):
+    data_mean, report = stream_geos_mean(url, variable, time_start, time_end, lev=lev, time_block=time_block)
+    record_network(geos_source(url), report['bytes'])
+
+    print('accessed GEOS-FP {variable} and computed its mean: {requests} requests, {megabytes:.1f} MB in {seconds:.1f} s'.format(
+        megabytes=report['bytes'] / 10**6, **report))
+    return data_mean
+
+
+# Function that returns the cache folder of one GEOS-FP product/variable (and level), e.g. <cache_dir>/tavg3_3d_asm_Nv/rh_lev72
+def geos_cache_folder(cache_dir, url, variable, lev=None):
+    name = variable if lev is None else '{}_lev{}'.format(variable, lev)
+    return os.path.join(cache_dir, url.rstrip('/').split('/')[-1], name)
+
+
+# Function that returns the file of one cached timestep
+def geos_cache_file(folder, timestamp):
+    return os.path.join(folder, '{}.nc'.format(np.datetime_as_string(timestamp, unit='m').replace(':', '')))
+
+
+# Function that stores one timestep of the africa subset as a compressed netcdf file
+# (written to a temporary file first, so an interrupted run never leaves a broken timestep in the cache)
+def write_cached_timestep(file_path, values, data):
+    timestep = xr.DataArray(values, coords={'lat': data.lat.values, 'lon': data.lon.values}, dims=('lat', 'lon'), name=data.name)
+    temporary_file = temporary_path(file_path)
+    timestep.to_netcdf(temporary_file, engine='netcdf4', encoding={data.name: {'zlib': True, 'complevel': 4}})
+    os.replace(temporary_file, file_path)
+
+
+def read_cached_timestep(file_path):
+    with xr.open_dataarray(file_path, engine='netcdf4') as timestep:
+        return timestep.values
+
+
+# Function that computes the mean of one GEOS-FP variable over the given timeframe like stream_geos_mean, but keeps
+# every downloaded timestep of the africa subset in a local cache and the running sum/count of the last window on disk.
+# Only timesteps that are not in the cache yet are requested from the OPeNDAP server, and the mean is updated as a
+# rolling window: timesteps that left the window are subtracted, new ones are added.
+def rolling_geos_mean(url, variable, time_start, time_end, cache_dir, lev=None, time_block=1):
+    started = time.monotonic()
+    folder = geos_cache_folder(cache_dir, url, variable, lev)
+    os.makedirs(folder, exist_ok=True)
+    window_file = os.path.join(folder, 'window.npz')
+
+    dataset, data, time_slice = open_geos_subset(url, variable, time_start, time_end, lev=lev)
+    timestamps = data.time.values[time_slice]
+
+    # download the missing timesteps, contiguous ones are requested together in blocks of time_block
+    missing = [time_slice.start + i for i, timestamp in enumerate(timestamps)
+               if not os.path.exists(geos_cache_file(folder, timestamp))]
+    requests = 0
+    transferred = 0
+    block_start = 0
+    while block_start < len(missing):
+        block_stop = block_start + 1
+        while block_stop < len(missing) and block_stop - block_start < time_block and missing[block_stop] == missing[block_stop - 1] + 1:
+            block_stop += 1
+        first, last = missing[block_start], missing[block_stop - 1]
+        block = data.isel(time=slice(first, last + 1)).values
+        requests += 1
+        transferred += block.nbytes
+        for offset in range(block.shape[0]):
+            write_cached_timestep(geos_cache_file(folder, data.time.values[first + offset]), block[offset], data)
+        block_start = block_stop
+
+    # rolling window update of the previous run's running sum/count, if it was computed on the same grid
+    window_keys = set(np.datetime_as_string(timestamps, unit='m'))
+    value_sum = np.zeros(data.shape[1:], dtype=np.float64)
+    value_count = np.zeros(data.shape[1:], dtype=np.int64)
+    in_window = set()
+    if os.path.exists(window_file):
+        previous = np.load(window_file)
+        if previous['sum'].shape == value_sum.shape:
+            dropped = set(previous['timestamps']) - window_keys
+            dropped_files = [geos_cache_file(folder, np.datetime64(key)) for key in dropped]
+            # a timestep that left the window can only be subtracted while it is still in the cache
+            if all(os.path.exists(file_path) for file_path in dropped_files):
+                value_sum = previous['sum']
+                value_count = previous['count']
+                in_window = set(previous['timestamps']) - dropped
+                for file_path in dropped_files:
+                    accumulate_block(value_sum, value_count, read_cached_timestep(file_path)[np.newaxis], sign=-1)
+
+    added = 0
+    for timestamp in timestamps:
+        if np.datetime_as_string(timestamp, unit='m') not in in_window:
+            accumulate_block(value_sum, value_count, read_cached_timestep(geos_cache_file(folder, timestamp))[np.newaxis])
+            added += 1
+
+    temporary_file = temporary_path(window_file, '.npz')
+    np.savez(temporary_file, sum=value_sum, count=value_count, timestamps=np.array(sorted(window_keys)))
+    os.replace(temporary_file, window_file)
+
+    data_mean = running_mean_to_dataarray(value_sum, value_count, data)
+    dataset.close()
+
+    report = {
+        'variable': variable,
+        'url': url,
+        'requests': requests,
+        'bytes': transferred,
+        'cached': len(timestamps) - len(missing),
+        'added': added,
+        'seconds': time.monotonic() - started,
+    }
+    return data_mean, report
+
+
+# Function like fetch_geos_mean that uses the local timestep cache and the rolling window
+def fetch_geos_rolling_mean(url, variable, time_start, time_end, cache_dir, lev=None, time_block=1):
+    data_mean, report = rolling_geos_mean(url, variable, time_start, time_end, cache_dir, lev=lev, time_block=time_block)
+    record_network(geos_source(url), report['bytes'])
+
+    print('accessed GEOS-FP {variable} and updated its rolling mean: {cached} timesteps from cache, {requests} requests, '
+          '{megabytes:.1f} MB in {seconds:.1f} s'.format(megabytes=report['bytes'] / 10**6, **report))
+    return data_mean
+
+
+# Daily sums of the GEOS-FP assimilation, for the backfill of past risk maps (see backfill_risk_maps): the weekly
+# means of the dates of a range share 6 of their 7 days with the next date, so every day is downloaded and summed once
+#   <folder>/<YYYYmmdd>.npz    sum and count of the timesteps of the day, and the lat/lon of the africa subset
+def geos_day_file(folder, day):
+    return os.path.join(folder, '{}.npz'.format(day.strftime('%Y%m%d')))
+
+
+# Function that downloads the timesteps of the given days (datetime.date) of one GEOS-FP variable and stores their daily
+# sums in folder. The dataset is opened once for all days, days that are already in folder are skipped and every
+# timestep is requested once, in blocks of time_block. Returns the number of days summed and the bytes downloaded
+def fetch_geos_daily_sums(url, variable, days, folder, lev=None, time_block=1):
+    missing = sorted(day for day in set(days) if not os.path.exists(geos_day_file(folder, day)))
+    if not missing:
+        return 0, 0
+    os.makedirs(folder, exist_ok=True)
+    started = time.monotonic()
+    dataset, data, _ = open_geos_subset(url, variable, '{}T00:00:00'.format(missing[0]), '{}T23:59:59'.format(missing[-1]), lev=lev)
+    times = dataset.time.values
+
+    transferred = 0
+    summed = []
+    for day in missing:
+        day_slice = coordinate_index_slice(times, np.datetime64('{}T00:00:00'.format(day)), np.datetime64('{}T23:59:59'.format(day)))
+        # a day that is not published (yet) is not stored, the dates that need it can't be computed
+        if day_slice.stop == day_slice.start:
+            print('GEOS-FP {} has no timesteps on {}'.format(variable, day))
+            continue
+        value_sum = np.zeros(data.shape[1:], dtype=np.float64)
+        value_count = np.zeros(data.shape[1:], dtype=np.int64)
+        for block_start in range(day_slice.start, day_slice.stop, time_block):
+            block = data.isel(time=slice(block_start, min(block_start + time_block, day_slice.stop))).values
+            transferred += block.nbytes
+            accumulate_block(value_sum, value_count, block)
+
+        day_file = geos_day_file(folder, day)
+        temporary_file = temporary_path(day_file, '.npz')
+        np.savez(temporary_file, sum=value_sum, count=value_count, lat=data.lat.values, lon=data.lon.values,
+                 timesteps=day_slice.stop - day_slice.start, dtype=str(data.dtype))
+        os.replace(temporary_file, day_file)
+        summed.append(day)
+    dataset.close()
+    record_network(geos_source(url), transferred)
+
+    print('summed GEOS-FP {} of {} days: {:.1f} MB in {:.1f} s'.format(variable, len(summed), transferred / 10**6, time.monotonic() - started))
+    return len(summed), transferred
+
+
+# Function that returns the mean of one GEOS-FP variable over the given days from their daily sums, as a (lat, lon)
+# DataArray like fetch_geos_mean
+def geos_days_mean(folder, days, variable):
+    value_sum = None
+    for day in days:
+        with np.load(geos_day_file(folder, day)) as day_sums:
+            if value_sum is None:
+                value_sum = day_sums['sum'].copy()
+                value_count = day_sums['count'].copy()
+                coords = {'lat': day_sums['lat'], 'lon': day_sums['lon']}
+                dtype = str(day_sums['dtype'])
+            else:
+                value_sum += day_sums['sum']
+                value_count += day_sums['count']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(value_count > 0, value_sum / value_count, np.nan).astype(dtype)
+    return xr.DataArray(mean, coords=coords, dims=('lat', 'lon'), name=variable)
+
+
+# Function that evicts cached GEOS-FP timesteps: first everything older than max_age_days,
+# then the oldest timesteps until the cache is smaller than max_bytes
+# timesteps of the current rolling window of a variable are never evicted
+def evict_geos_cache(cache_dir, max_age_days, max_bytes):
+    cutoff = np.datetime64(datetime.utcnow()) - np.timedelta64(max_age_days, 'D')
+
+    cached = []
+    for folder, _, file_names in os.walk(cache_dir):
+        keep = set()
+        if 'window.npz' in file_names:
+            keep = set(np.load(os.path.join(folder, 'window.npz'))['timestamps'])
+        for file_name in file_names:
+            if file_name.endswith('.nc'):
+                # file names are the timesteps without the colon, e.g. 2024-05-01T0130.nc
+                timestamp = '{}:{}'.format(file_name[:13], file_name[13:15])
+                file_path = os.path.join(folder, file_name)
+                cached.append((np.datetime64(timestamp), os.path.getsize(file_path), file_path, timestamp in keep))
+    cached.sort()
+
+    total = sum(size for _, size, _, _ in cached)
+    removed = 0
+    for timestamp, size, file_path, in_window in cached:
+        if in_window:
+            continue
+        if timestamp < cutoff or total > max_bytes:
+            os.remove(file_path)
+            total -= size
+            removed += 1
+
+    print('evicted {} timesteps from the GEOS-FP cache'.format(removed))
+
+
+# Steps (hours after 00z) of the ECMWF open data ensemble forecast: 3 hourly up to 144, 6 hourly from 144 to 360
+ECMWF_ENSEMBLE_STEPS = list(range(0, 144, 3)) + list(range(144, 361, 6))
+
+
+# Function that returns the published steps of all forecast horizons [(name, first step, last step)], in order and
+# each only once, so the horizons share one download
+def ensemble_steps(horizons):
+    return [step for step in ECMWF_ENSEMBLE_STEPS if any(first <= step <= last for _, first, last in horizons)]
+
+
+# Function that downloads the ECMWF ensemble forecast (control + 50 perturbed members) of one parameter to a grib2 file
+# The download goes to the workspace of the run when one is given, and is only moved to target once it is complete
+def fetch_ecmwf_ensemble(param, steps, levtype, target, levelist=None, source="ecmwf", workspace=None):
+    download = target if workspace is None else workspace_path(workspace, 'downloads', os.path.basename(target))
+    request = {
+        'date': 0,
+        'time': 0,
+        'step': steps,
+        'stream': "enfo",
+        'type': ['cf', 'pf'],
+        'levtype': levtype,
+        'param': param,
+        'target': download,
+    }
+    if levelist is not None:
+        request['levelist'] = levelist
+
+    client = Client(source, beta=True)
+    client.retrieve(**request)
+    record_network('ecmwf/{}'.format(param), os.path.getsize(download))
+    if download != target:
+        move_into_place(download, target)
+
+    print('accessed and stored ECMWF {} forecast'.format(param))
+    return target
@@ -5,12 +5,304 @@ from eccodes import *
 import rasterio
 import fiona
 from rasterio.mask import mask
+from rasterio.features import geometry_mask, bounds
+from rasterio.warp import reproject, Resampling
+from rasterio.windows import Window
+import rasterio.shutil
+from affine import Affine
+from collections import namedtuple, deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 from osgeo import gdal
+import math
+import operator
+import json
+import hashlib
+import warnings
 import os
 
+from .instrumentation_fun import instrumented
+from .workspace_fun import workspace_path, temporary_path
+
+
+# In-memory raster used by the processing pipeline: a 2D array plus its georeferencing
+# The file based functions below read a GeoTIFF into a Raster, call the array function and write the result back,
+# so the pipeline can chain the array functions and only write the final risk maps to disk
+Raster = namedtuple('Raster', ['array', 'transform', 'crs', 'nodata'])
+
+
+# Function that reads the first band of a raster file into a Raster
+@instrumented
+def read_raster(input_file):
+    with rasterio.open(input_file) as src:
+        return Raster(src.read(1), src.transform, src.crs, src.nodata)
+
+
+# Function that writes a Raster to a single band GeoTIFF file
+@instrumented
+def write_raster(raster, output_file):
+    with rasterio.open(output_file, 'w', driver='GTiff',
+                       width=raster.array.shape[1], height=raster.array.shape[0],
+                       count=1, dtype=raster.array.dtype,
+                       nodata=raster.nodata,
+                       crs=raster.crs, transform=raster.transform) as dst:
+        dst.write(raster.array, 1)
+
+
+# Layout of the GeoTIFFs that are written window by window: 256x256 tiles, so every window is a set of whole tiles
+TILE_SIZE = 256
+TILED_GTIFF = {'driver': 'GTiff', 'tiled': True, 'blockxsize': TILE_SIZE, 'blockysize': TILE_SIZE, 'compress': 'deflate'}
+
+# The risk maps are stored as cloud optimized GeoTIFFs (COG): 256x256 tiles, compressed, with overviews in front of the
+# full resolution tiles, so a map tile at a low zoom level or a range request only reads a small part of the file.
+# The risk levels are 1-9, so the pixels are uint8 with 255 as nodata, and the overviews are built with mode resampling
+# (the most frequent level) because the levels are categories
+RISK_MAP_DTYPE = np.uint8
+RISK_MAP_NODATA = 255
+COG_OPTIONS = {'driver': 'COG', 'blocksize': TILE_SIZE, 'overview_resampling': 'mode', 'bigtiff': 'if_safer'}
+
+# default amount of memory the windowed functions may use for the arrays of one window
+DEFAULT_MEMORY_BUDGET = 256 * 1024**2
+
+
+# Function that splits a raster of the given size into square windows of whole tiles,
+# as large as possible while one window of bytes_per_pixel stays within memory_budget bytes
+def block_windows(height, width, bytes_per_pixel, memory_budget):
+    size = max(1, int(math.sqrt(memory_budget / bytes_per_pixel)) // TILE_SIZE) * TILE_SIZE
+    return [Window(col, row, min(size, width - col), min(size, height - row))
+            for row in range(0, height, size) for col in range(0, width, size)]
+
+
+# Function that applies a pixel by pixel array function (Raster -> Raster) to a raster file window by window
+# and writes the result as a tiled GeoTIFF, so only one window of the raster is in memory at a time
+@instrumented
+def apply_windowed(input_file, output_file, function, *args, memory_budget=DEFAULT_MEMORY_BUDGET):
+    with rasterio.open(input_file) as src:
+        # input window, output window and the temporary array of the function
+        windows = block_windows(src.height, src.width, 3 * np.dtype(src.dtypes[0]).itemsize, memory_budget)
+        with rasterio.open(output_file, 'w', width=src.width, height=src.height, count=1, dtype=src.dtypes[0],
+                           nodata=src.nodata, crs=src.crs, transform=src.transform, **TILED_GTIFF) as dst:
+            for window in windows:
+                block = Raster(src.read(1, window=window), src.window_transform(window), src.crs, src.nodata)
+                dst.write(function(block, *args).array, 1, window=window)
+
+
+# Function that copies a tiled GeoTIFF into a COG, compress is 'deflate' or 'zstd'
+# the COG driver builds the overviews itself while copying, into a temporary file next to the output that then replaces
+# it, so the output is never read (or written by another run) half copied
+@instrumented
+def write_cog(input_file, output_file, compress='deflate'):
+    temporary_file = temporary_path(output_file, '.tif')
+    try:
+        rasterio.shutil.copy(input_file, temporary_file, compress=compress, **COG_OPTIONS)
+        os.replace(temporary_file, output_file)
+    finally:
+        if os.path.exists(temporary_file):
+            os.remove(temporary_file)
+
+
+# Function that returns the path of the uncompressed copy of a raster that is written before the COG: in the workspace
+# of the run when one is given, otherwise next to the output
+def scratch_raster_path(output_file, workspace=None):
+    if workspace is None:
+        return temporary_path(output_file, '.tif')
+    return workspace_path(workspace, 'scratch', temporary_path(os.path.basename(output_file), '.tif'))
+
+
+# Function that rewrites a risk map of an older version (int16 with 9999 as nodata, no tiles or overviews) as a uint8 COG
+# in place, window by window (the uncompressed copy is written to the workspace of the run when one is given)
+@instrumented
+def convert_risk_map_to_cog(risk_map_file, compress='deflate', memory_budget=DEFAULT_MEMORY_BUDGET, workspace=None):
+    temporary_file = scratch_raster_path(risk_map_file, workspace)
+    try:
+        with rasterio.open(risk_map_file) as src:
+            windows = block_windows(src.height, src.width, 4 * np.dtype(src.dtypes[0]).itemsize, memory_budget)
+            with rasterio.open(temporary_file, 'w', width=src.width, height=src.height, count=1, dtype=RISK_MAP_DTYPE,
+                               nodata=RISK_MAP_NODATA, crs=src.crs, transform=src.transform, **TILED_GTIFF) as dst:
+                for window in windows:
+                    levels = src.read(1, window=window)
+                    nodata = (levels == src.nodata) if src.nodata is not None else np.zeros(levels.shape, dtype=bool)
+                    dst.write(np.where(nodata, RISK_MAP_NODATA, levels), 1, window=window)
+
+        write_cog(temporary_file, risk_map_file, compress)
+    finally:
+        if os.path.exists(temporary_file):
+            os.remove(temporary_file)
+    # statistics GDAL kept next to the old file
+    if os.path.exists(risk_map_file + '.aux.xml'):
+        os.remove(risk_map_file + '.aux.xml')
+
+
+# Function that turns a 2D (lat, lon) xarray DataArray into a north-up Raster in EPSG:4326
+# replaces writing the DataArray to .nc and reading it back through the GDAL netCDF driver
+@instrumented
+def dataarray_to_raster(data_array):
+    # GDAL presents bottom-up netCDF grids north-up, so flip ascending latitudes the same way
+    if data_array.lat.values[0] < data_array.lat.values[-1]:
+        data_array = data_array.isel(lat=slice(None, None, -1))
+
+    lons = data_array.lon.values
+    lats = data_array.lat.values
+    x_res = float(lons[1] - lons[0])
+    y_res = float(lats[0] - lats[1])
+    transform = Affine(x_res, 0.0, float(lons[0]) - x_res / 2, 0.0, -y_res, float(lats[0]) + y_res / 2)
+
+    return Raster(np.asarray(data_array.values), transform, rasterio.crs.CRS.from_epsg(4326), np.nan)
+
+
+# Function that decodes the messages of a GRIB file one at a time
+# yields the values (2D, missing values as nan), the grid keys, the ensemble member number (0 = control forecast) and
+# the forecast step (hours). With keep_step only the messages whose step it returns True for are decoded, the others
+# are skipped
+def grib_fields(grib_file, keep_step=None):
+    with open(grib_file, "rb") as f:
+        while True:
+            gid = codes_grib_new_from_file(f)
+            if gid is None:
+                break
+            try:
+                step = codes_get(gid, "endStep")
+                if keep_step is not None and not keep_step(step):
+                    continue
+                grid = (codes_get(gid, "Ni"), codes_get(gid, "Nj"),
+                        codes_get(gid, "latitudeOfFirstGridPointInDegrees"), codes_get(gid, "longitudeOfFirstGridPointInDegrees"),
+                        codes_get(gid, "iDirectionIncrementInDegrees"), codes_get(gid, "jDirectionIncrementInDegrees"),
+                        codes_get(gid, "jScansPositively"), codes_get(gid, "iScansNegatively"))
+                values = codes_get_values(gid).reshape(grid[1], grid[0])
+                if codes_get(gid, "bitmapPresent"):
+                    values = np.where(values == codes_get(gid, "missingValue"), np.nan, values)
+                member = codes_get(gid, "perturbationNumber") if codes_is_defined(gid, "perturbationNumber") else 0
+            finally:
+                codes_release(gid)
+            yield values, grid, member, step
+
+
+# Function that turns values on a GRIB grid (last two axes) north-up and west to east like the GeoTIFFs written by GDAL
+# and returns them with their transform; global grids that start at 0 (or 180) are rolled to start at -180
+def orient_grib_values(values, grid):
+    ni, nj, lat_first, lon_first, lon_step, lat_step, j_positive, i_negative = grid
+    if j_positive:
+        values = values[..., ::-1, :]
+        lat_first += (nj - 1) * lat_step
+    if i_negative:
+        values = values[..., ::-1]
+        lon_first -= (ni - 1) * lon_step
+    lon_first = (lon_first + 180) % 360 - 180
+    if abs(ni * lon_step - 360) < lon_step / 2 and lon_first != -180:
+        values = np.roll(values, int(round((lon_first + 180) / lon_step)) % ni, axis=-1)
+        lon_first = -180.0
+
+    transform = Affine(lon_step, 0.0, lon_first - lon_step / 2, 0.0, -lat_step, lat_first + lat_step / 2)
+    return np.ascontiguousarray(values), transform
+
+
+# Function that computes the mean of all messages of a GRIB file (e.g. every ensemble member and step of one parameter)
+# and returns it as a north-up float32 Raster in EPSG:4326, georeferenced from the grid keys of the messages.
+# The messages are decoded one at a time with eccodes and added to a running sum and count, so only one field is in
+# memory whatever the number of members and steps. Missing values are skipped like in ecdata.mean.
+# Values stay in the units of the GRIB file (2t in K, unlike the GeoTIFFs of transform_grib2_to_TIFF that GDAL converts to C)
+@instrumented
+def grib_mean_to_raster(grib_file):
+    value_sum = None
+    for values, grid, member, step in grib_fields(grib_file):
+        if value_sum is None:
+            first_grid = grid
+            value_sum = np.zeros(values.shape, dtype=np.float64)
+            value_count = np.zeros(values.shape, dtype=np.int32)
+        elif grid != first_grid:
+            raise ValueError('{} contains messages on different grids'.format(grib_file))
+        valid = ~np.isnan(values)
+        value_sum += np.where(valid, values, 0)
+        value_count += valid
+
+    if value_sum is None:
+        raise ValueError('{} contains no GRIB messages'.format(grib_file))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(value_count > 0, value_sum / value_count, np.nan).astype(np.float32)
+
+    mean, transform = orient_grib_values(mean, first_grid)
+    return Raster(mean, transform, rasterio.crs.CRS.from_epsg(4326), np.nan)
+
+
+# Function that returns the window of a grid that covers the target Grid, None when the target is not
+# a part of the grid with the same pixel size and pixel edges
+def grid_window(transform, shape, target):
+    if (target.transform.a, target.transform.e) != (transform.a, transform.e):
+        return None
+    col_off = (target.transform.c - transform.c) / transform.a
+    row_off = (target.transform.f - transform.f) / transform.e
+    if abs(col_off - round(col_off)) > 1e-6 or abs(row_off - round(row_off)) > 1e-6:
+        return None
+    window = Window(int(round(col_off)), int(round(row_off)), target.shape[1], target.shape[0])
+    if window.col_off < 0 or window.row_off < 0 or window.col_off + window.width > shape[1] or window.row_off + window.height > shape[0]:
+        return None
+    return window
+
+
+# Function that goes through an ensemble GRIB file once and computes the mean over all steps of every member
+# (a running sum and count per member) as well as the mean of all messages (same as grib_mean_to_raster).
+# With a target Grid that is a part of the GRIB grid only that part is kept, so memory is members x target grid
+# whatever the number of steps.
+# Returns the member means as a (members, rows, cols) float32 Raster, the overall mean Raster and the member numbers
+@instrumented
+def grib_ensemble_means(grib_file, target=None):
+    return grib_window_ensemble_means(grib_file, {'all': (-math.inf, math.inf)}, target)['all']
+
+
+# Function like grib_ensemble_means for several windows of forecast steps at once, e.g. the forecast weeks of the risk
+# maps: the GRIB file is decoded once and every message is added to the running sums of the windows its step is in,
+# so the means of all windows come from one download and one pass over it (messages of other steps are not decoded).
+# windows are {name: (first step, last step)}, returns {name: (member means, mean, member numbers)}
+@instrumented
+def grib_window_ensemble_means(grib_file, windows, target=None):
+    member_sums = {name: {} for name in windows}
+    member_counts = {name: {} for name in windows}
+    first_grid = None
+
+    def windows_of(step):
+        return [name for name, (first, last) in windows.items() if first <= step <= last]
+
+    for values, grid, member, step in grib_fields(grib_file, lambda step: bool(windows_of(step))):
+        in_windows = windows_of(step)
+        if first_grid is None:
+            first_grid = grid
+            slices = (slice(None), slice(None))
+            transform = orient_grib_values(values[:1, :1], grid)[1]
+            window = None if target is None else grid_window(transform, (grid[1], grid[0]), target)
+            if window is not None:
+                slices = window.toslices()
+                transform = rasterio.windows.transform(window, transform)
+        elif grid != first_grid:
+            raise ValueError('{} contains messages on different grids'.format(grib_file))
+
+        values = orient_grib_values(values, grid)[0][slices]
+        valid = ~np.isnan(values)
+        values = np.where(valid, values, 0)
+        for name in in_windows:
+            if member not in member_sums[name]:
+                member_sums[name][member] = np.zeros(values.shape, dtype=np.float64)
+                member_counts[name][member] = np.zeros(values.shape, dtype=np.int32)
+            member_sums[name][member] += values
+            member_counts[name][member] += valid
+
+    crs = rasterio.crs.CRS.from_epsg(4326)
+    means = {}
+    for name in windows:
+        if not member_sums[name]:
+            raise ValueError('{} contains no GRIB messages of the steps {} - {}'.format(grib_file, *windows[name]))
+        sums, counts = member_sums[name], member_counts[name]
+        members = sorted(sums)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            member_means = np.stack([np.where(counts[member] > 0, sums[member] / counts[member], np.nan) for member in members]).astype(np.float32)
+            total_count = sum(counts.values())
+            mean = np.where(total_count > 0, sum(sums.values()) / total_count, np.nan).astype(np.float32)
+        means[name] = (Raster(member_means, transform, crs, np.nan), Raster(mean, transform, crs, np.nan), members)
+    return means
+
 
 # Function to decompress ccds grib2 to simple grib2
+@instrumented
 def ccds_to_simple (input_file, output_file):
     with open(input_file, "rb") as f:
         # Create a GRIB handle for the input file
@@ -34,6 +326,7 @@ def ccds_to_simple (input_file, output_file):
 
 
 # Function to transform a grib2 file into a GeoTIFF file
+@instrumented
 def transform_grib2_to_TIFF (grib2_file, TIFF_output_file):
     src_ds = gdal.Open(grib2_file)
     dst_filename = TIFF_output_file
@@ -59,179 +352,657 @@ def transform_grib2_to_TIFF (grib2_file, TIFF_output_file):
     src_dsTemp = None
 
 
-# Function to clip the raster files to the outlines of Africa
-def create_mask_from_shapefile(shapefile_filepath, corresponding_orthomosaic_filepath, output_file):
+# checksums of the shapefiles by (path, size, modification time), so a shapefile is only hashed again when it changes
+shapefile_checksums = {}
+
+
+# Function that returns the checksum of a shapefile and its side files (.shx, .dbf, .prj, ...)
+def shapefile_checksum(shapefile_filepath):
+    stem = os.path.splitext(shapefile_filepath)[0]
+    parts = sorted(stem + extension for extension in ('.shp', '.shx', '.dbf', '.prj', '.cpg') if os.path.exists(stem + extension))
+    key = tuple((part, os.path.getsize(part), os.path.getmtime(part)) for part in parts)
+    if key not in shapefile_checksums:
+        checksum = hashlib.sha1()
+        for part in parts:
+            with open(part, 'rb') as part_file:
+                checksum.update(part_file.read())
+        shapefile_checksums[key] = checksum.hexdigest()
+    return shapefile_checksums[key]
+
+
+# rasterized shapefile masks by grid, the last MASK_CACHE_SIZE are kept in memory (and all of them on disk)
+MASK_CACHE_SIZE = 16
+shape_masks = OrderedDict()
 
-    # open shapefile
+
+# Function that rasterizes the shapes of a shapefile onto a grid
+# Returns the window to read (with crop: the outermost pixels containing the shapes, otherwise the whole grid)
+# and the boolean mask of that window that is True outside of the shapes
+@instrumented
+def rasterize_shape_mask(shapefile_filepath, transform, shape, crop):
     with fiona.open(shapefile_filepath, 'r') as shapefile:
         shapes = [feature['geometry'] for feature in shapefile]
 
-    # open rasterfile
-    with rasterio.open(corresponding_orthomosaic_filepath, 'r') as src:
-        out_image, out_transform = mask(src, shapes, crop=True, nodata=np.nan) # setting all pixels outside of the feature zone to nan
-        out_meta = src.meta
+    height, width = shape
+    window = Window(0, 0, width, height)
+    if crop:
+        # crop window = outermost pixels containing the shapes (floor of offsets, ceiling of width and height)
+        all_bounds = [bounds(geometry, transform=~transform) for geometry in shapes]
+        col_start = int(math.floor(min(b[0] for b in all_bounds)))
+        col_stop = int(math.ceil(max(b[2] for b in all_bounds)))
+        row_start = int(math.floor(min(b[3] for b in all_bounds)))
+        row_stop = int(math.ceil(max(b[1] for b in all_bounds)))
+        window = Window(col_start, row_start, col_stop - col_start, row_stop - row_start).intersection(window)
+
+    outside = geometry_mask(shapes, transform=rasterio.windows.transform(window, transform), out_shape=(window.height, window.width))
+    return window, outside
+
+
+# Function that returns the window and outside mask of a shapefile on a grid (see rasterize_shape_mask)
+# The shapes are only rasterized once per grid (transform, shape, CRS) and version of the shapefile: masks are kept in
+# memory and, when a cache_dir is given, on disk, so every variable on the same grid is clipped with the same mask
+# (masks of single windows are only read once per run, they are not kept in memory)
+@instrumented
+def cached_shape_mask(shapefile_filepath, transform, shape, crs, crop=True, cache_dir=None, keep_in_memory=True):
+    key = repr((tuple(transform), tuple(shape), crs.to_wkt() if crs else None, shapefile_checksum(shapefile_filepath), crop))
+    if key in shape_masks:
+        shape_masks.move_to_end(key)
+        return shape_masks[key]
+
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.npz')
+
+    if cache_file is not None and os.path.exists(cache_file):
+        cached = np.load(cache_file)
+        col_off, row_off, width, height = cached['window']
+        window = Window(int(col_off), int(row_off), int(width), int(height))
+        outside = np.unpackbits(cached['outside'], count=window.height * window.width).reshape(window.height, window.width).astype(bool)
+    else:
+        window, outside = rasterize_shape_mask(shapefile_filepath, transform, shape, crop)
+        if cache_file is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            # written to a temporary file first, so an interrupted run never leaves a broken mask in the cache
+            temporary_file = temporary_path(cache_file, '.npz')
+            np.savez_compressed(temporary_file, outside=np.packbits(outside),
+                                window=np.array([window.col_off, window.row_off, window.width, window.height]))
+            os.replace(temporary_file, cache_file)
+
+    if keep_in_memory:
+        shape_masks[key] = (window, outside)
+        if len(shape_masks) > MASK_CACHE_SIZE:
+            shape_masks.popitem(last=False)
+    return window, outside
+
+
+# Function to clip an in-memory Raster to the outlines of Africa
+# same result as rasterio.mask.mask(src, shapes, crop=True, nodata=np.nan) on the equivalent file
+# the rasterized outlines come from the mask cache, so clipping is an array slice and a np.where
+@instrumented
+def clip_raster_to_shapefile(shapefile_filepath, raster, fill_value=np.nan, cache_dir=None):
+    window, outside = cached_shape_mask(shapefile_filepath, raster.transform, raster.array.shape, raster.crs, cache_dir=cache_dir)
+    row_slice, col_slice = window.toslices()
+    out_transform = rasterio.windows.transform(window, raster.transform)
+
+    out_image = raster.array[row_slice, col_slice]
+
+    # pixels outside of the shapes or already flagged as nodata are set to the fill value
+    if raster.nodata is not None:
+        if np.isnan(raster.nodata):
+            outside = outside | np.isnan(out_image)
+        else:
+            outside = outside | (out_image == raster.nodata)
+    out_image = np.where(outside, np.array(fill_value, dtype=out_image.dtype), out_image)
 
-    out_meta.update({"driver": "GTiff",
-    "height": out_image.shape[1],
-    "width": out_image.shape[2],
-    "transform": out_transform})
+    return Raster(out_image, out_transform, raster.crs, raster.nodata)
 
-    output_file = output_file
 
-    with rasterio.open(output_file, "w", **out_meta) as dest:
-        dest.write(out_image)
+# Function to clip the raster files to the outlines of Africa
+@instrumented
+def create_mask_from_shapefile(shapefile_filepath, corresponding_orthomosaic_filepath, output_file):
+    raster = read_raster(corresponding_orthomosaic_filepath)
+    write_raster(clip_raster_to_shapefile(shapefile_filepath, raster), output_file)
 
 
-# function that multiplies every pixel of the raster by a scalar
-def multiply_raster_by_scalar(input_raster, output_raster, scalar):
-    # Get current directory
-    current_directory = os.getcwd()
-    
-    # Construct full paths for output rasters
-    #input_raster_path = os.path.join(current_directory, input_raster_filename)
-    #output_raster_path = os.path.join(current_directory, output_raster_filename)
-    
-    with rasterio.open(input_raster) as src:
-        # Read raster data
-        raster_data = src.read(1)
+# Function that multiplies every pixel of an in-memory Raster by a scalar
+@instrumented
+def multiply_array_by_scalar(raster, scalar):
+    # Convert the data type of the modified array back to the data type of the input raster
+    modified_array = (raster.array * scalar).astype(raster.array.dtype)
+    return raster._replace(array=modified_array)
 
-        # Apply scalar multiplication
-        modified_raster_data = raster_data * scalar
 
-        # Get metadata
-        profile = src.profile
-        
-        # Convert the data type of the modified array to match the data type of the output raster file
-        modified_raster_data = modified_raster_data.astype(profile['dtype'])
+# Function that substracts a scalar from every pixel of an in-memory Raster
+@instrumented
+def subtract_scalar_from_array(raster, scalar):
+    modified_array = (raster.array - scalar).astype(raster.array.dtype)
+    return raster._replace(array=modified_array)
 
-    # Write the modified raster to output file
-    with rasterio.open(output_raster, 'w', **profile) as dst:
-        dst.write(modified_raster_data, 1)
+
+# function that multiplies every pixel of the raster by a scalar
+@instrumented
+def multiply_raster_by_scalar(input_raster, output_raster, scalar, memory_budget=DEFAULT_MEMORY_BUDGET):
+    apply_windowed(input_raster, output_raster, multiply_array_by_scalar, scalar, memory_budget=memory_budget)
 
     print("Raster multiplication completed successfully.")
 
 
 # Funtion that substract a scalar from every pixel in the raster file
-def subtract_scalar_from_raster(input_raster, output_raster_filename, scalar):
-    # Get current directory
-    current_directory = os.getcwd()
-    
-    # Construct full paths for output rasters
-    #input_raster_path = os.path.join(current_directory, input_raster_filename)
-    output_raster_path = os.path.join(current_directory, output_raster_filename)
-    
-    with rasterio.open(input_raster) as src:
-        # Read raster data
-        raster_data = src.read(1)
-
-        # Apply scalar multiplication
-        modified_raster_data = raster_data - scalar
-
-        # Get metadata
-        profile = src.profile
-        
-        # Convert the data type of the modified array to match the data type of the output raster file
-        modified_raster_data = modified_raster_data.astype(profile['dtype'])
-
-    # Write the modified raster to output file
-    with rasterio.open(output_raster_path, 'w', **profile) as dst:
-        dst.write(modified_raster_data, 1)
+@instrumented
+def subtract_scalar_from_raster(input_raster, output_raster, scalar, memory_budget=DEFAULT_MEMORY_BUDGET):
+    apply_windowed(input_raster, output_raster, subtract_scalar_from_array, scalar, memory_budget=memory_budget)
 
     print("Raster substraction completed successfully.")
 
 
-def resample_resolution(inputFilename, outputFilename):
-    # open reference file and get resolution
-    dirname = os.getcwd()
-    referenceFile = os.path.join(dirname,"IntermediateDataFiles", "RH_fc_weekly_mean_mask.tif")
-    reference = gdal.Open(referenceFile, 0)  # this opens the file in only reading mode
-    print(type(reference))
-    referenceTrans = reference.GetGeoTransform()
-    x_res = referenceTrans[1]
-    y_res = -referenceTrans[5]  # make sure this value is positive
-
-    # get reference raster size
-    ref_cols = reference.RasterXSize
-    ref_rows = reference.RasterYSize
-    
-    # call gdal Warp
-    kwargs = {"format": "GTiff", "xRes": x_res, "yRes": y_res, "outputBounds": [referenceTrans[0], referenceTrans[3] - ref_rows * y_res, referenceTrans[0] + ref_cols * x_res, referenceTrans[3]]}
-    ds = gdal.Warp(outputFilename, inputFilename, **kwargs)
+# Grid of a raster without its data: the target of a regridding is given as a Grid instead of a reference file
+Grid = namedtuple('Grid', ['transform', 'shape', 'crs'])
+
+
+def raster_grid(raster):
+    return Grid(raster.transform, raster.array.shape, raster.crs)
+
+
+# Function that reads the grid of a raster file (only the header, not the data)
+@instrumented
+def read_grid(input_file):
+    with rasterio.open(input_file) as src:
+        return Grid(src.transform, src.shape, src.crs)
+
+
+# Function that returns the global lat/lon grid of the given resolution as it is published by ECMWF open data:
+# pixel centres from 90 to -90 and from -180 to 180 - resolution (e.g. 721 x 1440 at 0.25 degrees)
+@instrumented
+def global_grid(resolution):
+    transform = Affine(resolution, 0.0, -180 - resolution / 2, 0.0, -resolution, 90 + resolution / 2)
+    return Grid(transform, (int(round(180 / resolution)) + 1, int(round(360 / resolution))), rasterio.crs.CRS.from_epsg(4326))
+
+
+# Function that returns the grid a raster on the given grid has after clip_raster_to_shapefile
+@instrumented
+def clip_grid(shapefile_filepath, grid, cache_dir=None):
+    window = cached_shape_mask(shapefile_filepath, grid.transform, grid.shape, grid.crs, cache_dir=cache_dir)[0]
+    return Grid(rasterio.windows.transform(window, grid.transform), (window.height, window.width), grid.crs)
+
+
+REGRID_METHODS = ('nearest', 'bilinear')
+
+# regrid plans by (source grid, target grid, method), also kept on disk when a cache_dir is given
+regrid_plans = {}
+
+
+# Function that works out which source pixels (and weights) make up every target pixel
+# nearest: same source pixel as a nearest neighbour gdal warp, found by warping the array of source pixel indices
+#          (also between CRSs, e.g. onto the web mercator tiles of raster_ingest_fun)
+# bilinear: the 4 source pixels around the target pixel centre and their bilinear weights (grids in the same CRS)
+# Returns (index, weights), index is -1 where a target pixel has no source pixel
+def build_regrid_plan(source, target, method):
+    source_size = source.shape[0] * source.shape[1]
+    index_dtype = np.int32 if source_size < np.iinfo(np.int32).max else np.int64
+
+    if method == 'nearest':
+        index = np.full(target.shape, -1, dtype=index_dtype)
+        reproject(np.arange(source_size, dtype=index_dtype).reshape(source.shape), index,
+                  src_transform=source.transform, src_crs=source.crs,
+                  dst_transform=target.transform, dst_crs=target.crs or source.crs, dst_nodata=-1,
+                  resampling=Resampling.nearest)
+        return index, None
+
+    if method == 'bilinear':
+        if target.crs != source.crs:
+            raise ValueError('bilinear regridding needs both grids in the same CRS')
+        rows, cols = np.mgrid[0:target.shape[0], 0:target.shape[1]]
+        x, y = target.transform * (cols + 0.5, rows + 0.5)
+        source_cols, source_rows = ~source.transform * (x, y)
+        # pixel centres of the source grid are at index + 0.5
+        source_cols -= 0.5
+        source_rows -= 0.5
+        col0 = np.floor(source_cols).astype(index_dtype)
+        row0 = np.floor(source_rows).astype(index_dtype)
+        col_weight = (source_cols - col0).astype(np.float32)
+        row_weight = (source_rows - row0).astype(np.float32)
+
+        index = np.empty((4,) + tuple(target.shape), dtype=index_dtype)
+        weights = np.empty((4,) + tuple(target.shape), dtype=np.float32)
+        corners = ((0, 0, (1 - row_weight) * (1 - col_weight)), (0, 1, (1 - row_weight) * col_weight),
+                   (1, 0, row_weight * (1 - col_weight)), (1, 1, row_weight * col_weight))
+        for corner, (row_step, col_step, weight) in enumerate(corners):
+            corner_rows = row0 + row_step
+            corner_cols = col0 + col_step
+            inside = (corner_rows >= 0) & (corner_rows < source.shape[0]) & (corner_cols >= 0) & (corner_cols < source.shape[1])
+            index[corner] = np.where(inside, corner_rows * source.shape[1] + corner_cols, -1)
+            weights[corner] = np.where(inside, weight, 0)
+        return index, weights
+
+    raise ValueError('unknown regrid method {}, use one of {}'.format(method, ', '.join(REGRID_METHODS)))
+
+
+# Function that returns the regrid plan from one grid to another, it is only built the first time it is used
+# (and read from cache_dir in later runs, the GEOS-FP and ECMWF grids don't change from day to day)
+@instrumented
+def get_regrid_plan(source, target, method='nearest', cache_dir=None):
+    key = repr((tuple(source.transform), tuple(source.shape), source.crs.to_wkt() if source.crs else None,
+                tuple(target.transform), tuple(target.shape), target.crs.to_wkt() if target.crs else None, method))
+    if key in regrid_plans:
+        return regrid_plans[key]
+
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.npz')
+
+    if cache_file is not None and os.path.exists(cache_file):
+        cached = np.load(cache_file)
+        plan = (cached['index'], cached['weights'] if 'weights' in cached else None)
+    else:
+        plan = build_regrid_plan(source, target, method)
+        if cache_file is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            arrays = {'index': plan[0]} if plan[1] is None else {'index': plan[0], 'weights': plan[1]}
+            temporary_file = temporary_path(cache_file, '.npz')
+            np.savez_compressed(temporary_file, **arrays)
+            os.replace(temporary_file, cache_file)
+
+    regrid_plans[key] = plan
+    return plan
+
+
+# Function that regrids an in-memory Raster onto the target Grid with a cached plan, so regridding is one indexed
+# gather per array instead of a warp (nearest gives the same result as the previous gdal.Warp call)
+# pixels of the target without source pixel, or whose source pixels are all nodata, get the nodata value
+@instrumented
+def regrid(raster, target, method='nearest', cache_dir=None):
+    index, weights = get_regrid_plan(raster_grid(raster), target, method, cache_dir)
+    nodata = np.nan if raster.nodata is None else raster.nodata
+    values = raster.array.ravel()
+
+    if weights is None:
+        destination = values.take(np.maximum(index, 0))
+        destination[index < 0] = nodata
+        return Raster(destination, target.transform, raster.crs, raster.nodata)
+
+    corner_values = values.take(np.maximum(index, 0)).astype(np.float64)
+    valid = (index >= 0) & ~np.isnan(corner_values)
+    if not np.isnan(nodata):
+        valid &= corner_values != nodata
+    weights = np.where(valid, weights, 0)
+    total = weights.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        destination = (np.where(valid, corner_values, 0) * weights).sum(axis=0) / total
+    destination[total == 0] = nodata
+    return Raster(destination.astype(raster.array.dtype), target.transform, raster.crs, raster.nodata)
+
+
+# Function that regrids every layer of a (members, rows, cols) Raster onto the target Grid
+@instrumented
+def regrid_members(members, target, method='nearest', cache_dir=None):
+    layers = [regrid(Raster(layer, members.transform, members.crs, members.nodata), target, method, cache_dir).array
+              for layer in members.array]
+    return Raster(np.stack(layers), target.transform, members.crs, members.nodata)
+
+
+@instrumented
+def resample_resolution(inputFilename, outputFilename, referenceFile):
+    # regrid onto the grid of the reference file (only its header is read)
+    write_raster(regrid(read_raster(inputFilename), read_grid(referenceFile)), outputFilename)
 
 # resulting raster still shows some missing pixels at the borders where RH/2tm raster has pixels
 # will this be a problem during risk map computation?
 
 
+# Vigilance levels defined by Dione et al. as (level, conditions) in the order they are applied - a pixel that meets
+# several conditions gets the level of the last one. A condition is (variable, operator, threshold) with
+# variable 0 = 2mt (C), 1 = RH (%), 2 = sdc (ug/m3)
+# 1 - highest risk level
+# 9 - lowest risk level
+# nodata - assigned to pixels that don't meet any of the conditions
+DIONE_RULES = [
+    (1, [(0, '>=', 30), (1, '<=', 20), (2, '>=', 400)]),
+    (2, [(0, '>', 27), (0, '<', 30), (1, '<=', 20), (2, '>=', 400)]),
+    (3, [(0, '>=', 30), (1, '<=', 20), (2, '>', 150), (2, '<', 400)]),
+    (4, [(0, '>=', 30), (1, '>', 40), (1, '<=', 60), (2, '>=', 400)]),
+    (5, [(0, '>', 27), (0, '<', 30), (1, '>', 20), (1, '<=', 40), (2, '>', 150), (2, '<', 400)]),
+    (6, [(0, '>', 27), (1, '<', 60), (2, '<', 150)]),
+    (7, [(0, '>', 27), (1, '>', 40), (1, '<=', 60), (2, '>', 150), (2, '<', 400)]),
+    (8, [(1, '>', 60)]),
+    (9, [(0, '<', 27)]),
+]
+
+RULE_OPERATORS = {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+
+# level of the pixels that don't meet any of the conditions
+CLASSIFIER_NODATA = 9999
+
+
+# Function that compiles a list of rules into a lookup classifier
+# Every variable is binned into classes by its thresholds t1 < ... < tn: below t1, equal to t1, between t1 and t2, ...,
+# above tn and nan. Every comparison of a rule has the same outcome for all values of one class, so evaluating the
+# rules (in order) on one representative value per class gives the level of every combination of classes.
+# Returns the thresholds of every variable and the 3D table of levels
+@instrumented
+def compile_risk_classifier(rules, nodata_value=CLASSIFIER_NODATA):
+    thresholds = [sorted({threshold for _, conditions in rules for variable, _, threshold in conditions if variable == index})
+                  for index in range(3)]
+
+    representatives = []
+    for values in thresholds:
+        values = np.array(values, dtype=np.float64)
+        if values.size == 0:
+            representatives.append(np.array([0.0, np.nan]))
+            continue
+        below = np.concatenate([[values[0] - 1], (values[:-1] + values[1:]) / 2])
+        classes = np.empty(2 * values.size + 2)
+        classes[0:-2:2] = below
+        classes[1:-2:2] = values
+        classes[-2] = values[-1] + 1
+        classes[-1] = np.nan
+        representatives.append(classes)
+
+    grids = np.meshgrid(*representatives, indexing='ij')
+    table = np.full(grids[0].shape, nodata_value, dtype=np.int16)
+    for level, conditions in rules:
+        mask = np.ones(table.shape, dtype=bool)
+        for variable, comparison, threshold in conditions:
+            mask &= RULE_OPERATORS[comparison](grids[variable], threshold)
+        table[mask] = level
+
+    return thresholds, table
+
+
+DIONE_CLASSIFIER = compile_risk_classifier(DIONE_RULES)
+
+RULE_VARIABLES = {'t2m': 0, 'rh': 1, 'sdc': 2}
+
+
+# Function that converts rules stored as JSON (RiskRuleSet.rules) into the (level, conditions) form of DIONE_RULES
+def rules_from_json(rules):
+    converted = []
+    for rule in rules:
+        conditions = []
+        for variable, comparison, threshold in rule['conditions']:
+            if variable not in RULE_VARIABLES or comparison not in RULE_OPERATORS:
+                raise ValueError('invalid condition {} {} {}'.format(variable, comparison, threshold))
+            conditions.append((RULE_VARIABLES[variable], comparison, float(threshold)))
+        converted.append((int(rule['level']), conditions))
+    return converted
+
+
+# compiled classifiers by rule set version (and rules, in case a version is edited in the admin)
+compiled_classifiers = {}
+
+
+# Function that returns the compiled classifier of a rule set, it is only compiled the first time it is used
+@instrumented
+def get_risk_classifier(version, rules):
+    key = (version, json.dumps(rules, sort_keys=True))
+    if key not in compiled_classifiers:
+        compiled_classifiers[key] = compile_risk_classifier(rules_from_json(rules))
+    return compiled_classifiers[key]
+
+
+# Function that returns the class of every value for the given thresholds:
+# 2i for values between t(i-1) and ti, 2i+1 for values equal to ti, 2n for values above tn and 2n+1 for nan
+# (the number of thresholds below a value plus the number of thresholds below or equal to it)
+def classify_variable(values, thresholds, dtype=np.uint16):
+    classes = np.zeros(values.shape, dtype=dtype)
+    for threshold in thresholds:
+        # compared like the scalar comparisons in compute_risk_array_by_masks
+        classes += values > threshold
+        classes += values >= threshold
+    classes[np.isnan(values)] = 2 * len(thresholds) + 1
+    return classes
+
+
 # Function that calculates the risk map based on the categories defined by Dione et al.
-def compute_risk_map(twomt_inputFile, rh_inputFile, sdc_inputFile, riskMap_outputFile):
+# takes the 2mt (C), RH (%) and sdc (ug/m3) Rasters on the same grid and returns the risk map Raster
+# The levels are looked up in a single pass from the compiled classifier, block by block so the temporary
+# class arrays stay small
+@instrumented
+def compute_risk_array(twomt, rh, sdc, classifier=DIONE_CLASSIFIER, nodata_value=9999, block_rows=64):
+    thresholds, table = classifier
+    flat_table = table.ravel()
+    index_dtype = np.uint16 if table.size <= np.iinfo(np.uint16).max else np.uint32
+    output_data = np.empty(twomt.array.shape, dtype=np.int16)
+
+    for row in range(0, output_data.shape[0], block_rows):
+        rows = slice(row, row + block_rows)
+        # index of the class combination in the flattened table
+        index = classify_variable(twomt.array[rows], thresholds[0], index_dtype)
+        index *= table.shape[1]
+        index += classify_variable(rh.array[rows], thresholds[1], index_dtype)
+        index *= table.shape[2]
+        index += classify_variable(sdc.array[rows], thresholds[2], index_dtype)
+        flat_table.take(index, out=output_data[rows])
+
+    return Raster(output_data, twomt.transform, twomt.crs, nodata_value)
+
+
+# Reference implementation of the risk classification: one boolean mask per condition, applied one after another
+# compute_risk_array has to give bit-identical results, this one is kept to check and benchmark it against
+@instrumented
+def compute_risk_array_by_masks(twomt, rh, sdc):
 # 1 - highest risk level
 # 9 - lowest risk level
 # nodata - assigned to pixels that don't meet any of the conditions
 
-    # Load the three input raster files
-    with rasterio.open(twomt_inputFile) as src_2mt, \
-         rasterio.open(rh_inputFile) as src_RH, \
-         rasterio.open(sdc_inputFile) as src_dustmass:
+    data1 = twomt.array
+    data2 = rh.array
+    data3 = sdc.array
 
-        # Read raster data as numpy arrays
-        data1 = src_2mt.read(1)
-        data2 = src_RH.read(1)
-        data3 = src_dustmass.read(1)
+    # fill an array with 9999 (which will also become the nodata value) for the outputfile
+    nodata_value = 9999
+    output_data = np.full_like(data1, nodata_value, dtype=np.int16)
+    
+    # Define the threshold conditions and output values
+    # Output_data file array of 9999s will be filled with these new values for pixels that meet the conditions
+    # pixels that do not meet any condition will continue to have a value of 9999 = nodatas
+    # Vigilence levels rank from pixel value=1 (highest risk) to =9(lowest risk)
+
+    # Condition 1
+    mask = (data1 >= 30) & (data2 <= 20) & (data3 >= 400)
+    output_data[mask] = 1
+    
+    # Condition 2
+    mask = (27 < data1) & (data1 < 30) & (data2 <= 20) & (data3 >= 400)
+    output_data[mask] = 2
+    
+    # Condition 3
+    mask = (data1 >= 30) & (data2 <= 20) & (150 < data3) & (data3 < 400)
+    output_data[mask] = 3
+    
+    # Condition 4
+    mask = (data1 >= 30) & (40 < data2) & (data2 <= 60) & (data3 >= 400)
+    output_data[mask] = 4
+    
+    # Condition 5
+    mask = (27 < data1) & (data1 < 30) & (20 < data2) & (data2 <= 40) & (150 < data3) & (data3 < 400)
+    output_data[mask] = 5
+    
+    # Condition 6
+    mask = (data1 > 27) & (data2 < 60) & (data3 < 150)
+    output_data[mask] = 6
+    
+    # Condition 7
+    mask = (data1 > 27) & (40 < data2) & (data2 <= 60) & (150 < data3) & (data3 < 400)
+    output_data[mask] = 7
+    
+    # Condition 8
+    mask = (data2 > 60)
+    output_data[mask] = 8
+    
+    # Condition 9
+    mask = (data1 < 27)
+    output_data[mask] = 9
+    
+    return Raster(output_data, twomt.transform, twomt.crs, nodata_value)
+
+
+# Function that returns the conditions (operator, threshold) the rules put on one variable, e.g. ('>=', 30) for 2mt
+def rule_conditions(rules, variable):
+    return sorted({(rule_operator, threshold) for _, conditions in rules
+                   for condition_variable, rule_operator, threshold in conditions if condition_variable == variable},
+                  key=lambda condition: (condition[1], condition[0]))
+
+
+# Function that computes per pixel statistics over the ensemble members (first axis of a member Raster):
+# mean, spread (standard deviation), the given percentiles and, for every condition, the probability that a member
+# meets it (e.g. P(2mt >= 30)). Returns a list of (name, Raster)
+@instrumented
+def ensemble_statistics(members, name, percentiles=(10, 50, 90), conditions=()):
+    values = members.array
+    valid_count = (~np.isnan(values)).sum(axis=0)
+    layers = []
+    with np.errstate(invalid='ignore', divide='ignore'), warnings.catch_warnings():
+        # all-nan pixels (outside of the data) give nan without a warning
+        warnings.simplefilter('ignore', RuntimeWarning)
+        layers.append(('{} mean'.format(name), np.nanmean(values, axis=0)))
+        layers.append(('{} spread'.format(name), np.nanstd(values, axis=0)))
+        for percentile, layer in zip(percentiles, np.nanpercentile(values, percentiles, axis=0)):
+            layers.append(('{} p{:g}'.format(name, percentile), layer))
+        for rule_operator, threshold in conditions:
+            meets = RULE_OPERATORS[rule_operator](values, threshold).sum(axis=0)
+            layers.append(('P({} {} {:g})'.format(name, rule_operator, threshold), np.where(valid_count > 0, meets / valid_count, np.nan)))
+
+    return [(layer_name, Raster(layer.astype(np.float32), members.transform, members.crs, np.nan)) for layer_name, layer in layers]
+
+
+# Function that returns the share of ensemble members whose own 2mt and RH (with the same sdc) give the same risk level
+# as the ensemble mean, a confidence layer for the risk map. Members are matched by position (same member numbers)
+@instrumented
+def ensemble_agreement(twomt_members, rh_members, sdc, risk_map, classifier=DIONE_CLASSIFIER, nodata_value=9999):
+    agreeing = np.zeros(risk_map.array.shape, dtype=np.int32)
+    for member in range(twomt_members.array.shape[0]):
+        member_map = compute_risk_array(Raster(twomt_members.array[member], sdc.transform, sdc.crs, np.nan),
+                                        Raster(rh_members.array[member], sdc.transform, sdc.crs, np.nan),
+                                        sdc, classifier, nodata_value)
+        agreeing += member_map.array == risk_map.array
+    agreement = (agreeing / twomt_members.array.shape[0]).astype(np.float32)
+    return Raster(agreement, risk_map.transform, risk_map.crs, np.nan)
+
+
+# Function that writes named single band Rasters on the same grid as one float32 GeoTIFF, the names become the band descriptions
+@instrumented
+def write_layers(layers, output_file):
+    first = layers[0][1]
+    with rasterio.open(output_file, 'w', width=first.array.shape[1], height=first.array.shape[0],
+                       count=len(layers), dtype=np.float32, nodata=np.nan,
+                       crs=first.crs, transform=first.transform, **TILED_GTIFF) as dst:
+        for band, (name, raster) in enumerate(layers, start=1):
+            dst.write(raster.array.astype(np.float32), band)
+            dst.set_band_description(band, name)
+
+
+# Function that stores the three classification inputs (2mt, RH, sdc) of a risk map as one compressed 3 band GeoTIFF,
+# so the risk map can be recomputed later with another rule set without downloading anything
+# (kept in their own data type, so a recomputation with the same rules gives the same risk map)
+# the file is tiled, so it can be classified window by window with compute_risk_map_windowed
+@instrumented
+def write_risk_inputs(twomt, rh, sdc, output_file):
+    dtype = np.result_type(twomt.array, rh.array, sdc.array)
+    with rasterio.open(output_file, 'w',
+                       width=twomt.array.shape[1], height=twomt.array.shape[0],
+                       count=3, dtype=dtype, nodata=np.nan,
+                       crs=twomt.crs, transform=twomt.transform, **TILED_GTIFF) as dst:
+        dst.write(np.stack([twomt.array, rh.array, sdc.array]).astype(dtype))
+
+
+# Function that reads the classification inputs stored by write_risk_inputs, returns the 2mt, RH and sdc Rasters
+@instrumented
+def read_risk_inputs(input_file):
+    with rasterio.open(input_file) as src:
+        return tuple(Raster(src.read(band), src.transform, src.crs, src.nodata) for band in (1, 2, 3))
+
+
+# Function that calculates the risk map from the three input raster files and writes it as a GeoTIFF
+@instrumented
+def compute_risk_map(twomt_inputFile, rh_inputFile, sdc_inputFile, riskMap_outputFile, memory_budget=DEFAULT_MEMORY_BUDGET):
+    # Create a new COG for the output, the nodata value is 255
+    compute_risk_map_windowed([(twomt_inputFile, 1), (rh_inputFile, 1), (sdc_inputFile, 1)], riskMap_outputFile,
+                              memory_budget=memory_budget)
 
-        # fill an array with 9999 (which will also become the nodata value) for the outputfile
-        nodata_value = 9999
-        output_data = np.full_like(data1, nodata_value, dtype=np.int16)
-        
-        # Define the threshold conditions and output values
-        # Output_data file array of 9999s will be filled with these new values for pixels that meet the conditions
-        # pixels that do not meet any condition will continue to have a value of 9999 = nodatas
-        # Vigilence levels rank from pixel value=1 (highest risk) to =9(lowest risk)
-
-        # Condition 1
-        mask = (data1 >= 30) & (data2 <= 20) & (data3 >= 400)
-        output_data[mask] = 1
-        
-        # Condition 2
-        mask = (27 < data1) & (data1 < 30) & (data2 <= 20) & (data3 >= 400)
-        output_data[mask] = 2
-        
-        # Condition 3
-        mask = (data1 >= 30) & (data2 <= 20) & (150 < data3) & (data3 < 400)
-        output_data[mask] = 3
-        
-        # Condition 4
-        mask = (data1 >= 30) & (40 < data2) & (data2 <= 60) & (data3 >= 400)
-        output_data[mask] = 4
-        
-        # Condition 5
-        mask = (27 < data1) & (data1 < 30) & (20 < data2) & (data2 <= 40) & (150 < data3) & (data3 < 400)
-        output_data[mask] = 5
         
-        # Condition 6
-        mask = (data1 > 27) & (data2 < 60) & (data3 < 150)
-        output_data[mask] = 6
-        
-        # Condition 7
-        mask = (data1 > 27) & (40 < data2) & (data2 <= 60) & (150 < data3) & (data3 < 400)
-        output_data[mask] = 7
-        
-        # Condition 8
-        mask = (data2 > 60)
-        output_data[mask] = 8
-        
-        # Condition 9
-        mask = (data1 < 27)
-        output_data[mask] = 9
-        
-        # Create a new GeoTIFF file for the output
-        # set the nodata value to 9999
-        with rasterio.open(riskMap_outputFile, 'w', driver='GTiff', 
-                            width=src_2mt.width, height=src_2mt.height,
-                            nodata = 9999,
-                            count=1, dtype=rasterio.int16, 
-                            crs=src_2mt.crs, transform=src_2mt.transform) as dst:
-            
-            # Write the output data to the output raster
-            dst.write(output_data, 1)
-
-        
\ No newline at end of file
+
+
+# bytes per pixel the windowed risk classification needs: the three inputs and their converted float copies,
+# the outside mask, the class index and the output
+RISK_BYTES_PER_PIXEL = 64
+
+
+# Function that computes the risk map of one window: reads the window of the three inputs, masks the pixels outside of
+# the shapes and the nodata pixels (like clip_raster_to_shapefile), converts the units and classifies the window
+# defined at module level so it can run in a process pool
+@instrumented
+def risk_map_window(inputs, window, conversions, shapefile_filepath, mask_cache_dir, classifier, nodata_value):
+    outside = None
+    rasters = []
+    for (input_file, band), (scale, offset) in zip(inputs, conversions):
+        with rasterio.open(input_file) as src:
+            array = src.read(band, window=window)
+            transform = src.window_transform(window)
+            raster = Raster(array.astype(np.promote_types(array.dtype, np.float32)), transform, src.crs, src.nodata)
+
+        if shapefile_filepath is not None and outside is None:
+            outside = cached_shape_mask(shapefile_filepath, transform, array.shape, src.crs, crop=False,
+                                        cache_dir=mask_cache_dir, keep_in_memory=False)[1]
+        if raster.nodata is not None and not np.isnan(raster.nodata):
+            raster.array[array == raster.nodata] = np.nan
+        if outside is not None:
+            raster.array[outside] = np.nan
+
+        if scale != 1:
+            raster = multiply_array_by_scalar(raster, scale)
+        if offset != 0:
+            raster = subtract_scalar_from_array(raster, offset)
+        rasters.append(raster)
+
+    levels = compute_risk_array(*rasters, classifier).array
+    return np.where(levels == CLASSIFIER_NODATA, nodata_value, levels).astype(RISK_MAP_DTYPE)
+
+
+# Function that calculates the risk map from three inputs on the same grid window by window and writes it as a COG
+# inputs are (file, band) pairs of the 2mt, RH and sdc rasters, conversions the (scale, offset) that turn every input
+# into the units of the rules (value * scale - offset, e.g. (1, 273.15) for K to C). Pixels outside of the shapefile
+# are masked when one is given, with the masks of the windows kept in mask_cache_dir.
+# Only one window per worker is processed at a time, so the peak memory stays within memory_budget whatever the
+# resolution. With workers > 1 the windows are classified in a process pool (not from inside a celery worker,
+# its processes cannot start child processes), the budget is shared by the workers.
+# The uncompressed map is written to the workspace of the run when one is given (see workspace_fun).
+@instrumented
+def compute_risk_map_windowed(inputs, output_file, conversions=((1, 0), (1, 0), (1, 0)), shapefile_filepath=None,
+                              classifier=DIONE_CLASSIFIER, nodata_value=RISK_MAP_NODATA, memory_budget=DEFAULT_MEMORY_BUDGET, workers=1,
+                              mask_cache_dir=None, compress='deflate', workspace=None):
+    grids = []
+    for input_file, band in inputs:
+        with rasterio.open(input_file) as src:
+            grids.append((src.width, src.height, src.transform, src.crs))
+    if any(grid != grids[0] for grid in grids):
+        raise ValueError('the risk map inputs have to be on the same grid')
+    width, height, transform, crs = grids[0]
+
+    windows = block_windows(height, width, RISK_BYTES_PER_PIXEL, memory_budget // workers)
+    window_args = (conversions, shapefile_filepath, mask_cache_dir, classifier, nodata_value)
+
+    # the windows are written to a tiled GeoTIFF first, the COG driver can only copy a complete file
+    temporary_file = scratch_raster_path(output_file, workspace)
+    try:
+        with rasterio.open(temporary_file, 'w', width=width, height=height, count=1, dtype=RISK_MAP_DTYPE,
+                           nodata=nodata_value, crs=crs, transform=transform, **TILED_GTIFF) as dst:
+            if workers == 1:
+                for window in windows:
+                    dst.write(risk_map_window(inputs, window, *window_args), 1, window=window)
+            else:
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    # at most two windows per worker are submitted ahead of the one that is written next
+                    pending = deque()
+                    for window in windows:
+                        pending.append((window, executor.submit(risk_map_window, inputs, window, *window_args)))
+                        if len(pending) >= 2 * workers:
+                            done_window, future = pending.popleft()
+                            dst.write(future.result(), 1, window=done_window)
+                    while pending:
+                        done_window, future = pending.popleft()
+                        dst.write(future.result(), 1, window=done_window)
+
+        write_cog(temporary_file, output_file, compress)
+    finally:
+        if os.path.exists(temporary_file):
+            os.remove(temporary_file)
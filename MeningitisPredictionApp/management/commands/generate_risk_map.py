@@ -1,427 +1,523 @@
 from django.core.management.base import BaseCommand
-from ecmwf.opendata import Client
-import ecmwf.data as ecdata
-from eccodes import *
-import rasterio
-from rasterio.mask import mask
-import numpy as np
-from netCDF4 import Dataset
-import xarray as xr
-from netCDF4 import num2date
+from django.core.management import call_command
 import os
 from datetime import date
 from datetime import timedelta
-from django.contrib.gis.gdal import DataSource
+from concurrent.futures import ThreadPoolExecutor
 from raster.models import RasterLayer
 from django.conf import settings
+from MeningitisPredictionApp.models import RiskRuleSet, RiskMap, PipelineRun
 
-from .data_processing_fun import ccds_to_simple, transform_grib2_to_TIFF, create_mask_from_shapefile, multiply_raster_by_scalar, subtract_scalar_from_raster, resample_resolution, compute_risk_map
+from .stage_graph_fun import run_stage, evict_stage_dirs
+from .workspace_fun import run_workspace, workspace_path, evict_workspaces
+from .instrumentation_fun import start_run, finish_run, measure_stage, write_prometheus_file
+from .raster_ingest_fun import ingest_raster_layer, remove_orphaned_reprojected
+from .risk_archive_fun import append_risk_map
+from .data_acquisition_fun import fetch_geos_mean, fetch_geos_rolling_mean, evict_geos_cache, fetch_ecmwf_ensemble, ensemble_steps
+from .data_processing_fun import grib_window_ensemble_means, write_raster, dataarray_to_raster, clip_raster_to_shapefile, multiply_array_by_scalar, subtract_scalar_from_array, regrid, regrid_members, raster_grid, global_grid, clip_grid, compute_risk_map_windowed, compute_risk_array, get_risk_classifier, rules_from_json, RULE_VARIABLES, write_risk_inputs, rule_conditions, ensemble_statistics, ensemble_agreement, write_layers, shapefile_checksum
 
 
 
 class Command(BaseCommand):
     help = 'Fetch data, compute risk map, and store it in the database'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--dump-intermediates', action='store_true',
+                            help='Also write every intermediate raster as a GeoTIFF to the workspace of the run, which is then kept (for debugging)')
+        parser.add_argument('--force', action='store_true',
+                            help='Run every stage again, also the ones that already completed today')
+
+    # write an intermediate raster to the workspace of the run, only when --dump-intermediates is set
+    def dump(self, raster, filename):
+        if self.dump_intermediates:
+            write_raster(raster, workspace_path(self.workspace, "intermediates", filename))
+
+    # compute a risk map from its 3 band inputs file as a COG
+    def classify(self, inputs_file, output_file, classifier):
+        compute_risk_map_windowed([(inputs_file, 1), (inputs_file, 2), (inputs_file, 3)], output_file, classifier=classifier,
+                                  memory_budget=settings.RISK_MAP_MEMORY_BUDGET_MB * 1024**2, workers=settings.RISK_MAP_WORKERS,
+                                  compress=settings.RISK_MAP_COMPRESSION, workspace=self.workspace)
+
+    # store a risk map as the tiles of its RasterLayer (instead of the django-raster parse task), measured as a stage of
+    # the run with the ingest time, the number of tiles and how much the tile table grew
+    def ingest(self, raster_layer, tif_path, name):
+        with measure_stage('ingest_' + name) as record:
+            record.update(ingest_raster_layer(raster_layer, tif_path, min_zoom=settings.RISK_MAP_TILE_MIN_ZOOM, max_zoom=settings.RISK_MAP_TILE_MAX_ZOOM,
+                                              cache_dir=settings.REGRID_CACHE_DIR, batch_size=settings.RASTER_INGEST_BATCH_SIZE))
+            record['status'] = 'ran'
+        print('stored {} tiles of {} (zoom levels {}) in {:.2f} s'.format(record['tiles'], raster_layer.name, record['zoom_levels'], record['seconds']))
+        return record
+
+    # run a stage of the job, or read its output when it already ran for today's forecast with the same inputs
+    # (see stage_graph_fun.run_stage)
+    def stage(self, name, function, inputs=(), params=(), files=False):
+        return run_stage(self.stage_dir, name, function, inputs, [self.today] + list(params), files, self.force)
+
     def handle(self, *args, **kwargs):
-        
+        self.dump_intermediates = kwargs.get('dump_intermediates', False)
+        self.force = kwargs.get('force', False)
+
+        # the outputs of the stages are kept per forecast date, the folders of older dates are removed
+        self.today = date.today()
+        self.stage_dir = os.path.join(settings.RISK_MAP_STAGE_DIR, self.today.strftime("%Y%m%d"))
+        evict_stage_dirs(settings.RISK_MAP_STAGE_DIR, settings.RISK_MAP_STAGE_MAX_AGE_DAYS, self.today)
+        # scratch files of the run go to a workspace of its own, removed when the run ends (see workspace_fun)
+        evict_workspaces(settings.RISK_MAP_WORKSPACE_ROOT, settings.RISK_MAP_WORKSPACE_MAX_AGE_HOURS)
+
+        # every stage and data processing function of the run is measured, the summary of the run is stored in the
+        # database and written as Prometheus metrics, also when the run fails
+        start_run('generate_risk_map')
+        status = 'failed'
+        try:
+            with run_workspace(settings.RISK_MAP_WORKSPACE_ROOT, 'generate_risk_map', keep=self.dump_intermediates) as workspace:
+                self.workspace = workspace
+                # the six downloads only wait on the network, so they all run at the same time in a thread pool
+                # and each risk map is processed as soon as its own inputs have arrived
+                with ThreadPoolExecutor(max_workers=settings.RISK_MAP_FETCH_WORKERS) as executor:
+                    self.compute_risk_maps(executor)
+            status = 'success'
+        finally:
+            # a failure to store the summary must not replace the error of the run (celery retries on that one)
+            try:
+                self.store_run(finish_run(status))
+            except Exception as error:
+                self.stderr.write('storing the summary of the run failed: {!r}'.format(error))
+
+    # store the summary of a run in the database and write its metrics
+    def store_run(self, run):
+        PipelineRun.objects.create(name=run['name'], started=run['started'], finished=run['finished'], status=run['status'],
+                                   wallSeconds=run['wall_seconds'], cpuSeconds=run['cpu_seconds'], peakRssBytes=run['peak_rss_bytes'],
+                                   bytesRead=run['bytes_read'], bytesWritten=run['bytes_written'], networkBytes=run['network'],
+                                   stages=run['stages'], functions=run['functions'])
+        write_prometheus_file(run, settings.PIPELINE_METRICS_FILE)
+
+        print('run {} in {:.1f} s, peak memory {:.0f} MB, downloaded {:.1f} MB'.format(
+            run['status'], run['wall_seconds'], run['peak_rss_bytes'] / 10**6, sum(run['network'].values()) / 10**6))
+
+    # The job is a graph of stages, every stage output is memoized in the stage folder of the forecast date and keyed
+    # by the content hashes of its inputs, so a retry only runs the stages that failed and the ones downstream of them,
+    # and a second run on the same day does no work at all
+    #   fetch     GEOS-FP weekly means (averaged while they are streamed), ECMWF ensemble grib2 files
+    #   reduce    weekly means of the ECMWF ensemble members
+    #   convert   GEOS-FP means to rasters, ECMWF 2m temperature to celsius
+    #   clip      to the outlines of Africa
+    #   scale     to the units of the rules
+    #   regrid    onto the ECMWF grid
+    #   classify  risk maps of week 1 and of the forecast horizons (week 2, ...), ensemble statistics of the forecasts
+    #   publish   database, archive and zonal statistics
+    def compute_risk_maps(self, executor):
+
         dirname = os.getcwd()
+        geos_url = settings.GEOS_FP_OPENDAP_URL
+
+        # get today's date
+        today = self.today
+        # get date from 7 days ago
+        seven_days_in_past = today - timedelta(days=7)
+        # get yesterday's date
+        yesterday = today - timedelta(days = 1)
+        seven_days_from_now = today + timedelta(days = 6)
+        yest_year_month_day = yesterday.strftime("%Y%m%d")
+
         #********************************************************************************************************
-        # Forecast data of the past -                                                                           *
-        # used for the outbreak risk predictions for week 1                                                     *
+        # Start all downloads                                                                                   *
         #********************************************************************************************************
 
         # Fetching of NASA's GEOS-FP Assimilation Forecast data of the last 7 days of the variables: relative humidity, surface dust concentration, 2m air temperature
-        
+
         # Relative humidity
-        url_rh = 'https://opendap.nccs.nasa.gov/dods/GEOS-5/fp/0.25_deg/assim/tavg3_3d_asm_Nv'
+        url_rh = '{}/assim/tavg3_3d_asm_Nv'.format(geos_url)
         # Surface dust concentration
-        url_dusm = 'https://opendap.nccs.nasa.gov/dods/GEOS-5/fp/0.25_deg/assim/tavg3_2d_aer_Nx'
+        url_dusm = '{}/assim/tavg3_2d_aer_Nx'.format(geos_url)
         # 2m air temperature
-        url_2mt = 'https://opendap.nccs.nasa.gov/dods/GEOS-5/fp/0.25_deg/assim/inst3_2d_asm_Nx'
-        
-        # Access the data for the 3 variables through the OPeNDAP server
-        d_rh = xr.open_dataset(url_rh, engine='netcdf4')
-        d_dusm = xr.open_dataset(url_dusm, engine='netcdf4')
-        d_2mt = xr.open_dataset(url_2mt, engine='netcdf4')
-
-        print('accessed GEOS-FP past forecasts')
+        url_2mt = '{}/assim/inst3_2d_asm_Nx'.format(geos_url)
 
         # Prepare the time slices that describe the timeframe we are interested i.e.:
         # from today-7 to yesterday (= last week)
-        
-        # get today's date
-        today = date.today()
-        # get date from 7 days ago
-        seven_days_in_past = today - timedelta(days=7)
-        # get yesterday's date
-        yesterday = today - timedelta(days = 1)
-        
+
         # First time step of every day = 01:30 - last time step of every day = 22:30 for relative humidity and surface concentration dataset
         slice_yesterday = '{}T22:30:00.000000000'.format(yesterday)
         slice_7d_past = '{}T01:30:00.000000000'.format(seven_days_in_past)
         # the 2mt dataset has time steps starting at 00 everyday with 3h steps
         slice_7d_past_2mt = '{}T00:00:00.000000000'.format(seven_days_in_past)
 
-        # slice the dataset to the variable of interest('rh', 'dusmass', 't2m'), the geographic extend of africa and the temporal extend of the last 7 days
-        ds_rh = d_rh.rh.sel(lat=slice(-51, 38), lon=slice(-26,78), time=slice(slice_7d_past, slice_yesterday), lev=72)
-        ds_dusm = d_dusm.dusmass.sel(lat=slice(-51, 38), lon=slice(-26,78), time=slice(slice_7d_past, slice_yesterday))
-        ds_2mt = d_2mt.t2m.sel(lat=slice(-51, 38), lon=slice(-26,78), time=slice(slice_7d_past, slice_yesterday))
+        # Access the data for the 3 variables through the OPeNDAP server, sliced to the variable of interest('rh', 'dusmass', 't2m'),
+        # the geographic extend of africa and the temporal extend of the last 7 days, and compute their weekly mean values
+        # N.B. xarray serialises netCDF4 reads behind one lock, so the three OPeNDAP subsets share the network with each other,
+        # but overlap fully with the ECMWF downloads
+        # every request only asks the server for GEOS_FP_TIME_BLOCK timesteps of the africa bounding box
+        # timesteps are kept in a local cache, so only the day that is new since the last run has to be downloaded
+        # and the weekly means are updated as a rolling window
+        time_block = settings.GEOS_FP_TIME_BLOCK
+        cache_dir = settings.GEOS_FP_CACHE_DIR
+        rh_past_download = executor.submit(self.stage, 'fetch_rh_past',
+                                           lambda: fetch_geos_rolling_mean(url_rh, 'rh', slice_7d_past, slice_yesterday, cache_dir, lev=72, time_block=time_block),
+                                           params=[url_rh, slice_7d_past, slice_yesterday])
+        dusm_past_download = executor.submit(self.stage, 'fetch_dusm_past',
+                                             lambda: fetch_geos_rolling_mean(url_dusm, 'dusmass', slice_7d_past, slice_yesterday, cache_dir, time_block=time_block),
+                                             params=[url_dusm, slice_7d_past, slice_yesterday])
+        twomt_past_download = executor.submit(self.stage, 'fetch_2mt_past',
+                                              lambda: fetch_geos_rolling_mean(url_2mt, 't2m', slice_7d_past, slice_yesterday, cache_dir, time_block=time_block),
+                                              params=[url_2mt, slice_7d_past, slice_yesterday])
 
-        # compute the weekly mean values of all three variables
-        ds_rh_mean = ds_rh.mean(dim='time')
-        ds_dusm_mean = ds_dusm.mean(dim='time')
-        ds_2mt_mean = ds_2mt.mean(dim='time')
+        # Fetching of ECMWF Ensemble Forecast data (for 2m air temperature and relative humidity) for the next 7 days
 
-        print('computed mean values of GEOS-FP past forecasts')
+        # Data is fetched daily (after 7:55) for ref time stamp of 00 on that day for the next 7 days: 00 of the next day to 00 7 days from now
+        # with reference to 00z on today that means steps: 24 to 192
+        # Data is available 3 hourly for 00 to 144 and 6 hourly for 150 to 360
+        # steps needed are (24, 144, 3) and (150, 192, 6)
+        # further forecast horizons (ECMWF_FORECAST_HORIZONS, e.g. week 3 from steps 198 to 360) add their steps to the
+        # same downloads, every GRIB message is then added to the weekly means of the horizons it belongs to
+        horizons = settings.ECMWF_FORECAST_HORIZONS
+        steps = ensemble_steps(horizons)
+        windows = {product: (first_step, last_step) for product, first_step, last_step in horizons}
 
-        # save the mean forecast values of all three variables of the last week to a netcdf files
-        ds_rh_mean.to_netcdf(os.path.join(dirname,"IntermediateDataFiles","rh_assi_africa_past7days_mean.nc"), engine='netcdf4')
-        ds_dusm_mean.to_netcdf(os.path.join(dirname,"IntermediateDataFiles", "dusm_assi_africa_past7days_mean.nc"), engine='netcdf4')
-        ds_2mt_mean.to_netcdf(os.path.join(dirname,"IntermediateDataFiles", "2mt_assi_africa_past7days_mean.nc"), engine='netcdf4')
+        # Request Ensemble forecasts for the defined timesteps above
+        # Setting the type to pf (perturbed forecast), cf (control forecast) will download all 50 ensemble members as well as the control forecast. (total of 51 values per step)
+        # 2m air temperature: levtype = sfc = surface level or single level
+        # relative humidity "r": levtype = pl = pressure - 1000 hPa corresponds to surface level
+        # the grib2 files are the outputs of the fetch stages, a rerun on the same day finds them unchanged and downloads nothing
+        # they are downloaded to the workspace of the run and kept in the stage folder of the forecast date once complete
+        twomt_fc_file = os.path.join(self.stage_dir, "ccsds2mt_ensemble_all_steps.grib2")
+        rh_fc_file = os.path.join(self.stage_dir, "ccsds_r_ensemble_all_steps.grib2")
+        twomt_fc_download = executor.submit(self.stage, 'fetch_2t_fc',
+                                            lambda: fetch_ecmwf_ensemble('2t', steps, "sfc", twomt_fc_file, source=settings.ECMWF_OPENDATA_SOURCE,
+                                                                         workspace=self.workspace),
+                                            params=[steps, settings.ECMWF_OPENDATA_SOURCE], files=True)
+        rh_fc_download = executor.submit(self.stage, 'fetch_r_fc',
+                                         lambda: fetch_ecmwf_ensemble('r', steps, "pl", rh_fc_file, levelist="1000", source=settings.ECMWF_OPENDATA_SOURCE,
+                                                                      workspace=self.workspace),
+                                         params=[steps, settings.ECMWF_OPENDATA_SOURCE], files=True)
+
+        # Fetching of NASA GEOS-FP Ensemble Forecast (of surface dust concentration) for the next 7 days
+        # construct the url for the opendap server to access the forecast published yesterday at 00 (for the next 10 days)
+        url = '{}/fcast/tavg3_2d_aer_Nx/tavg3_2d_aer_Nx.{}_00'.format(geos_url, yest_year_month_day)
 
-        print('stored means of past forecasts as .nc files')
+        # prepare the slices of the timeframe we are interested in
+        slice_today = '{}T01:30:00.000000000'.format(today)
+        slice_7d_ahead = '{}T22:30:00.000000000'.format(seven_days_from_now)
 
-        # convert the 3 nc files to tif files:
+        # the surface dust concentration ('dusmass') over the geographic extend of africa averaged over the next 7 days
+        sdc_fc_download = executor.submit(self.stage, 'fetch_sdc_fc',
+                                          lambda: fetch_geos_mean(url, 'dusmass', slice_today, slice_7d_ahead, time_block=time_block),
+                                          params=[url, slice_today, slice_7d_ahead])
 
-        # Construct the full path to the .nc file
-        nc_file_path_assi_rh = os.path.join(dirname,"IntermediateDataFiles","rh_assi_africa_past7days_mean.nc")
+        # shared steps of the stages below
+        input_shapefile = os.path.join(dirname,"AfricaOutlines", "Africa_Boundaries.shp")
+        mask_cache_dir = settings.MASK_CACHE_DIR
+        regrid_cache_dir = settings.REGRID_CACHE_DIR
+        # the outlines are part of the key of the clip stages, a new version of the shapefile clips again
+        outlines = shapefile_checksum(input_shapefile)
 
-        # Prepend the "netcdf:" prefix to the path
-        netcdf_path_assi_rh = f"netcdf:{nc_file_path_assi_rh}"
+        # the risk maps are computed on the ECMWF forecast grid (global, 0.25 deg) clipped to africa
+        # the grid is known up front, so week 1 doesn't have to wait for the ECMWF downloads
+        target_grid = clip_grid(input_shapefile, global_grid(settings.RISK_MAP_GRID_RESOLUTION), cache_dir=mask_cache_dir)
 
-        # turn the .nc file into a .tif file
-        reader = rasterio.open(netcdf_path_assi_rh)
-        prof = reader.profile
-        prof.update(driver='GTiff', crs="EPSG:4326",)
-        array = reader.read(1)
-        with rasterio.open(os.path.join(dirname,"IntermediateDataFiles","rh_assi_africa_past7days_mean.tif"), "w", **prof) as dst:
-            dst.write(array,1)
+        # the outlines are rasterized once per grid and kept in the mask cache, so all variables share one mask
+        def clip(raster):
+            return clip_raster_to_shapefile(input_shapefile, raster, cache_dir=mask_cache_dir)
 
-        nc_file_path_assi_dusm = os.path.join(dirname,"IntermediateDataFiles", "dusm_assi_africa_past7days_mean.nc")
-        netcdf_path_assi_dusm = f"netcdf:{nc_file_path_assi_dusm}"
+        # the source -> target pixel mapping is built once and reused for every variable and every day
+        def regrid_to_target(raster):
+            return regrid(raster, target_grid, cache_dir=regrid_cache_dir)
 
-        reader = rasterio.open(netcdf_path_assi_dusm) 
-        prof = reader.profile
-        prof.update(driver='GTiff', crs="EPSG:4326",)
-        array = reader.read(1)
-        with rasterio.open(os.path.join(dirname,"IntermediateDataFiles","dusm_assi_africa_past7days_mean.tif"), "w", **prof) as dst:
-            dst.write(array,1)      
+        #********************************************************************************************************
+        # Forecast data of the past -                                                                           *
+        # used for the outbreak risk predictions for week 1                                                     *
+        #********************************************************************************************************
 
-        nc_file_path_assi_2mt = os.path.join(dirname, "IntermediateDataFiles", "2mt_assi_africa_past7days_mean.nc")
-        netcdf_path_assi_2mt = netcdf_path_assi_dusm = f"netcdf:{nc_file_path_assi_2mt}"
+        # wait for the weekly mean values of all three variables
+        rh_past = rh_past_download.result()
+        dusm_past = dusm_past_download.result()
+        twomt_past = twomt_past_download.result()
 
-        reader = rasterio.open(netcdf_path_assi_2mt) 
-        prof = reader.profile
-        prof.update(driver='GTiff', crs="EPSG:4326",)
-        array = reader.read(1)
-        with rasterio.open(os.path.join(dirname, "IntermediateDataFiles","2mt_assi_africa_past7days_mean.tif"), "w", **prof) as dst:
-            dst.write(array,1)  
-        
-        print('turned past forecasts .nc files into .tif files')
+        print('computed mean values of GEOS-FP past forecasts')
 
-# turn .nc to .tif conversion into a function?
-# sometimes NASA's GEOS OPeNDAP server is down. write an if statement to not proceed w the script if that is the case
+        evict_geos_cache(cache_dir, settings.GEOS_FP_CACHE_MAX_AGE_DAYS, settings.GEOS_FP_CACHE_MAX_BYTES)
 
+        # turn the weekly means into in-memory rasters (array + georeferencing)
+        # intermediate results are only written to the workspace of the run when --dump-intermediates is set
+        rh_past = self.stage('convert_rh_past', dataarray_to_raster, [rh_past])
+        dusm_past = self.stage('convert_dusm_past', dataarray_to_raster, [dusm_past])
+        twomt_past = self.stage('convert_2mt_past', dataarray_to_raster, [twomt_past])
+        self.dump(rh_past.value, "rh_assi_africa_past7days_mean.tif")
+        self.dump(dusm_past.value, "dusm_assi_africa_past7days_mean.tif")
+        self.dump(twomt_past.value, "2mt_assi_africa_past7days_mean.tif")
 
-        # Clip the weekly mean forecast of the past week of the 3 variables to the outlines of Africa
-        input_raster_rh = os.path.join(dirname,"IntermediateDataFiles", "rh_assi_africa_past7days_mean.tif")
-        output_file_rh = os.path.join(dirname,"IntermediateDataFiles", "rh_assi_africa_past7days_mean_mask.tif")
-        input_shapefile = os.path.join(dirname,"AfricaOutlines", "Africa_Boundaries.shp")
-        create_mask_from_shapefile(input_shapefile, input_raster_rh, output_file_rh)
+        print('turned past forecasts into rasters')
 
-        input_raster_dusm = os.path.join(dirname,"IntermediateDataFiles", "dusm_assi_africa_past7days_mean.tif")
-        output_file_dusm = os.path.join(dirname,"IntermediateDataFiles", "dusm_assi_africa_past7days_mean_mask.tif")
-        create_mask_from_shapefile(input_shapefile, input_raster_dusm, output_file_dusm)
+        # sometimes NASA's GEOS OPeNDAP server is down, the task is then retried and only the stages that did not
+        # complete run again
 
-        input_raster_2mt = os.path.join(dirname,"IntermediateDataFiles", "2mt_assi_africa_past7days_mean.tif")
-        output_file_2mt = os.path.join(dirname,"IntermediateDataFiles", "2mt_assi_africa_past7days_mean_mask.tif")
-        create_mask_from_shapefile(input_shapefile, input_raster_2mt, output_file_2mt)
+        # Clip the weekly mean forecast of the past week of the 3 variables to the outlines of Africa
+        rh_past = self.stage('clip_rh_past', clip, [rh_past], [outlines])
+        dusm_past = self.stage('clip_dusm_past', clip, [dusm_past], [outlines])
+        twomt_past = self.stage('clip_2mt_past', clip, [twomt_past], [outlines])
+        self.dump(rh_past.value, "rh_assi_africa_past7days_mean_mask.tif")
+        self.dump(dusm_past.value, "dusm_assi_africa_past7days_mean_mask.tif")
+        self.dump(twomt_past.value, "2mt_assi_africa_past7days_mean_mask.tif")
 
-        print('clipped past forecast tif files to africa')
+        print('clipped past forecast rasters to africa')
 
         # multiply the relative humidity (rh) raster (nominal 0-1) by 100 to obtain unit of percentages
-        input_raster_rh = os.path.join(dirname,"IntermediateDataFiles", "rh_assi_africa_past7days_mean_mask.tif")
-        output_raster_rh = os.path.join(dirname,"IntermediateDataFiles", "rh_assi_africa_past7days_mean_mask_percent.tif")
-        scalar_rh = 100
-        multiply_raster_by_scalar(input_raster_rh, output_raster_rh, scalar_rh)
+        rh_past = self.stage('scale_rh_past', lambda raster: multiply_array_by_scalar(raster, 100), [rh_past], [100])
+        self.dump(rh_past.value, "rh_assi_africa_past7days_mean_mask_percent.tif")
 
         # multiply the surface dust concentration (dusmass/sdc) raster (unit kg m^-3) by 1x10^9 to obtain unit of ug m^-3
-        input_raster_dusm = os.path.join(dirname,"IntermediateDataFiles", "dusm_assi_africa_past7days_mean_mask.tif")
-        output_raster_dusm = os.path.join(dirname,"IntermediateDataFiles", "dusm_assi_africa_past7days_mean_mask_ugm3.tif")
-        scalar_sdc = 10**9
-        multiply_raster_by_scalar(input_raster_dusm, output_raster_dusm, scalar_sdc)
+        dusm_past = self.stage('scale_dusm_past', lambda raster: multiply_array_by_scalar(raster, 10**9), [dusm_past], [10**9])
+        self.dump(dusm_past.value, "dusm_assi_africa_past7days_mean_mask_ugm3.tif")
 
         # substract 273.15 from 2mt raster (K) to obtain unit of celsius (C)
-        input_raster_2mt = os.path.join(dirname,"IntermediateDataFiles", "2mt_assi_africa_past7days_mean_mask.tif")
-        output_raster_2mt = os.path.join(dirname,"IntermediateDataFiles", "2mt_assi_africa_past7days_mean_mask_celsius.tif")
-        scalar_2mt = 273.15
-        subtract_scalar_from_raster(input_raster_2mt, output_raster_2mt, scalar_2mt)
+        twomt_past = self.stage('scale_2mt_past', lambda raster: subtract_scalar_from_array(raster, 273.15), [twomt_past], [273.15])
+        self.dump(twomt_past.value, "2mt_assi_africa_past7days_mean_mask_celsius.tif")
+
+        # resample the surface dust concentration, 2mt, rh (pixel size: 0.3125,-0.25.) (GEOS-FP assimilation past fc)
+        # to match the 2mt and RH raster (pixel size: 0.25,-0.25) (ECMWF forecast)
+        dusm_past = self.stage('regrid_dusm_past', regrid_to_target, [dusm_past], [target_grid])
+        rh_past = self.stage('regrid_rh_past', regrid_to_target, [rh_past], [target_grid])
+        twomt_past = self.stage('regrid_2mt_past', regrid_to_target, [twomt_past], [target_grid])
+        self.dump(dusm_past.value, "dusm_assi_africa_past7days_mean_mask_ugm3_resampled.tif")
+        self.dump(rh_past.value, "rh_assi_africa_past7days_mean_mask_percent_resampled.tif")
+        self.dump(twomt_past.value, "2mt_assi_africa_past7days_mean_mask_celsius_resampled.tif")
+
+        print('resampled the 3 GEOS-FP past forecasts to the resolution of ECMWF')
 
         #------------------------------------------------------------------------
-        
+
         #********************************************************************************************************
         # Forecast data for the future -                                                                        *
         # used for the outbreak risk predictions for week 2                                                     *
         #********************************************************************************************************
 
-        # Fetching of ECMWF Ensemble Forecast data (for 2m air temperature and relative humidity) for the next 7 days
-        
-        # Data is fetched daily (after 7:55) for ref time stamp of 00 on that day for the next 7 days: 00 of the next day to 00 7 days from now
-        # with reference to 00z on today that means steps: 24 to 192
-        # Data is available 3 hourly for 00 to 144 and 6 hourly for 150 to 360
-        # steps needed are (24, 144, 3) and (150, 192, 6)
-        steps= [i for i in range (24, 144, 3)]
-        steps_set2 = [i for i in range (144, 198, 6)]
-        steps.extend(steps_set2)
-        
-        # Download 2m air temperature variable
-        # Request Ensemble forecasts for the defined timesteps above
-        # Setting the type to pf (perturbed forecast), cf (control forecast) will download all 50 ensemble members as well as the control forecast. (total of 51 values per step)
-        # levtype = sfc = surface level or single level
-        client = Client("ecmwf", beta=True)
-        client.retrieve(
-            date= 0,
-            time= 0,
-            step= steps,
-            stream="enfo", 
-            type=['cf', 'pf'],
-            levtype="sfc",
-            param='2t',
-            target= os.path.join(dirname,"IntermediateDataFiles", "ccsds2mt_ensemble_all_steps.grib2")  
-        )
-
-        print('accessed and stored ECMWF 2t forecast')
-
-        data_2mt = ecdata.read(os.path.join(dirname,"IntermediateDataFiles", "ccsds2mt_ensemble_all_steps.grib2"))  #"ccsds2mt_ensemble_all_steps.grib2")
+        # the reduce stages return the weekly means of the members, the weekly mean and the member numbers of every
+        # forecast horizon, by horizon
+        # wait for the ECMWF 2m air temperature download
+        twomt_fc = twomt_fc_download.result()
 
         # mean of 2mt for 1 week is calculated from all ensemble members for all time steps for all days
         # end result = 1 mean value for 1 week
-        t2m_mean = ecdata.mean(data_2mt)
-        t2m_mean.write(os.path.join(dirname,"IntermediateDataFiles", "ccds_2mt_ensemble_mean.grib"))  #'ccds_2mt_ensemble_mean.grib'
-        ccds_to_simple(os.path.join(dirname,"IntermediateDataFiles", "ccds_2mt_ensemble_mean.grib"), os.path.join("IntermediateDataFiles", "simple_2mt_ensemble_mean.grib"))                         
-
-        print('calculated and stored ECMWF 2t mean forecast as grib file')
-
-        # Retrieve data for all the defined steps for relative humidity "r"
-        # levtype = pl = pressure - 1000 hPa corresponds to surface level
-        client = Client("ecmwf", beta=True)
-        client.retrieve(
-            date= 0,
-            time= 0,
-            step= steps,
-            stream="enfo", 
-            type=['cf', 'pf'],
-            levtype="pl",
-            levelist = "1000",
-            param='r',
-            target= os.path.join(dirname,"IntermediateDataFiles", "ccsds_r_ensemble_all_steps.grib2") 
-        )
-
-        print('accessed and stored ECMWF r forecast')
-
-        data_r = ecdata.read(os.path.join(dirname,"IntermediateDataFiles", "ccsds_r_ensemble_all_steps.grib2"))
-        # calculate the mean value for the whole week
-        r_mean = ecdata.mean(data_r)
-        r_mean.write(os.path.join(dirname,"IntermediateDataFiles", "ccds_r_ensemble_mean.grib"))  #'ccds_r_ensemble_mean.grib')
-
-        ccds_to_simple(os.path.join(dirname,"IntermediateDataFiles", "ccds_r_ensemble_mean.grib"), os.path.join(dirname,"IntermediateDataFiles", "simple_r_ensemble_mean.grib")) 
-
-        print('calculated and stored ECMWF r mean forecast as grib file')
-        # Save both variable weekly mean forecasts as GeoTIFF files
-        transform_grib2_to_TIFF (os.path.join(dirname,"IntermediateDataFiles", "simple_2mt_ensemble_mean.grib"), os.path.join(dirname,"IntermediateDataFiles", "2mt_fc_weekly_mean.tif"))
-        transform_grib2_to_TIFF (os.path.join(dirname,"IntermediateDataFiles", "simple_r_ensemble_mean.grib"), os.path.join(dirname,"IntermediateDataFiles", "RH_fc_weekly_mean.tif"))
-
-        # Clip both tif files to the outlines of Africa
-        input_raster_2mt = os.path.join(dirname,"IntermediateDataFiles", "2mt_fc_weekly_mean.tif")
-        input_shapefile = os.path.join(dirname,"AfricaOutlines", "Africa_Boundaries.shp")
-        output_file_2mt = os.path.join(dirname,"IntermediateDataFiles", "2mt_fc_weekly_mean_mask.tif")
-        create_mask_from_shapefile(input_shapefile, input_raster_2mt, output_file_2mt)
-
-        input_raster_RH = os.path.join(dirname,"IntermediateDataFiles", "RH_fc_weekly_mean.tif")
-        output_file_RH = os.path.join(dirname,"IntermediateDataFiles", "RH_fc_weekly_mean_mask.tif")
-        create_mask_from_shapefile(input_shapefile, input_raster_RH, output_file_RH)
-       
-        print('r and 2t mean forecasts turned into tif files and clipped to africa')
-        # -------------
-        # Fetching of NASA GEOS-FP Ensemble Forecast (of surface dust concentration) for the next 7 days 
+        # the GRIB messages are decoded one by one and added to the mean, straight into an in-memory raster
+        # the weekly mean of every member (over africa) is kept as well for the ensemble statistics
+        twomt_fc = self.stage('reduce_2t_fc', lambda grib_file: grib_window_ensemble_means(grib_file, windows, target_grid), [twomt_fc], [target_grid, horizons])
 
-        # get today's date
-        today = date.today()
-        # get yesterday's date
-        yesterday = today - timedelta(days = 1)
-        tomorrow = today + timedelta(days = 1)
-        seven_days_from_now = today + timedelta(days = 6)
-        yest_year_month_day = yesterday.strftime("%Y%m%d")
+        # substract 273.15 from the 2mt raster (K) to obtain unit of celsius (C)
+        twomt_fc = self.stage('convert_2t_fc',
+                              lambda horizon_means: {product: (subtract_scalar_from_array(means[0], 273.15), subtract_scalar_from_array(means[1], 273.15), means[2])
+                                                     for product, means in horizon_means.items()},
+                              [twomt_fc], [273.15])
+        for product, means in twomt_fc.value.items():
+            self.dump(means[1], "2mt_fc_{}_mean.tif".format(product))
 
-        # construct the url for the opendap server to access the forecast published yesterday at 00 (for the next 10 days)
-        url = 'https://opendap.nccs.nasa.gov/dods/GEOS-5/fp/0.25_deg/fcast/tavg3_2d_aer_Nx/tavg3_2d_aer_Nx.{}_00'.format(yest_year_month_day)
-        
-        # access the dataset from the opendap server
-        d = xr.open_dataset(url, engine='netcdf4')
-        print('accessed GEOS-FP sdc forecast data')
+        print('calculated ECMWF 2t mean forecast')
 
-        # prepare the slices of the timeframe we are interested in
-        slice_today = '{}T01:30:00.000000000'.format(today)
-        slice_7d_ahead = '{}T22:30:00.000000000'.format(seven_days_from_now)
+        # wait for the ECMWF relative humidity download
+        rh_fc = rh_fc_download.result()
 
-        # slice the dataset to the variable surface dust concentration ('dusmass'), the geographic extend of africa and the temporal extend of the next 7 days
-        ds = d.dusmass.sel(lat=slice(-51, 38), lon=slice(-26,78), time=slice(slice_today, slice_7d_ahead))
+        # calculate the mean value for the whole week
+        rh_fc = self.stage('reduce_r_fc', lambda grib_file: grib_window_ensemble_means(grib_file, windows, target_grid), [rh_fc], [target_grid, horizons])
+        for product, means in rh_fc.value.items():
+            self.dump(means[1], "RH_fc_{}_mean.tif".format(product))
+
+        print('calculated ECMWF r mean forecast')
+
+        # Clip both weekly means to the outlines of Africa
+        def clip_means(horizon_means):
+            return {product: (means[0], clip(means[1]), means[2]) for product, means in horizon_means.items()}
+
+        # safeguard in case ECMWF ever publishes on another grid
+        def regrid_means(horizon_means):
+            return {product: means if raster_grid(means[1]) == target_grid else
+                    (regrid_members(means[0], target_grid, cache_dir=regrid_cache_dir), regrid_to_target(means[1]), means[2])
+                    for product, means in horizon_means.items()}
+
+        twomt_fc = self.stage('clip_2t_fc', clip_means, [twomt_fc], [outlines])
+        rh_fc = self.stage('clip_r_fc', clip_means, [rh_fc], [outlines])
+        twomt_fc = self.stage('regrid_2t_fc', regrid_means, [twomt_fc], [target_grid])
+        rh_fc = self.stage('regrid_r_fc', regrid_means, [rh_fc], [target_grid])
+        for product in windows:
+            self.dump(twomt_fc.value[product][1], "2mt_fc_{}_mean_mask.tif".format(product))
+            self.dump(rh_fc.value[product][1], "RH_fc_{}_mean_mask.tif".format(product))
+
+        print('r and 2t mean forecasts clipped to africa')
+        # -------------
+        # NASA GEOS-FP Ensemble Forecast (of surface dust concentration) for the next 7 days
 
-        # calculate the mean value of the surface dust concentration for the whole 7 days ahead
-        ds_mean = ds.mean(dim='time')
+        # wait for the mean value of the surface dust concentration for the whole 7 days ahead
+        sdc_fc = sdc_fc_download.result()
         print('calculated GEOS-FP sdc forecast mean')
-        # save the mean sdc of the next week to a netcdf file
-        ds_mean.to_netcdf(os.path.join(dirname,"IntermediateDataFiles","xarray_subset_fp_africa_7days_mean.nc"), engine='netcdf4')
-        print('stored GEOS-FP sdc mean as nc file')
-
-        # Construct the full path to the .nc file
-        nc_file_path_fp_sdc = os.path.join(dirname,"IntermediateDataFiles", "xarray_subset_fp_africa_7days_mean.nc")
 
-        # Prepend the "netcdf:" prefix to the path
-        netcdf_path_fp_sdc = f"netcdf:{nc_file_path_fp_sdc}"
-
-        # turn the .nc file into a .tif file
-        reader = rasterio.open(netcdf_path_fp_sdc)
-        prof = reader.profile
-        prof.update(driver='GTiff', crs="EPSG:4326")
-        array = reader.read(1)
-        with rasterio.open(os.path.join(dirname,"IntermediateDataFiles","xarray_subset_fp_africa_7days_mean.tif"), "w", **prof) as dst:
-            dst.write(array,1)
+        # turn the mean sdc of the next week into an in-memory raster
+        sdc_fc = self.stage('convert_sdc_fc', dataarray_to_raster, [sdc_fc])
+        self.dump(sdc_fc.value, "xarray_subset_fp_africa_7days_mean.tif")
 
         # Clip the weekly mean forecast of surface dust concentration to the outlines of Africa
-        input_raster = os.path.join(dirname,"IntermediateDataFiles","xarray_subset_fp_africa_7days_mean.tif")
-        input_shapefile = os.path.join(dirname,"AfricaOutlines","Africa_Boundaries.shp")
-        output_file_name = os.path.join(dirname,"IntermediateDataFiles","xarray_subset_fp_africa_7days_mean_mask.tif")
-
-        create_mask_from_shapefile(input_shapefile, input_raster, output_file_name)
+        sdc_fc = self.stage('clip_sdc_fc', clip, [sdc_fc], [outlines])
+        self.dump(sdc_fc.value, "xarray_subset_fp_africa_7days_mean_mask.tif")
 
-        print('turned GEOS-FP sdc forecast mean nc file into tif and clipped to africa')
+        print('turned GEOS-FP sdc forecast mean into a raster and clipped to africa')
 
         # original data unit of the raster is kg/m^3 - we turn the data into unit values of ug/m^3
-        input_raster = os.path.join(dirname,"IntermediateDataFiles","xarray_subset_fp_africa_7days_mean_mask.tif")
-        output_raster_filename = os.path.join(dirname,"IntermediateDataFiles", "sdc_fc_7days_mean_mask_ug3.tif")
-        scalar = 10**9
-# uncomment the inputraster location path in the functon, since the input we will give will probably be a path instead of file
-# name bc otherwise we design our system to just store files in one folder with our script instead of neatly storing it
-# in a data folder
-        multiply_raster_by_scalar(input_raster, output_raster_filename, scalar)
-
-# N.B. check if it will be a proplem that we reuse input names e.g. input_raster for different functions?
-# do we have to flush the disk or somehting?
+        sdc_fc = self.stage('scale_sdc_fc', lambda raster: multiply_array_by_scalar(raster, 10**9), [sdc_fc], [10**9])
+        self.dump(sdc_fc.value, "sdc_fc_7days_mean_mask_ug3.tif")
 
         #----------------------------------------------------
-        
+
         #*************************************************************************************************************************************************************************
         # Meningitis outbreak risk prediction calculation                                                                                                                        *
         # Risk map computation for week 1 is based on NASA's GEOS-FP assimilation past forecasts of the past week (week 0) (2m temp, relative humidity, sdc)                     *
         # Risk map computation for week 2 is based on the ECMWF ensemble forecast for week 1 (of 2m temp and relative humidity (ECMWF)) and dust surface concentration (GEOS-FP) *
+        # Risk map computation for week 3 (when configured) is based on the ECMWF ensemble forecast for week 2 and the same dust surface concentration                             *
         #*************************************************************************************************************************************************************************
-        """    
-        print('Get current working directory : ', os.getcwd())
-        print('example path:', os.path.join("IntermediateDataFiles", "sdc_fc_7days_mean_mask_ug3.tif"))
-        dirname = os.getcwd()
-        filename = os.path.join(dirname, 'rasters', 'riskmap.tif')
-        print(filename)
 
-        """   
-        
-        # dates for the meningitis risk fc for week 1 
+        # dates for the meningitis risk fc for week 1
         six_d_from_now = today + timedelta(days=6)
 
         today_ymd = today.strftime("%Y%m%d")
         six_d_from_now_ymd = six_d_from_now.strftime("%Y%m%d")
 
-        # dates for the meningitis risk fc of week 2: today+7 - today+14
-        seven_d_from_now = today + timedelta(days = 7)
-        fourteen_d_from_now = today + timedelta(days = 13)
-
-        seven_d_from_now_ymd = seven_d_from_now.strftime("%Y%m%d")
-        fourteen_d_from_now_ymd = fourteen_d_from_now.strftime("%Y%m%d")
-        
         # resample the surface dust concentration (pixel size: 0.3125,-0.25.) (GEOS-FP forecast) to match the 2mt and rh raster (pixel size: 0.25,-0.25) (ECMWF forecast)
-        inputfile_sdc_fc = os.path.join(dirname,"IntermediateDataFiles", "sdc_fc_7days_mean_mask_ug3.tif")
-        outputfile_sdc_fc = os.path.join(dirname,"IntermediateDataFiles", "dust_fc_weekly_mean_mask_ug3_resampled.tif")
-        resample_resolution(inputfile_sdc_fc, outputfile_sdc_fc)
-        
-        # resample the surface dust concentration, 2mt, rh (pixel size: 0.3125,-0.25.) (GEOS-FP assimilation past fc) 
-        # to match the 2mt and RH raster (pixel size: 0.25,-0.25) (ECMWF forecast)
-        inputfile_sdc_past = os.path.join(dirname,"IntermediateDataFiles", "dusm_assi_africa_past7days_mean_mask_ugm3.tif")
-        outputfile_sdc_past = os.path.join(dirname,"IntermediateDataFiles", "dusm_assi_africa_past7days_mean_mask_ugm3_resampled.tif")
-        resample_resolution(inputfile_sdc_past, outputfile_sdc_past)
-
-        inputfile_rh_past = os.path.join(dirname,"IntermediateDataFiles", "rh_assi_africa_past7days_mean_mask_percent.tif")
-        outputfile_rh_past = os.path.join(dirname,"IntermediateDataFiles", "rh_assi_africa_past7days_mean_mask_percent_resampled.tif")
-        resample_resolution(inputfile_rh_past, outputfile_rh_past)
-
-        inputfile_2mt_past = os.path.join(dirname,"IntermediateDataFiles", "2mt_assi_africa_past7days_mean_mask_celsius.tif")
-        outputfile_2mt_past = os.path.join(dirname,"IntermediateDataFiles", "2mt_assi_africa_past7days_mean_mask_celsius_resampled.tif")
-        resample_resolution(inputfile_2mt_past, outputfile_2mt_past)
+        sdc_fc = self.stage('regrid_sdc_fc', regrid_to_target, [sdc_fc], [target_grid])
+        self.dump(sdc_fc.value, "dust_fc_weekly_mean_mask_ug3_resampled.tif")
 
-        print('resampled all 4 GEOS-FP files to the resolution of ECMWF')
+        print('resampled the GEOS-FP sdc forecast to the resolution of ECMWF')
 
         today_dmy = today.strftime("%d/%m/%Y")
         six_d_from_now_dmy = six_d_from_now.strftime("%d/%m/%Y")
-        seven_d_from_now_dmy = seven_d_from_now.strftime("%d/%m/%Y")
-        fourteen_d_from_now_dmy = fourteen_d_from_now.strftime("%d/%m/%Y")
-
-        
-        
-        # compute Risk Map for week 1
-        input_2mt_past = os.path.join(dirname,"IntermediateDataFiles", "2mt_assi_africa_past7days_mean_mask_celsius_resampled.tif")
-        input_rh_past = os.path.join(dirname,"IntermediateDataFiles", "rh_assi_africa_past7days_mean_mask_percent_resampled.tif")
-        input_sdc_past = os.path.join(dirname,"IntermediateDataFiles", "dusm_assi_africa_past7days_mean_mask_ugm3_resampled.tif")
-        RiskMap_week1_file_name = os.path.join(dirname, "rasters", "Risk_map_week1_{}-{}.tif".format(today_ymd, six_d_from_now_ymd))
 
-        compute_risk_map(input_2mt_past, input_rh_past, input_sdc_past, RiskMap_week1_file_name)
 
-        print('computed risk map for week 1')
-       
-        # compute Risk Map for week 2
-        input_2mt_fc = os.path.join(dirname,"IntermediateDataFiles", "2mt_fc_weekly_mean_mask.tif")
-        input_rh_fc = os.path.join(dirname,"IntermediateDataFiles", "RH_fc_weekly_mean_mask.tif")
-        input_sdc_fc = os.path.join(dirname,"IntermediateDataFiles", "dust_fc_weekly_mean_mask_ug3_resampled.tif")
-        RiskMap_week2_file_name = os.path.join(dirname, "rasters", "Risk_map_week2_{}-{}.tif".format(seven_d_from_now_ymd, fourteen_d_from_now_ymd))
 
-        compute_risk_map(input_2mt_fc, input_rh_fc, input_sdc_fc, RiskMap_week2_file_name)
+        # the vigilance levels come from the active rule set, which is compiled once per version
+        # the rules are part of the key of the classify and publish stages, a new rule set classifies again
+        rule_set = RiskRuleSet.active()
+        classifier = get_risk_classifier(rule_set.version, rule_set.rules)
+        rule_set_key = [rule_set.version, rule_set.rules]
+        os.makedirs(settings.RISK_INPUTS_DIR, exist_ok=True)
 
-        print('computed risk map for week 2')
-        
-        # Load the .tif file into the database
-        # ds = DataSource(os.path.join("RiskMapFiles", "Risk_map_week1_{}-{}.tif".format(today_ymd, six_d_from_now_ymd)))
-
-        # layer = ds[0]
-
-        # Clear existing data (optional)
-        # RasterLayer.objects.all().delete()
-
-        # Save the new data
-        # for feat in layer:
-        #     raster = feat.geom.geos
-        #     RasterLayer.objects.create(rasterfile=geom)
-
-        #self.stdout.write(self.style.SUCCESS('Successfully generated and stored the risk map'))
-        
-
-        tif_path_week1 = os.path.join(dirname,"rasters", "Risk_map_week1_{}-{}.tif".format(today_ymd, six_d_from_now_ymd))
-
-        # Save the raster file to the database
-        raster_layer, created = RasterLayer.objects.get_or_create(name="{} - {}".format(today_dmy, six_d_from_now_dmy), datatype='ca') #datatype= 'ca'
-        raster_layer.rasterfile.name = os.path.relpath(tif_path_week1, settings.MEDIA_ROOT)
-        raster_layer.save()
-
-        print ('stored risk map week 1 to db')
-        
-        tif_path_week2 = os.path.join(dirname,"rasters", "Risk_map_week2_{}-{}.tif".format(seven_d_from_now_ymd, fourteen_d_from_now_ymd))
-
-        # Save the raster file to the database
-        raster_layer, created = RasterLayer.objects.get_or_create(name="{} - {}".format(seven_d_from_now_dmy, fourteen_d_from_now_dmy), datatype= 'ca') #datatype= 'ca'
-        raster_layer.rasterfile.name = os.path.relpath(tif_path_week2, settings.MEDIA_ROOT)
-        raster_layer.save()
-
-        print ('stored risk map week 2 to db')
-        
-        self.stdout.write(self.style.SUCCESS('Successfully computed and stored both risk maps'))
-    
-       
-#after adding the 2 risk maps to the database, empty both folders; IntermediateDataFiles and RiskMapFiles
-        
\ No newline at end of file
+        # compute Risk Map for week 1
+        # the classification inputs are kept, so the map can be recomputed with another rule set later
+        RiskMap_week1_file_name = os.path.join(dirname, "rasters", "Risk_map_week1_{}-{}.tif".format(today_ymd, six_d_from_now_ymd))
+        inputs_week1_file_name = os.path.join(settings.RISK_INPUTS_DIR, "Risk_map_week1_{}-{}_inputs.tif".format(today_ymd, six_d_from_now_ymd))
+
+        # the map is classified window by window from the tiled inputs file, within the memory budget
+        def classify_week1(twomt_past, rh_past, dusm_past):
+            write_risk_inputs(twomt_past, rh_past, dusm_past, inputs_week1_file_name)
+            self.classify(inputs_week1_file_name, RiskMap_week1_file_name, classifier)
+            return inputs_week1_file_name, RiskMap_week1_file_name
+
+        week1_files = self.stage('classify_week1', classify_week1, [twomt_past, rh_past, dusm_past],
+                                 [rule_set_key, RiskMap_week1_file_name, inputs_week1_file_name, settings.RISK_MAP_COMPRESSION], files=True)
+
+        print('computed risk map for week 1 with rule set {}'.format(rule_set.version))
+
+        # compute the Risk Maps of the forecast horizons: week 2, and week 3 when it is configured
+        # every horizon is classified from its own weekly means of the shared ECMWF downloads
+        # the GEOS-FP dust forecast ends 10 days after its run, so all horizons use the dust forecast of the next week
+        # (the dust of further weeks is assumed to persist)
+        rules = rules_from_json(rule_set.rules)
+        percentiles = settings.ECMWF_ENSEMBLE_PERCENTILES
+
+        def classify_horizon(product, first_step):
+            # the forecast of the week starting 24 h after first_step is used for the map of the week after it,
+            # e.g. steps 24 to 192 (today+1 - today+7) for the week 2 map of today+7 - today+13
+            first_day = today + timedelta(days=first_step // 24 + 6)
+            last_day = first_day + timedelta(days=6)
+            file_name = "Risk_map_{}_{}-{}".format(product, first_day.strftime("%Y%m%d"), last_day.strftime("%Y%m%d"))
+            risk_map_file_name = os.path.join(dirname, "rasters", file_name + ".tif")
+            inputs_file_name = os.path.join(settings.RISK_INPUTS_DIR, file_name + "_inputs.tif")
+
+            def classify_forecast(twomt_fc, rh_fc, sdc_fc):
+                write_risk_inputs(twomt_fc[product][1], rh_fc[product][1], sdc_fc, inputs_file_name)
+                self.classify(inputs_file_name, risk_map_file_name, classifier)
+                return inputs_file_name, risk_map_file_name
+
+            files = self.stage('classify_' + product, classify_forecast, [twomt_fc, rh_fc, sdc_fc],
+                               [rule_set_key, risk_map_file_name, inputs_file_name, settings.RISK_MAP_COMPRESSION], files=True)
+
+            # ensemble statistics of the ECMWF members as a confidence layer for the map:
+            # share of members that give the same risk level, mean, spread, percentiles and the probability of every rule threshold
+            ensemble_file_name = os.path.join(dirname, "rasters", file_name + "_ensemble.tif")
+
+            def classify_ensemble(twomt_fc, rh_fc, sdc_fc):
+                twomt_members, twomt_fc, twomt_member_numbers = twomt_fc[product]
+                rh_members, rh_fc, rh_member_numbers = rh_fc[product]
+
+                # members of the 2mt and RH forecasts are paired by member number
+                common_members = sorted(set(twomt_member_numbers) & set(rh_member_numbers))
+                twomt_members = twomt_members._replace(array=twomt_members.array[[twomt_member_numbers.index(number) for number in common_members]])
+                rh_members = rh_members._replace(array=rh_members.array[[rh_member_numbers.index(number) for number in common_members]])
+
+                risk_map = compute_risk_array(twomt_fc, rh_fc, sdc_fc, classifier)
+                layers = [("risk level agreement", ensemble_agreement(twomt_members, rh_members, sdc_fc, risk_map, classifier))]
+                layers += ensemble_statistics(twomt_members, "t2m", percentiles, rule_conditions(rules, RULE_VARIABLES['t2m']))
+                layers += ensemble_statistics(rh_members, "rh", percentiles, rule_conditions(rules, RULE_VARIABLES['rh']))
+                write_layers([(name, clip(layer)) for name, layer in layers], ensemble_file_name)
+
+                print('computed ensemble statistics of {} members for {}'.format(len(common_members), product))
+                return ensemble_file_name
+
+            ensemble_file = self.stage('classify_ensemble_' + product, classify_ensemble, [twomt_fc, rh_fc, sdc_fc],
+                                       [rule_set_key, percentiles, outlines, ensemble_file_name], files=True)
+
+            print('computed risk map for {}'.format(product))
+            return first_day, last_day, files, ensemble_file
+
+        forecast_maps = {product: classify_horizon(product, first_step) for product, first_step, _ in horizons}
+
+        # Save all raster files to the database, add them to the archive and compute their statistics per country
+        # the stage runs again whenever one of the maps changed, so a recomputed map is always published
+        def publish(week1_files, *forecast_files):
+            inputs_week1_file_name, tif_path_week1 = week1_files
+            forecast_files = dict(zip(forecast_maps, zip(forecast_files[::2], forecast_files[1::2])))
+            layer_ids = {}
+            ingested = []
+
+            def store_forecast(product, layer_name):
+                (inputs_file_name, tif_path), ensemble_file = forecast_files[product]
+                raster_layer, created = RasterLayer.objects.get_or_create(name=layer_name, datatype= 'ca') #datatype= 'ca'
+                ingested.append(self.ingest(raster_layer, tif_path, product))
+                RiskMap.objects.update_or_create(rasterLayer=raster_layer, defaults={'ruleSet': rule_set, 'inputsFile': inputs_file_name,
+                                                                                     'ensembleFile': ensemble_file})
+                layer_ids[product] = raster_layer.id
+
+                print ('stored risk map {} to db'.format(product))
+
+            def forecast_layer_name(product):
+                first_day, last_day = forecast_maps[product][:2]
+                return "{} - {}".format(first_day.strftime("%d/%m/%Y"), last_day.strftime("%d/%m/%Y"))
+
+            # the home page shows the two newest layers, so the maps of further horizons are stored before week 1 and
+            # week 2, and their layers are named by horizon as well (their dates are the ones of a week 2 map a week later)
+            products = list(forecast_maps)
+            for product in products[1:]:
+                store_forecast(product, "{} ({})".format(forecast_layer_name(product), product))
+
+            raster_layer, created = RasterLayer.objects.get_or_create(name="{} - {}".format(today_dmy, six_d_from_now_dmy), datatype='ca') #datatype= 'ca'
+            ingested.append(self.ingest(raster_layer, tif_path_week1, 'week1'))
+            RiskMap.objects.update_or_create(rasterLayer=raster_layer, defaults={'ruleSet': rule_set, 'inputsFile': inputs_week1_file_name})
+            layer_ids['week1'] = raster_layer.id
+
+            print ('stored risk map week 1 to db')
+
+            store_forecast(products[0], forecast_layer_name(products[0]))
+
+            # growth of the database per day: the tiles of all maps
+            if all(record['db_bytes'] is not None for record in ingested):
+                print('tile table grew by {:.2f} MB'.format(sum(record['db_bytes'] for record in ingested) / 10**6))
+            # copies django-raster left behind in rasters/reprojected
+            removed, removed_bytes = remove_orphaned_reprojected()
+            if removed:
+                print('removed {} reprojected copies ({:.1f} MB)'.format(removed, removed_bytes / 10**6))
+
+            # all maps are added to the archive, by the first day of the week they are valid for
+            append_risk_map(settings.RISK_ARCHIVE_FILE, 'week1', today, tif_path_week1, target_grid, regrid_cache_dir)
+            for product, ((inputs_file_name, tif_path), ensemble_file) in forecast_files.items():
+                append_risk_map(settings.RISK_ARCHIVE_FILE, product, forecast_maps[product][0], tif_path, target_grid, regrid_cache_dir)
+
+            # statistics of all maps per country, for dashboards and alerts
+            call_command('compute_zonal_statistics', layer=list(layer_ids.values()), shapefile=input_shapefile)
+            return [layer_ids['week1']] + [layer_ids[product] for product in forecast_maps]
+
+        forecast_outputs = [output for first_day, last_day, files, ensemble_file in forecast_maps.values() for output in (files, ensemble_file)]
+        self.stage('publish', publish, [week1_files] + forecast_outputs, [rule_set_key, settings.RISK_ARCHIVE_FILE, outlines])
+
+        self.stdout.write(self.style.SUCCESS('Successfully computed and stored the risk maps {}'.format(', '.join(['week1'] + list(forecast_maps)))))
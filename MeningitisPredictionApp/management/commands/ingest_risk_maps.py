@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from raster.models import RasterLayer
+import os
+
+from .raster_ingest_fun import ingest_raster_layer, remove_orphaned_reprojected, tile_table_bytes
+
+
+class Command(BaseCommand):
+    help = 'Store the tiles of risk maps with the risk map ingest instead of the django-raster parser, and remove the reprojected copies it left behind'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--layer', type=int, nargs='+', help='Ids of the raster layers to ingest (default: all layers with a file)')
+        parser.add_argument('--min-zoom', type=int, default=settings.RISK_MAP_TILE_MIN_ZOOM)
+        parser.add_argument('--max-zoom', type=int, default=settings.RISK_MAP_TILE_MAX_ZOOM, help='Default: the native zoom level of every map')
+
+    def handle(self, *args, **kwargs):
+        raster_layers = RasterLayer.objects.exclude(rasterfile='').order_by('id')
+        if kwargs['layer']:
+            raster_layers = raster_layers.filter(id__in=kwargs['layer'])
+
+        before = tile_table_bytes()
+        ingested = 0
+        seconds = 0
+        for raster_layer in raster_layers:
+            if not os.path.exists(raster_layer.rasterfile.path):
+                print('file of {} not found, skipped'.format(raster_layer.name))
+                continue
+            result = ingest_raster_layer(raster_layer, raster_layer.rasterfile.path, min_zoom=kwargs['min_zoom'], max_zoom=kwargs['max_zoom'],
+                                         cache_dir=settings.REGRID_CACHE_DIR, batch_size=settings.RASTER_INGEST_BATCH_SIZE)
+            ingested += 1
+            seconds += result['seconds']
+            print('stored {} tiles of {} (zoom levels {}) in {:.2f} s'.format(result['tiles'], raster_layer.name, result['zoom_levels'], result['seconds']))
+
+        removed, removed_bytes = remove_orphaned_reprojected()
+        print('removed {} reprojected copies ({:.1f} MB)'.format(removed, removed_bytes / 10**6))
+
+        # the tiles of replaced layers leave dead rows behind until postgres vacuums the table
+        after = tile_table_bytes()
+        if before is not None:
+            print('tile table {:.1f} MB -> {:.1f} MB'.format(before / 10**6, after / 10**6))
+
+        self.stdout.write(self.style.SUCCESS('Ingested {} risk maps in {:.1f} s'.format(ingested, seconds)))
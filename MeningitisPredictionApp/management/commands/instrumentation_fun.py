@@ -0,0 +1,248 @@
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import numpy as np
+import functools
+import threading
+import resource
+import logging
+import json
+import time
+import os
+
+from .workspace_fun import temporary_path
+
+
+# Measurements of the risk map job: every stage (see stage_graph_fun) and every data processing function that is
+# decorated with @instrumented records its wall time, CPU time, the peak memory of the process, the bytes it read and
+# wrote and the shapes/dtypes of its outputs, the downloads record their network bytes per source.
+# Stages are logged as one JSON line each, a finished run is summarized as Prometheus metrics and stored in the
+# database (PipelineRun). Outside of a recorded run (e.g. in the web views) the functions run unmeasured.
+# CPU time is the one of the calling thread plus the one of the child processes that ended meanwhile (the process pool
+# of compute_risk_map_windowed). Memory and I/O are counters of the whole process: the peak memory is reset at the
+# start of the run and at the start of every stage that no other stage runs next to, and the bytes read and written of
+# a stage that overlapped with other stages (the downloads) are left out, they would include the work of the others
+logger = logging.getLogger('MeningitisPredictionApp.pipeline')
+
+# the run being recorded by this process, None when no run is recorded
+current_run = None
+run_lock = threading.Lock()
+
+
+# bytes read and written by the process (files, pipes and sockets), 0 where /proc is not available
+def io_counters():
+    try:
+        with open('/proc/self/io') as io:
+            counters = dict(line.split(': ') for line in io.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+# Function that returns the resident memory of the process and its peak since the last reset (bytes), from
+# /proc/self/status on linux. The peak is reset by writing 5 to /proc/self/clear_refs, so the peak of a stage
+# includes the memory GDAL and eccodes allocate
+def rss_counters():
+    try:
+        with open('/proc/self/status') as status:
+            values = dict(line.split(':', 1) for line in status.read().splitlines() if ':' in line)
+        return int(values['VmRSS'].split()[0]) * 1024, int(values['VmHWM'].split()[0]) * 1024
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+
+# peak resident memory since the last reset (bytes); without /proc it is the peak of the whole life of the process
+def peak_rss():
+    _, peak = rss_counters()
+    if peak is None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return peak
+
+
+# CPU time (user + system) of the child processes that have ended and were waited for
+def children_cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+# Function that describes the outputs of a stage or function: shape and dtype of arrays and Rasters, size of files
+def describe_value(value):
+    if isinstance(value, np.ndarray):
+        return {'shape': list(value.shape), 'dtype': str(value.dtype)}
+    if hasattr(value, 'array') and isinstance(value.array, np.ndarray):
+        return describe_value(value.array)
+    if isinstance(value, str) and os.path.isfile(value):
+        return {'file': os.path.basename(value), 'bytes': os.path.getsize(value)}
+    if isinstance(value, (tuple, list)) and not hasattr(value, '_fields'):
+        described = [describe_value(item) for item in value]
+        return [item for item in described if item is not None] or None
+    return None
+
+
+# (thread, record) of the stages that are being measured, to tell which stages overlap
+active_stages = []
+
+
+def start_run(name):
+    global current_run
+    reset_peak_rss()
+    with run_lock:
+        current_run = {
+            'name': name,
+            'started': datetime.now(timezone.utc),
+            'stages': [],
+            'functions': {},
+            'network': {},
+            'peak_rss_bytes': 0,
+            'counters': (time.perf_counter(), time.process_time() + children_cpu_time(), io_counters()),
+        }
+    return current_run
+
+
+# Function that adds the peak memory since the last reset to the peak of the recorded run, so resetting the peak at a
+# stage doesn't lose the peak of the run. Called with run_lock held
+def update_run_peak():
+    peak = peak_rss()
+    if current_run is not None:
+        current_run['peak_rss_bytes'] = max(current_run['peak_rss_bytes'], peak)
+    return peak
+
+
+# Function that ends the recorded run and returns its summary
+def finish_run(status):
+    global current_run
+    with run_lock:
+        update_run_peak()
+        run, current_run = current_run, None
+    wall, cpu, (read, written) = run.pop('counters')
+    now_read, now_written = io_counters()
+    run.update({
+        'finished': datetime.now(timezone.utc),
+        'status': status,
+        'wall_seconds': time.perf_counter() - wall,
+        'cpu_seconds': time.process_time() + children_cpu_time() - cpu,
+        'bytes_read': now_read - read,
+        'bytes_written': now_written - written,
+    })
+    logger.info(json.dumps({'event': 'run', **{key: value for key, value in run.items() if key not in ('stages', 'functions')}}, default=str))
+    return run
+
+
+# Context manager that measures a stage of the recorded run. Yields the record of the stage, so the caller can add to
+# it (e.g. whether the stage ran or was read from the stage folder)
+@contextmanager
+def measure_stage(name):
+    record = {'stage': name, 'status': 'failed', 'overlapped': False}
+    with run_lock:
+        # the peak memory of the stage starts here, unless other stages are running (then it includes theirs)
+        # stages measured within a stage of the same thread (ingest within publish) don't overlap with it
+        thread = threading.get_ident()
+        for other_thread, other in active_stages:
+            if other_thread != thread:
+                record['overlapped'] = other['overlapped'] = True
+        if not active_stages:
+            update_run_peak()
+            reset_peak_rss()
+        active_stages.append((thread, record))
+    wall, cpu, (read, written) = time.perf_counter(), time.thread_time() + children_cpu_time(), io_counters()
+    try:
+        yield record
+    finally:
+        now_read, now_written = io_counters()
+        with run_lock:
+            active_stages[:] = [entry for entry in active_stages if entry[1] is not record]
+            record.update({
+                'wall_seconds': time.perf_counter() - wall,
+                'cpu_seconds': time.thread_time() + children_cpu_time() - cpu,
+                'peak_rss_bytes': update_run_peak(),
+                # process wide counters, unknown for a stage that ran next to others
+                'bytes_read': None if record['overlapped'] else now_read - read,
+                'bytes_written': None if record['overlapped'] else now_written - written,
+            })
+            if current_run is not None:
+                current_run['stages'].append(record)
+        logger.info(json.dumps({'event': 'stage', **record}, default=str))
+
+
+# Decorator that measures a data processing function while a run is recorded: calls, wall and CPU time (including
+# the functions it calls), and the shapes/dtypes of its last output
+def instrumented(function):
+    name = function.__name__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if current_run is None:
+            return function(*args, **kwargs)
+
+        wall, cpu = time.perf_counter(), time.thread_time()
+        result = function(*args, **kwargs)
+        wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+
+        with run_lock:
+            if current_run is not None:
+                totals = current_run['functions'].setdefault(name, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+                totals['calls'] += 1
+                totals['wall_seconds'] += wall
+                totals['cpu_seconds'] += cpu
+                totals['outputs'] = describe_value(result)
+        return result
+
+    return wrapper
+
+
+# Function that adds the bytes downloaded from a source (e.g. geos_fp/tavg3_2d_aer_Nx, ecmwf/2t) to the recorded run
+def record_network(source, transferred):
+    with run_lock:
+        if current_run is not None:
+            current_run['network'][source] = current_run['network'].get(source, 0) + transferred
+
+
+def prometheus_labels(**labels):
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels.items()) + '}'
+
+
+# Function that returns the summary of a run in the Prometheus text format (for the node exporter textfile collector)
+def prometheus_metrics(run, prefix='meningitis_pipeline'):
+    metrics = [
+        ('run_seconds', 'Wall time of the last run', [({}, run['wall_seconds'])]),
+        ('run_cpu_seconds', 'CPU time of the last run', [({}, run['cpu_seconds'])]),
+        ('run_peak_rss_bytes', 'Peak resident memory of the last run', [({}, run['peak_rss_bytes'])]),
+        ('run_read_bytes', 'Bytes read by the last run', [({}, run['bytes_read'])]),
+        ('run_written_bytes', 'Bytes written by the last run', [({}, run['bytes_written'])]),
+        ('run_success', '1 if the last run succeeded', [({}, int(run['status'] == 'success'))]),
+        ('run_finished_timestamp_seconds', 'End of the last run', [({}, run['finished'].timestamp())]),
+        ('network_bytes', 'Bytes downloaded per source by the last run', [({'source': source}, value) for source, value in sorted(run['network'].items())]),
+        ('stage_seconds', 'Wall time of the stages of the last run', [({'stage': stage['stage'], 'status': stage['status']}, stage['wall_seconds']) for stage in run['stages']]),
+        ('stage_cpu_seconds', 'CPU time of the stages of the last run', [({'stage': stage['stage'], 'status': stage['status']}, stage['cpu_seconds']) for stage in run['stages']]),
+        ('stage_peak_rss_bytes', 'Peak resident memory during the stages of the last run (including the stages running next to them)', [({'stage': stage['stage']}, stage['peak_rss_bytes']) for stage in run['stages']]),
+        ('stage_read_bytes', 'Bytes read during the stages of the last run that ran alone', [({'stage': stage['stage']}, stage['bytes_read']) for stage in run['stages'] if stage['bytes_read'] is not None]),
+        ('stage_written_bytes', 'Bytes written during the stages of the last run that ran alone', [({'stage': stage['stage']}, stage['bytes_written']) for stage in run['stages'] if stage['bytes_written'] is not None]),
+        ('ingest_tiles', 'Tiles stored per risk map by the last run', [({'stage': stage['stage']}, stage['tiles']) for stage in run['stages'] if 'tiles' in stage]),
+        ('ingest_db_bytes', 'Growth of the tile table per risk map in the last run', [({'stage': stage['stage']}, stage['db_bytes']) for stage in run['stages'] if stage.get('db_bytes') is not None]),
+        ('function_calls', 'Calls of the data processing functions in the last run', [({'function': name}, totals['calls']) for name, totals in sorted(run['functions'].items())]),
+        ('function_seconds', 'Wall time of the data processing functions in the last run', [({'function': name}, totals['wall_seconds']) for name, totals in sorted(run['functions'].items())]),
+    ]
+    lines = []
+    for metric, description, samples in metrics:
+        lines.append('# HELP {}_{} {}'.format(prefix, metric, description))
+        lines.append('# TYPE {}_{} gauge'.format(prefix, metric))
+        for labels, value in samples:
+            lines.append('{}_{}{} {}'.format(prefix, metric, prometheus_labels(name=run['name'], **labels), repr(float(value))))
+    return '\n'.join(lines) + '\n'
+
+
+# Function that writes the metrics of a run to a file, replaced at once so the collector never reads half a file
+def write_prometheus_file(run, metrics_file):
+    os.makedirs(os.path.dirname(metrics_file) or '.', exist_ok=True)
+    # a temporary file of its own, runs at the same time (a backfill next to the daily run) write the same file
+    temporary = temporary_path(metrics_file)
+    with open(temporary, 'w') as output:
+        output.write(prometheus_metrics(run))
+    os.replace(temporary, metrics_file)
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+import json
+
+from MeningitisPredictionApp.models import RiskRuleSet
+from .data_processing_fun import rules_from_json, compile_risk_classifier
+
+
+class Command(BaseCommand):
+    help = 'Store a versioned rule set for the vigilance levels from a JSON file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('rules_file', help='JSON file with a list of {"level": ..., "conditions": [[variable, operator, threshold], ...]}')
+        parser.add_argument('--version', required=True, help='Version name of the rule set, e.g. dione-v2')
+        parser.add_argument('--description', default='')
+        parser.add_argument('--activate', action='store_true', help='Use this rule set for all new risk maps')
+
+    def handle(self, *args, **kwargs):
+        with open(kwargs['rules_file']) as rules_file:
+            rules = json.load(rules_file)
+
+        # make sure the rules compile before they are stored
+        try:
+            compile_risk_classifier(rules_from_json(rules))
+        except (KeyError, TypeError, ValueError) as error:
+            raise CommandError('invalid rules: {}'.format(error))
+
+        if RiskRuleSet.objects.filter(version=kwargs['version']).exists():
+            raise CommandError('rule set {} already exists, rule sets are not changed once stored'.format(kwargs['version']))
+
+        with transaction.atomic():
+            if kwargs['activate']:
+                RiskRuleSet.objects.filter(isActive=True).update(isActive=False)
+            RiskRuleSet.objects.create(version=kwargs['version'], description=kwargs['description'],
+                                       rules=rules, isActive=kwargs['activate'])
+
+        self.stdout.write(self.style.SUCCESS('Stored rule set {}'.format(kwargs['version'])))
@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from datetime import datetime
+import rasterio
+import os
+
+from .risk_archive_fun import archive_time_series, archive_maps
+from .data_processing_fun import TILED_GTIFF, RISK_MAP_NODATA
+
+
+def parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+class Command(BaseCommand):
+    help = 'Read the levels at a point or the maps of a period from the risk map archive'
+
+    def add_arguments(self, parser):
+        parser.add_argument('start', type=parse_date, help='First week (YYYY-MM-DD)')
+        parser.add_argument('end', type=parse_date, help='Last week (YYYY-MM-DD)')
+        parser.add_argument('--product', default='week1', help='week1 or the name of a forecast horizon (ECMWF_FORECAST_HORIZONS), e.g. week2')
+        parser.add_argument('--point', type=float, nargs=2, metavar=('LON', 'LAT'), help='Print the levels at this point')
+        parser.add_argument('--maps', help='Write the maps of the period to this GeoTIFF, one band per week')
+
+    def handle(self, *args, **kwargs):
+        if not os.path.exists(settings.RISK_ARCHIVE_FILE):
+            raise CommandError('there is no risk map archive yet, run backfill_risk_archive first')
+        if not kwargs['point'] and not kwargs['maps']:
+            raise CommandError('give --point and/or --maps')
+
+        if kwargs['point']:
+            lon, lat = kwargs['point']
+            try:
+                series = archive_time_series(settings.RISK_ARCHIVE_FILE, kwargs['product'], lon, lat, kwargs['start'], kwargs['end'])
+            except ValueError as error:
+                raise CommandError(error)
+            for day, level in series:
+                self.stdout.write('{} {}'.format(day, level if level is not None else '-'))
+
+        if kwargs['maps']:
+            try:
+                dates, levels, grid = archive_maps(settings.RISK_ARCHIVE_FILE, kwargs['product'], kwargs['start'], kwargs['end'])
+            except ValueError as error:
+                raise CommandError(error)
+            if not dates:
+                raise CommandError('no {} maps from {} to {}'.format(kwargs['product'], kwargs['start'], kwargs['end']))
+            with rasterio.open(kwargs['maps'], 'w', width=grid.shape[1], height=grid.shape[0], count=len(dates), dtype=levels.dtype,
+                               nodata=RISK_MAP_NODATA, crs=grid.crs, transform=grid.transform, **TILED_GTIFF) as dst:
+                dst.write(levels)
+                for band, day in enumerate(dates, start=1):
+                    dst.set_band_description(band, day.isoformat())
+            self.stdout.write(self.style.SUCCESS('Wrote {} {} maps to {}'.format(len(dates), kwargs['product'], kwargs['maps'])))
@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from raster.models import RasterLayer
+from shapely.geometry import shape, mapping
+import fiona
+import json
+import time
+
+from .risk_query_fun import query_risk_maps, risk_query_layers
+
+
+class Command(BaseCommand):
+    help = 'Look up the risk levels at the points and in the polygons of a GeoJSON file or shapefile'
+
+    def add_arguments(self, parser):
+        parser.add_argument('input_file', help='GeoJSON file or shapefile with point and/or polygon features (longitude/latitude)')
+        parser.add_argument('--layer', type=int, nargs='+', help='Ids of the raster layers (default: the two most recent)')
+        parser.add_argument('--all-touched', action='store_true', help='Count every pixel a polygon touches, not only the ones whose center is inside')
+        parser.add_argument('--output', help='JSON file for the results (default: standard output)')
+
+    def handle(self, *args, **kwargs):
+        point_features = []
+        region_features = []
+        try:
+            with fiona.open(kwargs['input_file']) as features:
+                for feature in features:
+                    geometry = mapping(shape(feature['geometry']))
+                    properties = dict(feature['properties'])
+                    if geometry['type'] == 'Point':
+                        point_features.append((properties, geometry['coordinates'][:2]))
+                    elif geometry['type'] in ('Polygon', 'MultiPolygon'):
+                        region_features.append((properties, geometry))
+        except fiona.errors.FionaError as error:
+            raise CommandError(error)
+
+        if kwargs['layer']:
+            raster_layers = RasterLayer.objects.filter(id__in=kwargs['layer']).order_by('-id')
+        else:
+            raster_layers = RasterLayer.objects.order_by('-id')[:2]
+
+        started = time.perf_counter()
+        results = query_risk_maps(risk_query_layers(raster_layers), settings.RISK_QUERY_CACHE_DIR,
+                                  [point for _, point in point_features], [region for _, region in region_features],
+                                  all_touched=kwargs['all_touched'])
+        seconds = time.perf_counter() - started
+
+        # one entry per feature with the level (points) or the histogram and majority level (regions) of every layer
+        output = []
+        for position, (properties, _) in enumerate(point_features):
+            output.append({'properties': properties, 'levels': {result['name']: result['points'][position] for result in results}})
+        for position, (properties, _) in enumerate(region_features):
+            output.append({'properties': properties, 'levels': {result['name']: result['regions'][position] for result in results}})
+
+        if kwargs['output']:
+            with open(kwargs['output'], 'w') as output_file:
+                json.dump(output, output_file, indent=1, default=str)
+        else:
+            self.stdout.write(json.dumps(output, indent=1, default=str))
+
+        self.stderr.write('queried {} points and {} regions in {} risk maps in {:.3f} s'.format(
+            len(point_features), len(region_features), len(results), seconds))
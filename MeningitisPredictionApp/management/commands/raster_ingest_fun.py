@@ -0,0 +1,185 @@
+from django.conf import settings
+from django.contrib.gis.gdal import GDALRaster
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.utils import timezone
+from raster.models import RasterLayer, RasterLayerMetadata, RasterLayerParseStatus, RasterLayerBandMetadata, RasterLayerReprojected, RasterTile
+from raster.tiles.const import WEB_MERCATOR_SRID, WEB_MERCATOR_TILESIZE
+from raster.tiles.utils import tile_bounds, tile_index_range, tile_scale
+from rasterio.transform import array_bounds
+from rasterio.warp import transform_bounds
+from affine import Affine
+import rasterio.dtypes
+import rasterio.crs
+import numpy as np
+import datetime
+import time
+import os
+
+from .data_processing_fun import read_raster, regrid, raster_grid, Grid
+from .tile_cache_fun import WEB_MERCATOR_MAX_LATITUDE, native_zoom
+from .instrumentation_fun import instrumented
+
+
+# The risk maps are stored as the tiles of their RasterLayer here instead of by the django-raster parser. The parser
+# reprojects every map to a web mercator GeoTIFF, keeps a zipped copy of it in rasters/reprojected (temporary tmp*.zip
+# files that are never removed), warps that copy again for every zoom level and inserts the tiles in batches of 500
+# in their own transactions, from a celery task per layer.
+# Here every zoom level is warped straight from the EPSG:4326 map with nearest neighbour (the risk levels are
+# categories) through a regrid plan that is built once for the fixed africa grid and kept in the regrid cache, only the
+# zoom levels the maps are served at are stored, and all tiles of a map are inserted in large batches in one
+# transaction together with the metadata, so the tiles of a map are replaced all at once. Nothing is written to disk.
+# The layer's file is set with update(), which sends no save signals, so django-raster never parses the layer itself.
+
+
+# Function that returns the zoom levels the tiles of a map on a grid are stored for: min_zoom (the maps are never
+# shown further out, and the pre-rendered tiles cover the low zoom levels) up to max_zoom or the native zoom level
+def served_zoom_levels(grid, min_zoom=0, max_zoom=None):
+    if max_zoom is None:
+        max_zoom = native_zoom(grid)
+    return list(range(min(min_zoom, max_zoom), max_zoom + 1))
+
+
+# Function that returns the web mercator grid of all tiles of a zoom level that cover a grid, and the x/y index of
+# its upper left tile
+def mercator_tile_grid(grid, zoom):
+    west, south, east, north = array_bounds(grid.shape[0], grid.shape[1], grid.transform)
+    bbox = transform_bounds(grid.crs, 'EPSG:{}'.format(WEB_MERCATOR_SRID), west, max(south, -WEB_MERCATOR_MAX_LATITUDE),
+                            east, min(north, WEB_MERCATOR_MAX_LATITUDE))
+    xmin, ymin, xmax, ymax = tile_index_range(bbox, zoom)
+    left, _, _, top = tile_bounds(xmin, ymin, zoom)
+    scale = tile_scale(zoom)
+    shape = ((ymax - ymin + 1) * WEB_MERCATOR_TILESIZE, (xmax - xmin + 1) * WEB_MERCATOR_TILESIZE)
+    return xmin, ymin, Grid(Affine(scale, 0.0, left, 0.0, -scale, top), shape, rasterio.crs.CRS.from_epsg(WEB_MERCATOR_SRID))
+
+
+# Function that warps a Raster onto the web mercator tiles of a zoom level (nearest neighbour, with a cached regrid
+# plan) and returns (x, y, data) of every tile that has data
+@instrumented
+def mercator_tiles(raster, zoom, cache_dir=None):
+    xmin, ymin, grid = mercator_tile_grid(raster_grid(raster), zoom)
+    data = regrid(raster, grid, 'nearest', cache_dir).array
+
+    tiles = []
+    for row in range(0, grid.shape[0], WEB_MERCATOR_TILESIZE):
+        for col in range(0, grid.shape[1], WEB_MERCATOR_TILESIZE):
+            tile = data[row:row + WEB_MERCATOR_TILESIZE, col:col + WEB_MERCATOR_TILESIZE]
+            # tiles without data are not stored, like django-raster
+            if np.all(tile == raster.nodata):
+                continue
+            tiles.append((xmin + col // WEB_MERCATOR_TILESIZE, ymin + row // WEB_MERCATOR_TILESIZE, np.ascontiguousarray(tile)))
+    return tiles
+
+
+# Function that turns the data of a tile into the in-memory raster of a RasterTile
+def tile_raster(data, x, y, zoom, nodata):
+    xmin, _, _, ymax = tile_bounds(x, y, zoom)
+    scale = tile_scale(zoom)
+    return GDALRaster({
+        'width': WEB_MERCATOR_TILESIZE,
+        'height': WEB_MERCATOR_TILESIZE,
+        'origin': [xmin, ymax],
+        'scale': [scale, -scale],
+        'srid': WEB_MERCATOR_SRID,
+        'datatype': rasterio.dtypes.dtype_rev[str(data.dtype)],
+        'bands': [{'data': data, 'nodata_value': nodata}],
+    })
+
+
+# Function that returns the size of the tile table on disk (bytes, with its indexes), None on databases other than
+# PostgreSQL
+def tile_table_bytes():
+    if connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_total_relation_size(%s)', [RasterTile._meta.db_table])
+        return cursor.fetchone()[0]
+
+
+# Function that stores the metadata django-raster extracts while parsing: georeferencing of the map, and statistics
+# and histogram of its band (used by the legends and the value counts)
+def store_layer_metadata(raster_layer, raster, max_zoom):
+    transform = raster.transform
+    RasterLayerMetadata.objects.update_or_create(rasterlayer=raster_layer, defaults={
+        'uperleftx': transform.c, 'uperlefty': transform.f, 'width': raster.array.shape[1], 'height': raster.array.shape[0],
+        'scalex': transform.a, 'scaley': transform.e, 'skewx': transform.b, 'skewy': transform.d, 'numbands': 1,
+        'srs_wkt': raster.crs.to_wkt(), 'srid': raster.crs.to_epsg(), 'max_zoom': max_zoom,
+    })
+
+    RasterLayerBandMetadata.objects.filter(rasterlayer=raster_layer).delete()
+    values = raster.array[raster.array != raster.nodata]
+    if not values.size:
+        return
+    # the empty histogram (the bins) is set up when the band metadata is created
+    band = RasterLayerBandMetadata(rasterlayer=raster_layer, band=0, nodata_value=raster.nodata, min=float(values.min()),
+                                   max=float(values.max()), mean=float(values.mean()), std=float(values.std()))
+    band.save()
+    band.hist_values = np.histogram(values, bins=band.hist_bins)[0].tolist()
+    band.save()
+
+
+# Function that removes the reprojected copy django-raster kept of a layer
+def remove_reprojected(raster_layer):
+    for reprojected in RasterLayerReprojected.objects.filter(rasterlayer=raster_layer):
+        if reprojected.rasterfile.name:
+            reprojected.rasterfile.delete(save=False)
+        reprojected.delete()
+
+
+# Function that removes the files in rasters/reprojected that no layer refers to (left behind by django-raster)
+# Returns the number of files and bytes removed
+def remove_orphaned_reprojected():
+    folder = RasterLayerReprojected._meta.get_field('rasterfile').upload_to
+    if not default_storage.exists(folder):
+        return 0, 0
+    used = set(os.path.basename(name) for name in RasterLayerReprojected.objects.exclude(rasterfile='').values_list('rasterfile', flat=True))
+    removed = 0
+    removed_bytes = 0
+    for file_name in default_storage.listdir(folder)[1]:
+        if file_name in used:
+            continue
+        path = os.path.join(folder, file_name)
+        removed_bytes += default_storage.size(path)
+        default_storage.delete(path)
+        removed += 1
+    return removed, removed_bytes
+
+
+# Function that stores a risk map file as the tiles of a RasterLayer (see the top of this file)
+# Returns the ingest time, the zoom levels, the number of tiles and how much the tile table grew (None if unknown)
+def ingest_raster_layer(raster_layer, raster_file, min_zoom=0, max_zoom=None, cache_dir=None, batch_size=2000):
+    started = time.perf_counter()
+    raster = read_raster(raster_file)
+    zoom_levels = served_zoom_levels(raster_grid(raster), min_zoom, max_zoom)
+
+    tiles = []
+    for zoom in zoom_levels:
+        for x, y, data in mercator_tiles(raster, zoom, cache_dir):
+            tiles.append(RasterTile(rast=tile_raster(data, x, y, zoom, raster.nodata), rasterlayer_id=raster_layer.id,
+                                    tilex=x, tiley=y, tilez=zoom))
+
+    table_bytes = tile_table_bytes()
+    rasterfile = os.path.relpath(raster_file, settings.MEDIA_ROOT)
+    with transaction.atomic():
+        # update() sends no save signals, so django-raster doesn't reset the parse status and parse the layer
+        RasterLayer.objects.filter(pk=raster_layer.pk).update(rasterfile=rasterfile, modified=timezone.now())
+        raster_layer.rasterfile.name = rasterfile
+
+        RasterTile.objects.filter(rasterlayer=raster_layer).delete()
+        RasterTile.objects.bulk_create(tiles, batch_size=batch_size)
+        store_layer_metadata(raster_layer, raster, zoom_levels[-1])
+
+        log = '[{}] Ingested {} tiles at zoom levels {} from {}.'.format(
+            datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), len(tiles), zoom_levels, os.path.basename(raster_file))
+        RasterLayerParseStatus.objects.update_or_create(rasterlayer=raster_layer, defaults={
+            'status': RasterLayerParseStatus.FINISHED, 'tile_levels': zoom_levels, 'log': log})
+
+    remove_reprojected(raster_layer)
+    grown = tile_table_bytes()
+    return {
+        'layer': raster_layer.id,
+        'seconds': time.perf_counter() - started,
+        'zoom_levels': zoom_levels,
+        'tiles': len(tiles),
+        'db_bytes': grown - table_bytes if table_bytes is not None else None,
+    }
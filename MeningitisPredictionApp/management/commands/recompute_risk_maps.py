@@ -0,0 +1,65 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management import call_command
+from django.conf import settings
+import os
+
+from MeningitisPredictionApp.models import RiskRuleSet, RiskMap
+from .data_processing_fun import compute_risk_map_windowed, get_risk_classifier
+from .raster_ingest_fun import ingest_raster_layer
+from .workspace_fun import run_workspace
+
+
+class Command(BaseCommand):
+    help = 'Recompute stored risk maps with another rule set from their cached classification inputs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rule-set', help='Version of the rule set to use (default: the active one)')
+
+    def handle(self, *args, **kwargs):
+        if kwargs['rule_set']:
+            try:
+                rule_set = RiskRuleSet.objects.get(version=kwargs['rule_set'])
+            except RiskRuleSet.DoesNotExist:
+                raise CommandError('rule set {} does not exist'.format(kwargs['rule_set']))
+        else:
+            rule_set = RiskRuleSet.active()
+
+        classifier = get_risk_classifier(rule_set.version, rule_set.rules)
+
+        with run_workspace(settings.RISK_MAP_WORKSPACE_ROOT, 'recompute_risk_maps') as workspace:
+            recomputed_layers = self.recompute(rule_set, classifier, workspace)
+
+        if recomputed_layers:
+            call_command('render_risk_map_tiles', layer=recomputed_layers)
+            call_command('compute_zonal_statistics', layer=recomputed_layers)
+
+        self.stdout.write(self.style.SUCCESS('Recomputed {} risk maps'.format(len(recomputed_layers))))
+
+    # recompute every risk map of another rule set, returns the ids of the recomputed layers
+    def recompute(self, rule_set, classifier, workspace):
+        recomputed_layers = []
+        for risk_map in RiskMap.objects.exclude(ruleSet=rule_set).select_related('rasterLayer'):
+            if not risk_map.inputsFile or not os.path.exists(risk_map.inputsFile):
+                print('no cached inputs for {}, skipped'.format(risk_map.rasterLayer.name))
+                continue
+
+            # Risk_map_week1_20240507-20240513_inputs.tif -> Risk_map_week1_20240507-20240513_<version>.tif
+            file_name = os.path.basename(risk_map.inputsFile).replace('_inputs.tif', '_{}.tif'.format(rule_set.version))
+            tif_path = os.path.join(os.getcwd(), "rasters", file_name)
+            compute_risk_map_windowed([(risk_map.inputsFile, band) for band in (1, 2, 3)], tif_path, classifier=classifier,
+                                      memory_budget=settings.RISK_MAP_MEMORY_BUDGET_MB * 1024**2, workers=settings.RISK_MAP_WORKERS,
+                                      compress=settings.RISK_MAP_COMPRESSION, workspace=workspace)
+
+            # the tiles of the layer are replaced by the ones of the new file
+            raster_layer = risk_map.rasterLayer
+            ingested = ingest_raster_layer(raster_layer, tif_path, min_zoom=settings.RISK_MAP_TILE_MIN_ZOOM, max_zoom=settings.RISK_MAP_TILE_MAX_ZOOM,
+                                           cache_dir=settings.REGRID_CACHE_DIR, batch_size=settings.RASTER_INGEST_BATCH_SIZE)
+            risk_map.ruleSet = rule_set
+            # the tiles and zones are rendered again below, until then the django-raster tiles are shown
+            risk_map.tileSet = None
+            risk_map.zoneSet = None
+            risk_map.save()
+            recomputed_layers.append(raster_layer.id)
+
+            print('recomputed {} with rule set {} ({} tiles stored in {:.2f} s)'.format(raster_layer.name, rule_set.version, ingested['tiles'], ingested['seconds']))
+        return recomputed_layers
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from raster.models import RasterLayer, Legend
+
+from MeningitisPredictionApp.models import RiskMap
+from MeningitisPredictionApp.signals import invalidate_home_page
+from .tile_cache_fun import prerender_tile_set, evict_tile_sets
+from .risk_zones_fun import build_zone_set, evict_zone_sets
+
+
+class Command(BaseCommand):
+    help = 'Pre-render the map tiles and the vector risk zones of the risk maps into the tile and zone caches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--layer', type=int, nargs='+', help='Ids of the raster layers to render (default: the two most recent, shown on the home page)')
+        parser.add_argument('--max-zoom', type=int, default=settings.TILE_CACHE_MAX_ZOOM)
+        parser.add_argument('--legend', default=settings.RISK_MAP_LEGEND, help='Title of the legend with the colors of the vigilance levels')
+
+    def handle(self, *args, **kwargs):
+        legend = Legend.objects.filter(title__iexact=kwargs['legend']).first()
+        if legend is None:
+            raise CommandError('legend {} does not exist'.format(kwargs['legend']))
+        colormap = legend.colormap
+
+        if kwargs['layer']:
+            raster_layers = RasterLayer.objects.filter(id__in=kwargs['layer'])
+        else:
+            raster_layers = RasterLayer.objects.order_by('-id')[:2]
+
+        for raster_layer in raster_layers:
+            tile_set = prerender_tile_set(raster_layer.rasterfile.path, colormap, settings.TILE_CACHE_DIR,
+                                          max_zoom=kwargs['max_zoom'], layer_id=raster_layer.id)
+            # the levels of the map as polygons, drawn by the browser instead of the tiles
+            zone_set = build_zone_set(raster_layer.rasterfile.path, colormap, settings.ZONE_CACHE_DIR, layer_id=raster_layer.id)
+            # layers without a RiskMap (stored before rule sets existed) keep their django-raster tiles
+            RiskMap.objects.filter(rasterLayer=raster_layer).update(tileSet=tile_set, zoneSet=zone_set)
+            print('tiles of {} are in tile set {}, zones in zone set {}'.format(raster_layer.name, tile_set, zone_set))
+
+        # the tile sets of the maps on the home page are never evicted
+        home_layers = list(RasterLayer.objects.order_by('-id').values_list('id', flat=True)[:2])
+        keep = set(RiskMap.objects.filter(rasterLayer__in=home_layers).exclude(tileSet=None).values_list('tileSet', flat=True))
+        evicted = evict_tile_sets(settings.TILE_CACHE_DIR, settings.TILE_CACHE_MAX_SETS, keep)
+        # maps whose tiles were evicted fall back to the django-raster tiles
+        RiskMap.objects.filter(tileSet__in=evicted).update(tileSet=None)
+        # zone sets are small, they are kept for every stored map and only removed when the map was replaced
+        evict_zone_sets(settings.ZONE_CACHE_DIR, set(RiskMap.objects.exclude(zoneSet=None).values_list('zoneSet', flat=True)))
+        # update() sends no save signals, the home page links the new tile sets
+        invalidate_home_page()
+
+        self.stdout.write(self.style.SUCCESS('Rendered the tiles of {} risk maps'.format(len(raster_layers))))
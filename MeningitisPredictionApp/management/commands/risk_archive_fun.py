@@ -0,0 +1,187 @@
+from netCDF4 import Dataset
+import rasterio
+from rasterio.crs import CRS
+from affine import Affine
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+import numpy as np
+import fcntl
+import re
+import os
+
+from .data_processing_fun import Raster, Grid, read_grid, regrid, RISK_MAP_NODATA
+
+
+# Archive of all risk maps: one netCDF4 datacube (time x lat x lon) with a variable per product,
+#   week1 - map of the week starting at time, computed from the GEOS-FP analysis of the previous week
+#   week2 - forecast of the week starting at time, computed from the ECMWF ensemble one week earlier
+#   week3 - forecast of the week starting at time, computed from the ECMWF ensemble two weeks earlier (only when the
+#           horizon is configured, see ECMWF_FORECAST_HORIZONS)
+# time is the first day of the week a map is valid for (days since 1970-01-01), so the maps of all products of the
+# same week share a time index. The levels are uint8 (255 = no level), compressed in chunks of
+# ARCHIVE_TIME_CHUNK days x ARCHIVE_SPACE_CHUNK x ARCHIVE_SPACE_CHUNK pixels: the time series of a pixel and the map
+# of a week are each a few chunk reads. Products that are not in ARCHIVE_PRODUCTS (other forecast horizons) and
+# products of archives created before they existed get their variables with their first map
+ARCHIVE_PRODUCTS = ('week1', 'week2', 'week3')
+ARCHIVE_TIME_CHUNK = 32
+ARCHIVE_SPACE_CHUNK = 64
+ARCHIVE_EPOCH = date(1970, 1, 1)
+
+# Risk_map_week1_20240507-20240513.tif, Risk_map_week1_20240507-20240513_HfBEix4.tif (django upload duplicates),
+# Risk_map_week1_20240507-20240513_dione-v1.tif (recomputed with a rule set), ...
+RISK_MAP_FILE_NAME = re.compile(r'^Risk_map_(week\d+)_(\d{8})-(\d{8})(?:_[\w.-]+)?\.tif$')
+
+
+# Context manager that holds a lock on the sidecar lock file of an archive: exclusive for the processes that write it
+# (publish of generate_risk_map, backfill_risk_archive, the archive phase of backfill_risk_maps), shared for readers,
+# so only one process at a time appends to the netCDF file and nobody reads it half written
+@contextmanager
+def archive_lock(archive_file, exclusive=True):
+    os.makedirs(os.path.dirname(archive_file) or '.', exist_ok=True)
+    with open(archive_file + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def archive_day(day):
+    return (day - ARCHIVE_EPOCH).days
+
+
+def archive_date(days):
+    return ARCHIVE_EPOCH + timedelta(days=int(days))
+
+
+# Function that returns the product and the first valid day of a risk map file name, None for other files
+# (inputs, ensemble statistics, ...)
+def parse_risk_map_file_name(file_name):
+    match = RISK_MAP_FILE_NAME.match(file_name)
+    if match is None or file_name.endswith(('_inputs.tif', '_ensemble.tif')):
+        return None
+    return match.group(1), datetime.strptime(match.group(2), '%Y%m%d').date()
+
+
+# Function that creates an empty archive on the grid of the risk maps
+def create_archive(archive_file, grid):
+    height, width = grid.shape
+    transform = grid.transform
+    os.makedirs(os.path.dirname(archive_file) or '.', exist_ok=True)
+    with Dataset(archive_file, 'w', format='NETCDF4') as archive:
+        archive.createDimension('time', None)
+        archive.createDimension('lat', height)
+        archive.createDimension('lon', width)
+
+        time = archive.createVariable('time', 'i4', ('time',))
+        time.units = 'days since 1970-01-01'
+        time.long_name = 'first day of the week the maps are valid for'
+        lat = archive.createVariable('lat', 'f8', ('lat',))
+        lat[:] = transform.f + transform.e * (np.arange(height) + 0.5)
+        lon = archive.createVariable('lon', 'f8', ('lon',))
+        lon[:] = transform.c + transform.a * (np.arange(width) + 0.5)
+
+        for product in ARCHIVE_PRODUCTS:
+            create_product(archive, product)
+
+        archive.crs = grid.crs.to_wkt()
+        archive.geotransform = ' '.join(repr(value) for value in tuple(transform)[:6])
+
+
+# Function that adds the variables of a product to an archive
+def create_product(archive, product):
+    height, width = len(archive.dimensions['lat']), len(archive.dimensions['lon'])
+    levels = archive.createVariable(product, 'u1', ('time', 'lat', 'lon'), zlib=True, complevel=4, fill_value=RISK_MAP_NODATA,
+                                    chunksizes=(ARCHIVE_TIME_CHUNK, min(ARCHIVE_SPACE_CHUNK, height), min(ARCHIVE_SPACE_CHUNK, width)))
+    levels.long_name = 'vigilance level ({} map)'.format(product)
+    # whether the product has a map of the week, the other products may have one when this one has not
+    archived = archive.createVariable(product + '_archived', 'u1', ('time',), fill_value=0)
+    archived.long_name = '1 if the {} map of the week is archived'.format(product)
+
+
+# Function that returns the grid of an archive
+def archive_grid(archive):
+    return Grid(Affine(*(float(value) for value in archive.geotransform.split())),
+                (len(archive.dimensions['lat']), len(archive.dimensions['lon'])), CRS.from_wkt(archive.crs))
+
+
+# Function that reads a risk map file as uint8 levels on the grid of the archive (maps on another grid, e.g. from
+# before the common grid was introduced, are regridded with nearest neighbour)
+def read_archive_levels(risk_map_file, grid, regrid_cache_dir=None):
+    with rasterio.open(risk_map_file) as src:
+        levels = src.read(1)
+        nodata = src.nodata
+        raster = Raster(levels, src.transform, src.crs, nodata)
+
+    if nodata is not None and nodata != RISK_MAP_NODATA:
+        levels = np.where(levels == nodata, RISK_MAP_NODATA, levels)
+    raster = Raster(levels.astype(np.uint8), raster.transform, raster.crs, RISK_MAP_NODATA)
+    if (raster.transform, raster.array.shape) != (grid.transform, grid.shape):
+        raster = regrid(raster, grid, 'nearest', regrid_cache_dir)
+    return raster.array
+
+
+# Function that adds a risk map to the archive. A new archive is created on the given grid (the grid of the map by
+# default). A map of a product and week that is already archived is replaced, so archiving the same map again does
+# not add anything
+def append_risk_map(archive_file, product, first_day, risk_map_file, grid=None, regrid_cache_dir=None):
+    with archive_lock(archive_file):
+        if not os.path.exists(archive_file):
+            create_archive(archive_file, grid or read_grid(risk_map_file))
+
+        with Dataset(archive_file, 'a') as archive:
+            levels = read_archive_levels(risk_map_file, archive_grid(archive), regrid_cache_dir)
+            if product not in archive.variables:
+                create_product(archive, product)
+            times = archive.variables['time'][:]
+            position = np.nonzero(times == archive_day(first_day))[0]
+            if position.size:
+                position = int(position[0])
+            else:
+                position = len(times)
+                archive.variables['time'][position] = archive_day(first_day)
+            archive.variables[product][position] = levels
+            archive.variables[product + '_archived'][position] = 1
+
+
+# Function that returns the positions and dates of the weeks from start to end (inclusive) with a map of the product,
+# in date order
+def archive_weeks(archive, product, start, end):
+    # the products are the variables with an _archived flag (week1 and the configured forecast horizons)
+    if product not in archive.variables or product + '_archived' not in archive.variables:
+        raise ValueError('there are no {} maps in the archive'.format(product))
+    times = np.asarray(archive.variables['time'][:])
+    archived = np.ma.filled(archive.variables[product + '_archived'][:], 0) == 1
+    positions = np.nonzero(archived & (times >= archive_day(start)) & (times <= archive_day(end)))[0]
+    positions = positions[np.argsort(times[positions])]
+    return positions, [archive_date(times[position]) for position in positions]
+
+
+# Function that reads the product for the given time positions, contiguous positions are read in one slice
+def read_archive_slices(variable, positions, rows=slice(None), cols=slice(None)):
+    if len(positions) == 0:
+        return np.empty((0,) + np.broadcast_to(0, variable.shape[1:])[rows, cols].shape, dtype=np.uint8)
+    first, last = int(positions.min()), int(positions.max())
+    block = np.ma.filled(variable[first:last + 1, rows, cols], RISK_MAP_NODATA)
+    return block[positions - first]
+
+
+# Function that returns the levels of a product at a point (lon, lat) from start to end: [(date, level or None)]
+def archive_time_series(archive_file, product, lon, lat, start, end):
+    with archive_lock(archive_file, exclusive=False), Dataset(archive_file, 'r') as archive:
+        grid = archive_grid(archive)
+        col, row = (int(np.floor(value)) for value in ~grid.transform * (lon, lat))
+        if not (0 <= row < grid.shape[0] and 0 <= col < grid.shape[1]):
+            raise ValueError('{}, {} is outside of the archive'.format(lon, lat))
+        positions, dates = archive_weeks(archive, product, start, end)
+        levels = read_archive_slices(archive.variables[product], positions, row, col)
+    return [(day, int(level) if level != RISK_MAP_NODATA else None) for day, level in zip(dates, levels)]
+
+
+# Function that returns the maps of a product from start to end: the dates, the (time, lat, lon) levels and the grid
+def archive_maps(archive_file, product, start, end):
+    with archive_lock(archive_file, exclusive=False), Dataset(archive_file, 'r') as archive:
+        grid = archive_grid(archive)
+        positions, dates = archive_weeks(archive, product, start, end)
+        levels = read_archive_slices(archive.variables[product], positions)
+    return dates, levels, grid
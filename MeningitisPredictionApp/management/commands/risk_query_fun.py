@@ -0,0 +1,190 @@
+import rasterio
+from rasterio.features import geometry_mask, bounds
+from rasterio.warp import transform as transform_coordinates, transform_geom
+from rasterio.windows import Window, from_bounds
+from affine import Affine
+from collections import namedtuple, OrderedDict
+import numpy as np
+import hashlib
+import json
+import math
+import os
+
+from .workspace_fun import temporary_path
+
+
+# Risk maps prepared for queries: the levels as a memory mapped uint8 array (read from an uncompressed .npy copy of the
+# COG, so a lookup only touches the pages of the pixels it reads) plus the georeferencing
+RiskIndex = namedtuple('RiskIndex', ['array', 'transform', 'crs', 'nodata'])
+
+# coordinates of the queries are longitude/latitude
+QUERY_CRS = 'EPSG:4326'
+
+# risk indexes opened by this process by risk map file, with the copy they were read from: a newer copy of the same file
+# replaces the entry, and only the RISK_INDEX_CACHE_SIZE most recently queried maps stay open, so the memory maps of
+# copies that were removed are released (and their disk space freed)
+RISK_INDEX_CACHE_SIZE = 8
+risk_indexes = OrderedDict()
+
+
+# Function that returns the files of the query copy of a risk map
+def risk_index_files(raster_file, cache_dir):
+    stat = os.stat(raster_file)
+    name = '{}-{}-{}'.format(os.path.splitext(os.path.basename(raster_file))[0], stat.st_mtime_ns, stat.st_size)
+    return os.path.join(cache_dir, name + '.npy'), os.path.join(cache_dir, name + '.json')
+
+
+# Function that returns the RiskIndex of a risk map file. The first call writes the uncompressed copy to cache_dir
+# (older copies of the same file are removed), later calls in the same process return the opened index
+# Several web workers may build the same copy at once: both files are written to temporary names of their own and
+# renamed into place, so a copy another worker has memory mapped is never rewritten (a removed older copy stays
+# readable for the processes that have it mapped)
+def risk_index(raster_file, cache_dir):
+    array_file, meta_file = risk_index_files(raster_file, cache_dir)
+    if raster_file in risk_indexes and risk_indexes[raster_file][0] == array_file:
+        risk_indexes.move_to_end(raster_file)
+        return risk_indexes[raster_file][1]
+
+    if not os.path.exists(meta_file):
+        os.makedirs(cache_dir, exist_ok=True)
+        prefix = os.path.splitext(os.path.basename(raster_file))[0] + '-'
+        current = (os.path.basename(array_file), os.path.basename(meta_file))
+        for file_name in os.listdir(cache_dir):
+            # older copies only, not the current one or the temporary files of other workers
+            if file_name in current or '.tmp' in file_name:
+                continue
+            if file_name.startswith(prefix) and file_name.rsplit('-', 2)[0] + '-' == prefix:
+                try:
+                    os.remove(os.path.join(cache_dir, file_name))
+                except FileNotFoundError:
+                    pass
+
+        with rasterio.open(raster_file) as src:
+            temporary_array_file = temporary_path(array_file, '.npy')
+            np.save(temporary_array_file, src.read(1))
+            meta = {'transform': list(src.transform)[:6], 'crs': src.crs.to_string(), 'nodata': src.nodata}
+        os.replace(temporary_array_file, array_file)
+        # the metadata is written last, a copy without it is never used
+        temporary_meta_file = temporary_path(meta_file)
+        with open(temporary_meta_file, 'w') as meta_output:
+            json.dump(meta, meta_output)
+        os.replace(temporary_meta_file, meta_file)
+
+    with open(meta_file) as meta_input:
+        meta = json.load(meta_input)
+    index = RiskIndex(np.load(array_file, mmap_mode='r'), Affine(*meta['transform']), meta['crs'], meta['nodata'])
+    risk_indexes.pop(raster_file, None)
+    risk_indexes[raster_file] = (array_file, index)
+    if len(risk_indexes) > RISK_INDEX_CACHE_SIZE:
+        risk_indexes.popitem(last=False)
+    return index
+
+
+# Function that returns the row and column of the pixels containing the given longitudes/latitudes (arrays),
+# and whether they are inside of the raster
+def point_pixels(index, lons, lats):
+    xs, ys = np.asarray(lons, dtype=np.float64), np.asarray(lats, dtype=np.float64)
+    if index.crs != QUERY_CRS:
+        xs, ys = (np.asarray(values) for values in transform_coordinates(QUERY_CRS, index.crs, xs, ys))
+    cols, rows = ~index.transform * (xs, ys)
+    rows = np.floor(rows).astype(np.int64)
+    cols = np.floor(cols).astype(np.int64)
+    inside = (rows >= 0) & (rows < index.array.shape[0]) & (cols >= 0) & (cols < index.array.shape[1])
+    return rows, cols, inside
+
+
+# Function that returns the risk level at every point, None for points outside of the map or without a level
+def point_levels(index, lons, lats):
+    rows, cols, inside = point_pixels(index, lons, lats)
+    levels = np.full(rows.shape, -1, dtype=np.int64)
+    levels[inside] = index.array[rows[inside], cols[inside]]
+    if index.nodata is not None:
+        levels[levels == index.nodata] = -1
+    return [int(level) if level >= 0 else None for level in levels]
+
+
+# number of regions whose pixels are kept per process
+REGION_CACHE_SIZE = 4096
+region_pixel_cache = OrderedDict()
+
+
+# Function that returns the flat indices of the pixels of a risk map grid whose centers are inside of a region
+# (a GeoJSON geometry in longitude/latitude), the zone of the region on that grid. Zones are computed once per region
+# and grid, so repeated queries for the same health districts only index the array
+def region_pixels(index, geometry, all_touched=False):
+    key = (hashlib.sha1(json.dumps(geometry, sort_keys=True).encode()).hexdigest(), index.transform, index.array.shape, index.crs, all_touched)
+    if key in region_pixel_cache:
+        region_pixel_cache.move_to_end(key)
+        return region_pixel_cache[key]
+
+    if index.crs != QUERY_CRS:
+        geometry = transform_geom(QUERY_CRS, index.crs, geometry)
+    height, width = index.array.shape
+    # only the pixels of the bounding box of the region are rasterized
+    window = from_bounds(*bounds(geometry), transform=index.transform)
+    row_start, row_stop = max(0, math.floor(window.row_off)), min(height, math.ceil(window.row_off + window.height))
+    col_start, col_stop = max(0, math.floor(window.col_off)), min(width, math.ceil(window.col_off + window.width))
+
+    if row_start >= row_stop or col_start >= col_stop:
+        pixels = np.empty(0, dtype=np.int64)
+    else:
+        window = Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+        inside = ~geometry_mask([geometry], out_shape=(window.height, window.width),
+                                transform=rasterio.windows.transform(window, index.transform), all_touched=all_touched)
+        rows, cols = np.nonzero(inside)
+        pixels = (rows + row_start) * width + (cols + col_start)
+
+    region_pixel_cache[key] = pixels
+    if len(region_pixel_cache) > REGION_CACHE_SIZE:
+        region_pixel_cache.popitem(last=False)
+    return pixels
+
+
+# Function that returns the histogram of the risk levels in a region (level -> number of pixels, nodata excluded)
+# and its majority level (the lowest level on a tie, None without pixels)
+def region_levels(index, geometry, all_touched=False):
+    levels = index.array.reshape(-1)[region_pixels(index, geometry, all_touched)]
+    counts = np.bincount(levels, minlength=256)
+    if index.nodata is not None:
+        counts[int(index.nodata)] = 0
+    histogram = {int(level): int(counts[level]) for level in np.nonzero(counts)[0]}
+    majority = int(np.argmax(counts)) if histogram else None
+    return {'histogram': histogram, 'majority': majority, 'pixels': int(counts.sum())}
+
+
+# Function that answers a query of points ([lon, lat] pairs) and/or regions (GeoJSON geometries) for every risk map
+# layers are (id, name, file) of the risk maps
+def query_risk_maps(layers, cache_dir, points=(), regions=(), all_touched=False):
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    results = []
+    for layer_id, name, raster_file in layers:
+        index = risk_index(raster_file, cache_dir)
+        result = {'id': layer_id, 'name': name}
+        if len(points):
+            result['points'] = point_levels(index, points[:, 0], points[:, 1])
+        if len(regions):
+            result['regions'] = [region_levels(index, geometry, all_touched) for geometry in regions]
+        results.append(result)
+    return results
+
+
+# Function that returns the points and region geometries of a query from GeoJSON geometries or features
+def split_query_geometries(geometries):
+    points = []
+    regions = []
+    for geometry in geometries:
+        if geometry.get('type') == 'Feature':
+            geometry = geometry['geometry']
+        if geometry['type'] == 'Point':
+            points.append(geometry['coordinates'][:2])
+        elif geometry['type'] in ('Polygon', 'MultiPolygon'):
+            regions.append(geometry)
+        else:
+            raise ValueError('unsupported geometry type {}'.format(geometry['type']))
+    return points, regions
+
+
+# Function that returns the (id, name, file) of the raster layers that have a risk map file
+def risk_query_layers(raster_layers):
+    return [(raster_layer.id, raster_layer.name, raster_layer.rasterfile.path) for raster_layer in raster_layers
+            if raster_layer.rasterfile and os.path.exists(raster_layer.rasterfile.path)]
@@ -0,0 +1,166 @@
+import rasterio
+from rasterio.features import shapes
+from rasterio.warp import reproject, Resampling
+from affine import Affine
+from shapely.geometry import shape, mapping
+import shapely
+import numpy as np
+from raster.utils import band_data_to_image
+import hashlib
+import shutil
+import json
+import gzip
+import math
+import os
+
+from .tile_cache_fun import native_zoom
+from .instrumentation_fun import instrumented
+from .workspace_fun import temporary_path
+
+
+# Vector risk zones: every risk map is polygonized into one dissolved MultiPolygon per vigilance level, for every zoom
+# level from 0 to the native zoom level of the map, and stored as compact GeoJSON in a content addressed cache
+#   <cache_dir>/<zone set>/index.json         layer and zoom levels of the zone set
+#   <cache_dir>/<zone set>/<z>.geojson.gz     the zones of zoom level z, gzipped
+# The zones are generalized in the raster: the map is resampled (mode, the levels are categories) to the pixel size
+# of the zoom level before it is polygonized, so the zones of all levels still share their borders exactly (no gaps
+# or overlaps between neighbouring zones, unlike simplifying every polygon on its own). The zone set name is the
+# sha256 of the map, the colormap and the zoom levels, like the tile sets of tile_cache_fun
+
+# increase when the zone files change, so the zone sets are built again
+ZONE_SET_VERSION = 1
+
+# pixel size (degrees of longitude) of a 256 pixel web mercator tile at zoom level 0
+ZOOM0_PIXEL_DEGREES = 360 / 256
+
+
+def zone_set_path(cache_dir, zone_set):
+    return os.path.join(cache_dir, zone_set)
+
+
+def zone_file_path(cache_dir, zone_set, zoom):
+    return os.path.join(cache_dir, zone_set, '{}.geojson.gz'.format(zoom))
+
+
+# Function that returns the name of the zone set of a raster file with a colormap
+def zone_set_name(raster_file, colormap, zoom_levels):
+    checksum = hashlib.sha256()
+    with open(raster_file, 'rb') as raster:
+        for chunk in iter(lambda: raster.read(2**20), b''):
+            checksum.update(chunk)
+    checksum.update(json.dumps([colormap, zoom_levels, ZONE_SET_VERSION], sort_keys=True, default=str).encode())
+    return checksum.hexdigest()
+
+
+# Function that returns the colors of the levels as '#rrggbb', with the same colors as the django-raster tiles
+def level_colors(levels, colormap):
+    levels = np.asarray(levels).reshape(-1, 1)
+    img, _ = band_data_to_image(np.ma.masked_array(levels), colormap)
+    return {int(level): '#{:02x}{:02x}{:02x}'.format(*rgba[:3]) for level, rgba in zip(levels.ravel(), np.asarray(img).reshape(-1, 4))}
+
+
+# Function that resamples a risk map (mode) to the pixel size of a zoom level and returns (data, transform), maps
+# whose pixels are smaller than the ones of the zoom level are returned as they are
+@instrumented
+def generalize_risk_map(data, transform, crs, nodata, zoom):
+    factor = ZOOM0_PIXEL_DEGREES / 2**zoom / abs(transform.a)
+    if factor <= 1:
+        return data, transform
+    height = max(1, int(math.ceil(data.shape[0] / factor)))
+    width = max(1, int(math.ceil(data.shape[1] / factor)))
+    generalized_transform = transform * Affine.scale(data.shape[1] / width, data.shape[0] / height)
+    generalized = np.full((height, width), nodata, dtype=data.dtype)
+    reproject(data, generalized, src_transform=transform, src_crs=crs, src_nodata=nodata,
+              dst_transform=generalized_transform, dst_crs=crs, dst_nodata=nodata, resampling=Resampling.mode)
+    return generalized, generalized_transform
+
+
+# Function that polygonizes a risk map into one GeoJSON feature per level: the regions of the level dissolved into
+# one MultiPolygon, without the vertices on straight borders, coordinates rounded to a tenth of a pixel
+@instrumented
+def polygonize_zones(data, transform, nodata, colors):
+    regions = {}
+    for geometry, level in shapes(data, mask=data != nodata, transform=transform):
+        regions.setdefault(int(level), []).append(shape(geometry))
+
+    decimals = max(0, int(math.ceil(-math.log10(abs(transform.a) / 10))))
+    features = []
+    for level in sorted(regions):
+        zone = shapely.simplify(shapely.union_all(regions[level]), 0)
+        zone = shapely.set_precision(zone, 10**-decimals)
+        features.append({'type': 'Feature', 'properties': {'level': level, 'color': colors.get(level)}, 'geometry': mapping(zone)})
+    return features
+
+
+def write_zone_file(features, zoom, output_file):
+    collection = {'type': 'FeatureCollection', 'zoom': zoom, 'features': features}
+    data = json.dumps(collection, separators=(',', ':')).encode()
+    # written to a temporary file of its own first, so the zones are never served half written (builds of the same map
+    # at the same time write the same files)
+    temporary = temporary_path(output_file)
+    with gzip.open(temporary, 'wb', compresslevel=9) as output:
+        output.write(data)
+    os.replace(temporary, output_file)
+    return len(data)
+
+
+# Function that builds the zone set of a risk map file for zoom levels 0 to the native zoom level of the map
+# Returns the name of the zone set; a map that was polygonized before is not polygonized again
+def build_zone_set(raster_file, colormap, cache_dir, layer_id=None):
+    with rasterio.open(raster_file) as src:
+        data = src.read(1)
+        transform, crs, nodata = src.transform, src.crs, src.nodata
+        zoom_levels = list(range(native_zoom(src) + 1))
+    zone_set = zone_set_name(raster_file, colormap, zoom_levels)
+    index_path = os.path.join(zone_set_path(cache_dir, zone_set), 'index.json')
+    if os.path.exists(index_path):
+        return zone_set
+
+    os.makedirs(zone_set_path(cache_dir, zone_set), exist_ok=True)
+    colors = level_colors(np.unique(data[data != nodata]), colormap)
+    sizes = []
+    for zoom in zoom_levels:
+        generalized, generalized_transform = generalize_risk_map(data, transform, crs, nodata, zoom)
+        features = polygonize_zones(generalized, generalized_transform, nodata, colors)
+        write_zone_file(features, zoom, zone_file_path(cache_dir, zone_set, zoom))
+        sizes.append(os.path.getsize(zone_file_path(cache_dir, zone_set, zoom)))
+
+    temporary = temporary_path(index_path)
+    with open(temporary, 'w') as index_file:
+        json.dump({'layer': layer_id, 'zoom_levels': zoom_levels}, index_file)
+    os.replace(temporary, index_path)
+
+    print('polygonized {} into zones for zoom levels 0-{} ({:.1f} kB gzipped)'.format(
+        os.path.basename(raster_file), zoom_levels[-1], sum(sizes) / 10**3))
+    return zone_set
+
+
+# zone set indexes read by this process, by name
+zone_set_indexes = {}
+
+
+# Function that returns the index of a zone set, or None if it is not in the cache (any more)
+# the zone set may have been evicted by another process since this process read its index
+def read_zone_set(cache_dir, zone_set):
+    index_path = os.path.join(zone_set_path(cache_dir, zone_set), 'index.json')
+    if not os.path.exists(index_path):
+        zone_set_indexes.pop(zone_set, None)
+        return None
+    if zone_set not in zone_set_indexes:
+        with open(index_path) as index_file:
+            zone_set_indexes[zone_set] = json.load(index_file)
+    return zone_set_indexes[zone_set]
+
+
+# Function that removes the zone sets that are not in keep (the zone sets of the stored risk maps)
+# Returns the names of the removed zone sets
+def evict_zone_sets(cache_dir, keep):
+    if not os.path.isdir(cache_dir):
+        return []
+    evicted = [zone_set for zone_set in os.listdir(cache_dir) if zone_set not in keep and os.path.isdir(zone_set_path(cache_dir, zone_set))]
+    for zone_set in evicted:
+        shutil.rmtree(zone_set_path(cache_dir, zone_set))
+        zone_set_indexes.pop(zone_set, None)
+    if evicted:
+        print('removed {} zone sets of replaced risk maps'.format(len(evicted)))
+    return evicted
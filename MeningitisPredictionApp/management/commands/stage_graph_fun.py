@@ -0,0 +1,115 @@
+from collections import namedtuple
+from datetime import datetime, timedelta
+import hashlib
+import pickle
+import shutil
+import json
+import time
+import os
+
+from .instrumentation_fun import measure_stage, describe_value
+from .workspace_fun import temporary_path
+
+
+# Output of a stage of the risk map job: its value and the content hash of that value (of the files, for stages that
+# produce files). The hashes of the inputs of a stage are part of its key, so a stage only runs again when an input
+# really changed, not when an upstream stage was merely rerun
+StageOutput = namedtuple('StageOutput', ['value', 'hash'])
+
+# part of every stage key, increase it when the processing code changes in a way that changes the outputs
+STAGE_VERSION = 1
+
+
+# Function that returns the key of a stage: a hash of its name, parameters and the content hashes of its inputs
+def stage_key(name, params, input_hashes):
+    key = json.dumps([STAGE_VERSION, name, [repr(param) for param in params], list(input_hashes)])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def file_hash(file_path):
+    checksum = hashlib.sha256()
+    with open(file_path, 'rb') as content:
+        for chunk in iter(lambda: content.read(2**20), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+# the size and modification time of a file, to notice that a produced file was changed or removed after the stage ran
+def file_stamp(file_path):
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+# Function that stores the output of a stage and returns it as a StageOutput
+# values are pickled (the hash is the one of the pickle), for stages that produce files the value is the path or a
+# tuple of paths and the hash is the one of their contents
+def save_stage_record(record_file, value, files):
+    if files:
+        paths = [value] if isinstance(value, str) else list(value)
+        stamps = [file_stamp(path) for path in paths]
+        output_hash = hashlib.sha256(''.join(file_hash(path) for path in paths).encode()).hexdigest()
+        record = pickle.dumps({'value': value, 'hash': output_hash, 'stamps': stamps})
+    else:
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        output_hash = hashlib.sha256(data).hexdigest()
+        record = pickle.dumps({'value': data, 'hash': output_hash})
+
+    # written to a temporary file first, so a failed run never leaves a broken record
+    temporary_file = temporary_path(record_file)
+    with open(temporary_file, 'wb') as output:
+        output.write(record)
+    os.replace(temporary_file, record_file)
+    return StageOutput(value, output_hash)
+
+
+# Function that loads the output of a stage, None when the files of the stage were changed or removed since
+def load_stage_record(record_file, files):
+    with open(record_file, 'rb') as record_input:
+        record = pickle.load(record_input)
+    if files:
+        paths = [record['value']] if isinstance(record['value'], str) else list(record['value'])
+        if any(not os.path.exists(path) or file_stamp(path) != stamp for path, stamp in zip(paths, record['stamps'])):
+            return None
+        return StageOutput(record['value'], record['hash'])
+    return StageOutput(pickle.loads(record['value']), record['hash'])
+
+
+# Function that runs a stage of the risk map job, or returns its stored output when it already ran with the same
+# parameters and inputs (StageOutputs of upstream stages). function gets the values of the inputs as arguments.
+# A failed stage stores nothing, so a retry of the job runs the failed stage and everything downstream of it again,
+# while the stages that succeeded are read from stage_dir
+def run_stage(stage_dir, name, function, inputs=(), params=(), files=False, force=False):
+    key = stage_key(name, params, [stage_input.hash for stage_input in inputs])
+    record_file = os.path.join(stage_dir, '{}-{}.pkl'.format(name, key[:24]))
+
+    # every stage is measured, also the ones that are read from stage_dir (see instrumentation_fun)
+    with measure_stage(name) as record:
+        output = None
+        if not force and os.path.exists(record_file):
+            output = load_stage_record(record_file, files)
+        if output is not None:
+            record['status'] = 'cached'
+            print('stage {} is up to date'.format(name))
+        else:
+            started = time.monotonic()
+            value = function(*[stage_input.value for stage_input in inputs])
+            os.makedirs(stage_dir, exist_ok=True)
+            output = save_stage_record(record_file, value, files)
+            record['status'] = 'ran'
+            print('ran stage {} in {:.1f} s'.format(name, time.monotonic() - started))
+        record['outputs'] = describe_value(output.value)
+    return output
+
+
+# Function that removes the stage folders (one per forecast date, named YYYYMMDD) older than max_age_days
+def evict_stage_dirs(stages_dir, max_age_days, today):
+    if not os.path.isdir(stages_dir):
+        return
+    cutoff = today - timedelta(days=max_age_days)
+    for folder in os.listdir(stages_dir):
+        try:
+            day = datetime.strptime(folder, '%Y%m%d').date()
+        except ValueError:
+            continue
+        if day < cutoff:
+            shutil.rmtree(os.path.join(stages_dir, folder), ignore_errors=True)
@@ -0,0 +1,230 @@
+import rasterio
+from rasterio.warp import reproject, transform_bounds, Resampling
+from affine import Affine
+import numpy as np
+from PIL import Image
+from raster.tiles.const import WEB_MERCATOR_SRID, WEB_MERCATOR_TILESIZE
+from raster.tiles.utils import tile_bounds, tile_index_range, closest_zoomlevel
+from rasterio.transform import array_bounds
+from raster.utils import band_data_to_image
+from contextlib import contextmanager
+import hashlib
+import fcntl
+import json
+import io
+import os
+
+from .workspace_fun import temporary_path
+
+
+# Pre-rendered risk map tiles are kept in a content addressed cache:
+#   <cache_dir>/blobs/ab/abcdef....png   every distinct tile image once, named by the sha256 of its bytes
+#   <cache_dir>/sets/<tile set>.json     one index per rendered map: z/x/y -> tile image
+# the tile set name is the sha256 of the risk map file and the colormap, so a map is only rendered once per content
+# and the tile urls never change their content (they can be cached by the browser forever)
+# Renders hold a shared lock on <cache_dir>/.lock and evict_tile_sets an exclusive one, so the tile images of a set that
+# is being rendered (and has no index yet) are never evicted
+
+# latitude limit of the web mercator tiles
+WEB_MERCATOR_MAX_LATITUDE = 85.0511287798066
+
+
+def blob_path(cache_dir, digest):
+    return os.path.join(cache_dir, 'blobs', digest[:2], digest + '.png')
+
+
+def tile_set_path(cache_dir, tile_set):
+    return os.path.join(cache_dir, 'sets', tile_set + '.json')
+
+
+# Context manager that holds the lock of a tile cache: shared while tile sets are rendered, exclusive while they are evicted
+@contextmanager
+def tile_cache_lock(cache_dir, exclusive=True):
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, '.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+# Function that stores a tile image in the cache (once per content) and returns its name
+def store_blob(cache_dir, data):
+    digest = hashlib.sha256(data).hexdigest()
+    path = blob_path(cache_dir, digest)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written to a temporary file of its own first, so a tile is never served half written (renders of the same
+        # map at the same time write the same tiles)
+        temporary = temporary_path(path)
+        try:
+            with open(temporary, 'wb') as blob:
+                blob.write(data)
+            os.replace(temporary, path)
+        except OSError:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            # stored by another render in the meantime
+            if not os.path.exists(path):
+                raise
+    return digest
+
+
+# Function that returns the name of the tile set of a raster file rendered with a colormap
+def tile_set_name(raster_file, colormap, max_zoom):
+    checksum = hashlib.sha256()
+    with open(raster_file, 'rb') as raster:
+        for chunk in iter(lambda: raster.read(2**20), b''):
+            checksum.update(chunk)
+    checksum.update(json.dumps(colormap, sort_keys=True, default=str).encode())
+    checksum.update(str(max_zoom).encode())
+    return checksum.hexdigest()
+
+
+# Function that returns the zoom level whose pixels are closest to the pixels of a grid (anything with a transform, shape
+# and crs, e.g. a Grid or an open raster file), the highest zoom level django-raster would create tiles for (a tile
+# of a higher zoom level is warped from it when it is requested)
+def native_zoom(grid):
+    west, south, east, north = array_bounds(grid.shape[0], grid.shape[1], grid.transform)
+    bbox = transform_bounds(grid.crs, 'EPSG:{}'.format(WEB_MERCATOR_SRID), west, max(south, -WEB_MERCATOR_MAX_LATITUDE),
+                            east, min(north, WEB_MERCATOR_MAX_LATITUDE))
+    return closest_zoomlevel((bbox[2] - bbox[0]) / grid.shape[1])
+
+
+# Function that renders one web mercator tile of a raster as png, with the same colors as the django-raster tiles
+# pixels without data are transparent
+def render_tile(data, transform, crs, nodata, colormap, z, x, y):
+    xmin, ymin, xmax, ymax = tile_bounds(x, y, z)
+    scale = (xmax - xmin) / WEB_MERCATOR_TILESIZE
+    tile = np.full((WEB_MERCATOR_TILESIZE, WEB_MERCATOR_TILESIZE), nodata, dtype=data.dtype)
+    reproject(data, tile,
+              src_transform=transform, src_crs=crs, src_nodata=nodata,
+              dst_transform=Affine(scale, 0.0, xmin, 0.0, -scale, ymax), dst_crs='EPSG:{}'.format(WEB_MERCATOR_SRID),
+              dst_nodata=nodata, resampling=Resampling.nearest)
+
+    img, stats = band_data_to_image(np.ma.masked_values(tile, nodata), colormap)
+    return image_to_png(img)
+
+
+# Function that returns a fully transparent tile, like django-raster returns for tiles without data
+def render_empty_tile():
+    return image_to_png(Image.new("RGBA", (WEB_MERCATOR_TILESIZE, WEB_MERCATOR_TILESIZE), (0, 0, 0, 0)))
+
+
+def image_to_png(img):
+    with io.BytesIO() as output:
+        img.save(output, format='PNG')
+        return output.getvalue()
+
+
+# Function that pre-renders the tiles of a raster file from zoom level 0 to max_zoom over the extent of the raster
+# and stores them as a tile set. Tiles that look the same (e.g. fully transparent ones) are stored once.
+# Returns the name of the tile set; a raster that was rendered before is not rendered again
+def prerender_tile_set(raster_file, colormap, cache_dir, max_zoom=8, layer_id=None):
+    with tile_cache_lock(cache_dir, exclusive=False):
+        return render_tile_set(raster_file, colormap, cache_dir, max_zoom, layer_id)
+
+
+def render_tile_set(raster_file, colormap, cache_dir, max_zoom, layer_id):
+    tile_set = tile_set_name(raster_file, colormap, max_zoom)
+    index_path = tile_set_path(cache_dir, tile_set)
+    if os.path.exists(index_path):
+        # mark as recently used
+        os.utime(index_path)
+        return tile_set
+
+    with rasterio.open(raster_file) as src:
+        data = src.read(1)
+        transform, crs, nodata = src.transform, src.crs, src.nodata
+        west, south, east, north = src.bounds
+
+    # extent of the raster in web mercator
+    south = max(south, -WEB_MERCATOR_MAX_LATITUDE)
+    north = min(north, WEB_MERCATOR_MAX_LATITUDE)
+    bbox = transform_bounds(crs, 'EPSG:{}'.format(WEB_MERCATOR_SRID), west, south, east, north)
+
+    tiles = {}
+    for z in range(max_zoom + 1):
+        xmin, ymin, xmax, ymax = tile_index_range(bbox, z)
+        for x in range(xmin, xmax + 1):
+            for y in range(ymin, ymax + 1):
+                tiles['{}/{}/{}'.format(z, x, y)] = store_blob(cache_dir, render_tile(data, transform, crs, nodata, colormap, z, x, y))
+
+    index = {
+        'layer': layer_id,
+        'max_zoom': max_zoom,
+        'tiles': tiles,
+        # served for the tiles outside of the extent of the raster
+        'empty': store_blob(cache_dir, render_empty_tile()),
+    }
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    temporary = temporary_path(index_path)
+    with open(temporary, 'w') as index_file:
+        json.dump(index, index_file)
+    os.replace(temporary, index_path)
+
+    print('rendered {} tiles ({} distinct) of {}'.format(len(tiles), len(set(tiles.values())), os.path.basename(raster_file)))
+    return tile_set
+
+
+# tile set indexes read by this process, by name
+tile_set_indexes = {}
+
+
+# Function that returns the index of a tile set, or None if it is not in the cache (any more)
+# the index may have been evicted by another process (render_risk_map_tiles) since this process read it
+def read_tile_set(cache_dir, tile_set):
+    index_path = tile_set_path(cache_dir, tile_set)
+    if not os.path.exists(index_path):
+        tile_set_indexes.pop(tile_set, None)
+        return None
+    if tile_set not in tile_set_indexes:
+        with open(index_path) as index_file:
+            tile_set_indexes[tile_set] = json.load(index_file)
+        # mark as recently used
+        os.utime(index_path)
+    return tile_set_indexes[tile_set]
+
+
+# Function that evicts the least recently used tile sets until at most max_sets are left, tile sets in keep are never
+# evicted. Tile images that are not used by any remaining tile set are removed as well
+# Returns the names of the evicted tile sets
+def evict_tile_sets(cache_dir, max_sets, keep=()):
+    with tile_cache_lock(cache_dir):
+        return evict_least_recently_used(cache_dir, max_sets, keep)
+
+
+def evict_least_recently_used(cache_dir, max_sets, keep):
+    sets_dir = os.path.join(cache_dir, 'sets')
+    if not os.path.isdir(sets_dir):
+        return []
+
+    tile_sets = sorted((os.path.getmtime(os.path.join(sets_dir, file_name)), file_name[:-len('.json')])
+                       for file_name in os.listdir(sets_dir) if file_name.endswith('.json'))
+    removable = [tile_set for _, tile_set in tile_sets if tile_set not in keep]
+    evicted = removable[:max(0, len(tile_sets) - max_sets)]
+    for tile_set in evicted:
+        os.remove(tile_set_path(cache_dir, tile_set))
+        tile_set_indexes.pop(tile_set, None)
+
+    if not evicted:
+        return evicted
+
+    used = set()
+    for _, tile_set in tile_sets:
+        if tile_set not in evicted:
+            with open(tile_set_path(cache_dir, tile_set)) as index_file:
+                index = json.load(index_file)
+            used.update(index['tiles'].values())
+            used.add(index['empty'])
+
+    removed = 0
+    for folder, _, file_names in os.walk(os.path.join(cache_dir, 'blobs')):
+        for file_name in file_names:
+            if file_name.endswith('.png') and file_name[:-len('.png')] not in used:
+                os.remove(os.path.join(folder, file_name))
+                removed += 1
+
+    print('evicted {} tile sets and {} tile images from the tile cache'.format(len(evicted), removed))
+    return evicted
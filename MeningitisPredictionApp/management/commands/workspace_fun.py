@@ -0,0 +1,113 @@
+from contextlib import contextmanager
+from datetime import datetime
+import tempfile
+import socket
+import shutil
+import uuid
+import json
+import time
+import os
+
+
+# Run workspaces: every run of the risk map job writes its scratch files (ECMWF downloads in progress, the uncompressed
+# risk maps before they are copied into COGs, the rasters of --dump-intermediates) to a folder of its own, so runs at
+# the same time (a manual rerun next to the beat job, the dates of a backfill) never write to the same files
+#   <root>/<name>_<YYYYmmddTHHMMSS>_<random>/owner.json    pid and host of the run, and when it started
+# The root can be on tmpfs (e.g. /dev/shm/risk_map_workspaces), then the scratch files never touch the disk. A workspace
+# is removed when its run ends, the ones of runs that were killed (or kept for debugging) once they are older than the
+# retention and their run is not alive any more. Files that outlive the run are moved out of the workspace with
+# move_into_place.
+
+OWNER_FILE = 'owner.json'
+
+
+# Function that creates the workspace of a run under root and returns its path
+def create_workspace(root, name):
+    os.makedirs(root, exist_ok=True)
+    workspace = tempfile.mkdtemp(prefix='{}_{}_'.format(name, datetime.now().strftime('%Y%m%dT%H%M%S')), dir=root)
+    with open(os.path.join(workspace, OWNER_FILE), 'w') as owner:
+        json.dump({'pid': os.getpid(), 'host': socket.gethostname(), 'started': time.time()}, owner)
+    return workspace
+
+
+# Function that returns the path of a file in a workspace, the folders on the way are created
+def workspace_path(workspace, *parts):
+    path = os.path.join(workspace, *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def remove_workspace(workspace):
+    shutil.rmtree(workspace, ignore_errors=True)
+
+
+# Workspace of a run: created on entry, removed on exit unless keep is set (e.g. to look at the intermediate rasters)
+@contextmanager
+def run_workspace(root, name, keep=False):
+    workspace = create_workspace(root, name)
+    try:
+        yield workspace
+    finally:
+        if keep:
+            print('kept the workspace of the run in {}'.format(workspace))
+        else:
+            remove_workspace(workspace)
+
+
+# Function that tells if the run that created a workspace is still running, runs on other hosts are assumed to be
+def workspace_owner_alive(workspace):
+    try:
+        with open(os.path.join(workspace, OWNER_FILE)) as owner_file:
+            owner = json.load(owner_file)
+    except (OSError, ValueError):
+        return False
+    if owner.get('host') != socket.gethostname():
+        return True
+    try:
+        os.kill(owner['pid'], 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# Function that removes the workspaces under root that are older than max_age_hours and whose run is not alive
+# Returns the number of workspaces and bytes removed
+def evict_workspaces(root, max_age_hours):
+    if not os.path.isdir(root):
+        return 0, 0
+    cutoff = time.time() - max_age_hours * 3600
+    removed = 0
+    removed_bytes = 0
+    for folder in os.listdir(root):
+        workspace = os.path.join(root, folder)
+        if not os.path.isdir(workspace) or os.path.getmtime(workspace) > cutoff or workspace_owner_alive(workspace):
+            continue
+        removed_bytes += sum(os.path.getsize(os.path.join(path, file_name)) for path, _, files in os.walk(workspace) for file_name in files)
+        remove_workspace(workspace)
+        removed += 1
+    if removed:
+        print('removed {} workspaces of earlier runs ({:.1f} MB)'.format(removed, removed_bytes / 10**6))
+    return removed, removed_bytes
+
+
+# Function that returns a temporary path next to a file that no other run uses, for files that are written first and
+# then renamed over the file (os.replace is atomic within one filesystem)
+def temporary_path(path, suffix=''):
+    return '{}.{}.tmp{}'.format(path, uuid.uuid4().hex[:12], suffix)
+
+
+# Function that moves a finished file from a workspace to its place outside of it, readers of the target (and other
+# runs writing it) only ever see a complete file. The workspace may be on another filesystem, then the file is copied
+def move_into_place(source, target):
+    os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+    temporary = temporary_path(target)
+    try:
+        shutil.move(source, temporary)
+        os.replace(temporary, target)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    return target
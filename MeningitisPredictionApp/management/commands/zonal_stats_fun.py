@@ -0,0 +1,123 @@
+import rasterio
+import fiona
+from rasterio.features import rasterize
+from rasterio.warp import reproject, Resampling
+import numpy as np
+import hashlib
+import json
+import math
+import os
+
+from .data_processing_fun import shapefile_checksum
+from .workspace_fun import temporary_path
+
+
+# Vigilance levels that count as high risk in the zonal statistics
+HIGH_RISK_LEVELS = (1, 2, 3)
+
+# levels are uint8, the statistics of every zone are a row of 256 level bins
+LEVEL_BINS = 256
+
+# mean earth radius (km) used for the areas of the pixels of geographic grids
+EARTH_RADIUS_KM = 6371.0088
+
+
+# Function that rasterizes the shapes of a shapefile onto a grid as zone ids: 0 outside of the shapes, i + 1 inside of
+# the i-th feature. Returns the zone raster and the (key, name) of every zone
+def rasterize_zones(shapefile_filepath, transform, shape, key_field, name_field):
+    with fiona.open(shapefile_filepath, 'r') as shapefile:
+        features = [(feature['geometry'], feature['properties'][key_field], feature['properties'][name_field]) for feature in shapefile]
+
+    zones = rasterize([(geometry, zone) for zone, (geometry, _, _) in enumerate(features, start=1)],
+                      out_shape=shape, transform=transform, fill=0, dtype=np.int32)
+    return zones, [(key, name) for _, key, name in features]
+
+
+# Function that returns the zone raster of a shapefile on a grid (see rasterize_zones), rasterized once per grid
+# and version of the shapefile and kept in cache_dir
+def cached_zone_raster(shapefile_filepath, transform, shape, key_field='ISO', name_field='NAME_0', cache_dir=None):
+    key = repr((tuple(transform), tuple(shape), shapefile_checksum(shapefile_filepath), key_field, name_field))
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, 'zones_' + hashlib.sha1(key.encode()).hexdigest() + '.npz')
+
+    if cache_file is not None and os.path.exists(cache_file):
+        cached = np.load(cache_file)
+        return cached['zones'], [tuple(zone) for zone in json.loads(str(cached['zone_names']))]
+
+    zones, zone_names = rasterize_zones(shapefile_filepath, transform, shape, key_field, name_field)
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # written to a temporary file first, so an interrupted run never leaves a broken zone raster in the cache
+        temporary_file = temporary_path(cache_file, '.npz')
+        np.savez_compressed(temporary_file, zones=zones, zone_names=json.dumps(zone_names))
+        os.replace(temporary_file, cache_file)
+    return zones, zone_names
+
+
+# Function that returns the area (km2) of the pixels of every row of a grid: on a geographic grid the pixels get
+# smaller towards the poles, on a projected grid (in meters) they all have the same area
+def pixel_row_areas(transform, height, crs):
+    if crs is None or not crs.is_geographic:
+        return np.full(height, abs(transform.a * transform.e) / 10**6)
+    edges = np.radians(transform.f + transform.e * np.arange(height + 1))
+    return EARTH_RADIUS_KM**2 * math.radians(abs(transform.a)) * np.abs(np.diff(np.sin(edges)))
+
+
+# Function that sums a population raster (people per pixel) onto the grid of the risk map
+# in the same CRS the sum is the average density times the number of source pixels per target pixel, which GDAL
+# computes much faster than the sum resampling
+def population_on_grid(population_file, transform, shape, crs):
+    population = np.zeros(shape, dtype=np.float64)
+    with rasterio.open(population_file) as src:
+        if src.crs == crs:
+            reproject(rasterio.band(src, 1), population, dst_transform=transform, dst_crs=crs,
+                      dst_nodata=0, resampling=Resampling.average)
+            population *= abs(transform.a * transform.e) / abs(src.transform.a * src.transform.e)
+        else:
+            reproject(rasterio.band(src, 1), population, dst_transform=transform, dst_crs=crs,
+                      dst_nodata=0, resampling=Resampling.sum)
+    return population
+
+
+# Function that computes the statistics of a risk map per zone of a shapefile (e.g. per country) with one bincount
+# over (zone, level) per quantity: pixel counts per level, the area at every level and, with a population raster, the
+# population at every level. Returns one dict per zone that has pixels with a level
+def zonal_risk_statistics(risk_map_file, shapefile_filepath, cache_dir=None, population_file=None,
+                          key_field='ISO', name_field='NAME_0', high_levels=HIGH_RISK_LEVELS):
+    with rasterio.open(risk_map_file) as src:
+        levels = src.read(1)
+        transform, crs, nodata = src.transform, src.crs, src.nodata
+
+    zones, zone_names = cached_zone_raster(shapefile_filepath, transform, levels.shape, key_field, name_field, cache_dir)
+    bins = (len(zone_names) + 1) * LEVEL_BINS
+    # pixels without a level go to zone 0 (outside of all shapes), which is not reported
+    index = zones.astype(np.int64) * LEVEL_BINS + levels
+    if nodata is not None:
+        index[levels == nodata] = 0
+    index = index.ravel()
+    areas = np.broadcast_to(pixel_row_areas(transform, levels.shape[0], crs)[:, np.newaxis], levels.shape).ravel()
+
+    counts = np.bincount(index, minlength=bins).reshape(-1, LEVEL_BINS)
+    level_areas = np.bincount(index, weights=areas, minlength=bins).reshape(-1, LEVEL_BINS)
+    level_population = None
+    if population_file is not None:
+        population = population_on_grid(population_file, transform, levels.shape, crs)
+        level_population = np.bincount(index, weights=population.ravel(), minlength=bins).reshape(-1, LEVEL_BINS)
+
+    high = list(high_levels)
+    statistics = []
+    # zone 0 is outside of all shapes
+    for zone, (key, name) in enumerate(zone_names, start=1):
+        if counts[zone].sum() == 0:
+            continue
+        total_area = level_areas[zone].sum()
+        statistics.append({
+            'key': key,
+            'name': name,
+            'level_counts': {int(level): int(counts[zone, level]) for level in np.nonzero(counts[zone])[0]},
+            'area_km2': float(total_area),
+            'high_risk_share': float(level_areas[zone, high].sum() / total_area),
+            'population_at_risk': float(level_population[zone, high].sum()) if level_population is not None else None,
+        })
+    return statistics
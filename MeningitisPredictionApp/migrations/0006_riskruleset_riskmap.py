@@ -0,0 +1,63 @@
+# Generated by Django 4.1 on 2026-10-17 11:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("raster", "__first__"),
+        ("MeningitisPredictionApp", "0005_article_articlesubtitle"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RiskRuleSet",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("version", models.CharField(max_length=50, unique=True)),
+                ("description", models.TextField(blank=True, null=True)),
+                ("rules", models.JSONField()),
+                ("isActive", models.BooleanField(default=False)),
+                ("created", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="RiskMap",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("inputsFile", models.CharField(blank=True, max_length=255, null=True)),
+                (
+                    "rasterLayer",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="riskMap",
+                        to="raster.rasterlayer",
+                    ),
+                ),
+                (
+                    "ruleSet",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.PROTECT,
+                        to="MeningitisPredictionApp.riskruleset",
+                    ),
+                ),
+            ],
+        ),
+    ]
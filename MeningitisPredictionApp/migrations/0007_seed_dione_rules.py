@@ -0,0 +1,44 @@
+# Generated by Django 4.1 on 2026-10-17 11:20
+
+from django.db import migrations
+
+
+# The vigilance levels of Dione et al. as they were hardcoded in compute_risk_map
+DIONE_V1_RULES = [
+    {"level": 1, "conditions": [["t2m", ">=", 30], ["rh", "<=", 20], ["sdc", ">=", 400]]},
+    {"level": 2, "conditions": [["t2m", ">", 27], ["t2m", "<", 30], ["rh", "<=", 20], ["sdc", ">=", 400]]},
+    {"level": 3, "conditions": [["t2m", ">=", 30], ["rh", "<=", 20], ["sdc", ">", 150], ["sdc", "<", 400]]},
+    {"level": 4, "conditions": [["t2m", ">=", 30], ["rh", ">", 40], ["rh", "<=", 60], ["sdc", ">=", 400]]},
+    {"level": 5, "conditions": [["t2m", ">", 27], ["t2m", "<", 30], ["rh", ">", 20], ["rh", "<=", 40], ["sdc", ">", 150], ["sdc", "<", 400]]},
+    {"level": 6, "conditions": [["t2m", ">", 27], ["rh", "<", 60], ["sdc", "<", 150]]},
+    {"level": 7, "conditions": [["t2m", ">", 27], ["rh", ">", 40], ["rh", "<=", 60], ["sdc", ">", 150], ["sdc", "<", 400]]},
+    {"level": 8, "conditions": [["rh", ">", 60]]},
+    {"level": 9, "conditions": [["t2m", "<", 27]]},
+]
+
+
+def create_dione_v1(apps, schema_editor):
+    RiskRuleSet = apps.get_model("MeningitisPredictionApp", "RiskRuleSet")
+    RiskRuleSet.objects.get_or_create(
+        version="dione-v1",
+        defaults={
+            "description": "Vigilance levels 1-9 of Dione et al.",
+            "rules": DIONE_V1_RULES,
+            "isActive": True,
+        },
+    )
+
+
+def delete_dione_v1(apps, schema_editor):
+    RiskRuleSet = apps.get_model("MeningitisPredictionApp", "RiskRuleSet")
+    RiskRuleSet.objects.filter(version="dione-v1").delete()
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("MeningitisPredictionApp", "0006_riskruleset_riskmap"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_dione_v1, delete_dione_v1),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.1 on 2026-10-17 14:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("MeningitisPredictionApp", "0007_seed_dione_rules"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="riskmap",
+            name="ensembleFile",
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+    ]
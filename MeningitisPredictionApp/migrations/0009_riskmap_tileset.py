@@ -0,0 +1,17 @@
+# Generated by Django 4.1 on 2026-10-17 15:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("MeningitisPredictionApp", "0008_riskmap_ensemblefile"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="riskmap",
+            name="tileSet",
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.1 on 2026-10-17 11:35
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("raster", "__first__"),
+        ("MeningitisPredictionApp", "0009_riskmap_tileset"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ZonalRiskStatistics",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("zoneKey", models.CharField(max_length=32)),
+                ("zoneName", models.CharField(blank=True, max_length=255, null=True)),
+                ("levelCounts", models.JSONField()),
+                ("areaKm2", models.FloatField()),
+                ("highRiskShare", models.FloatField()),
+                ("populationAtRisk", models.FloatField(blank=True, null=True)),
+                (
+                    "rasterLayer",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="zonalStatistics",
+                        to="raster.rasterlayer",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("rasterLayer", "zoneKey")},
+            },
+        ),
+    ]
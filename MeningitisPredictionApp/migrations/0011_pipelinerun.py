@@ -0,0 +1,41 @@
+# Generated by Django 4.1 on 2026-10-17 11:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("MeningitisPredictionApp", "0010_zonalriskstatistics"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PipelineRun",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=50)),
+                ("started", models.DateTimeField()),
+                ("finished", models.DateTimeField()),
+                ("status", models.CharField(max_length=20)),
+                ("wallSeconds", models.FloatField()),
+                ("cpuSeconds", models.FloatField()),
+                ("peakRssBytes", models.BigIntegerField()),
+                ("bytesRead", models.BigIntegerField()),
+                ("bytesWritten", models.BigIntegerField()),
+                ("networkBytes", models.JSONField(default=dict)),
+                ("stages", models.JSONField(default=list)),
+                ("functions", models.JSONField(default=dict)),
+            ],
+            options={
+                "ordering": ["-started"],
+            },
+        ),
+    ]
@@ -1,5 +1,6 @@
 from django.db import models
 from django.contrib.gis.db import models as geomodels
+from raster.models import RasterLayer
 #from raster import models as rastermodels
 
 #class Maps(models.Model):
@@ -14,3 +15,76 @@ class Article(models.Model):
   articleSubtitle = models.CharField(null=True, blank=True, max_length=255)
   articleContent = models.TextField()
   articleImage = models.ImageField(null=True, blank=True, upload_to="static/")
+
+# Versioned rule table for the vigilance levels (Dione et al.)
+# rules = [{"level": 1, "conditions": [["t2m", ">=", 30], ["rh", "<=", 20], ["sdc", ">=", 400]]}, ...]
+# applied in order, a pixel that meets several rules gets the level of the last one
+class RiskRuleSet(models.Model):
+  version = models.CharField(max_length=50, unique=True)
+  description = models.TextField(null=True, blank=True)
+  rules = models.JSONField()
+  isActive = models.BooleanField(default=False)
+  created = models.DateTimeField(auto_now_add=True)
+
+  def __str__(self):
+    return self.version
+
+  # the rule set used for new risk maps
+  @classmethod
+  def active(cls):
+    return cls.objects.filter(isActive=True).latest('created')
+
+# Which rule set produced a stored risk map, and the cached classification inputs it can be recomputed from
+# ensembleFile: ensemble statistics (confidence layers) of forecast based maps
+# tileSet: pre-rendered tiles of the map in the tile cache (see render_risk_map_tiles)
+# zoneSet: vector risk zones of the map in the zone cache (see risk_zones_fun)
+class RiskMap(models.Model):
+  rasterLayer = models.OneToOneField(RasterLayer, on_delete=models.CASCADE, related_name='riskMap')
+  ruleSet = models.ForeignKey(RiskRuleSet, on_delete=models.PROTECT)
+  inputsFile = models.CharField(null=True, blank=True, max_length=255)
+  ensembleFile = models.CharField(null=True, blank=True, max_length=255)
+  tileSet = models.CharField(null=True, blank=True, max_length=64)
+  zoneSet = models.CharField(null=True, blank=True, max_length=64)
+
+# Statistics of a risk map per zone of the Africa_Boundaries shapefile (country), computed when the map is stored
+# so dashboards and alerts read this table instead of the rasters
+# levelCounts: pixels per vigilance level {"1": 12, "9": 340, ...}
+# highRiskShare: share of the area with a level that is at the levels 1-3
+# populationAtRisk: people at the levels 1-3, only when a population raster is configured
+class ZonalRiskStatistics(models.Model):
+  rasterLayer = models.ForeignKey(RasterLayer, on_delete=models.CASCADE, related_name='zonalStatistics')
+  zoneKey = models.CharField(max_length=32)
+  zoneName = models.CharField(null=True, blank=True, max_length=255)
+  levelCounts = models.JSONField()
+  areaKm2 = models.FloatField()
+  highRiskShare = models.FloatField()
+  populationAtRisk = models.FloatField(null=True, blank=True)
+
+  class Meta:
+    unique_together = ('rasterLayer', 'zoneKey')
+
+  def __str__(self):
+    return '{} {}'.format(self.rasterLayer.name, self.zoneKey)
+
+# Summary of a run of the risk map job (see instrumentation_fun): wall/CPU time, peak memory and bytes read and
+# written by the whole run, the bytes downloaded per source and the measurements of every stage and data processing
+# function, so slow stages and regressions can be found by comparing runs
+class PipelineRun(models.Model):
+  name = models.CharField(max_length=50)
+  started = models.DateTimeField()
+  finished = models.DateTimeField()
+  status = models.CharField(max_length=20)
+  wallSeconds = models.FloatField()
+  cpuSeconds = models.FloatField()
+  peakRssBytes = models.BigIntegerField()
+  bytesRead = models.BigIntegerField()
+  bytesWritten = models.BigIntegerField()
+  networkBytes = models.JSONField(default=dict)
+  stages = models.JSONField(default=list)
+  functions = models.JSONField(default=dict)
+
+  class Meta:
+    ordering = ['-started']
+
+  def __str__(self):
+    return '{} {} ({})'.format(self.name, self.started, self.status)
@@ -0,0 +1,35 @@
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from raster.models import RasterLayer
+
+from .models import Article, RiskMap
+
+
+# Cache keys of the rendered pages (see views.cached_page_response)
+HOME_PAGE_CACHE_KEY = 'page:home'
+
+
+def article_page_cache_key(template_name, article_id):
+    return 'page:{}:{}'.format(template_name, article_id)
+
+
+# the home page shows the two most recent risk maps and the tiles of their RiskMap
+def invalidate_home_page():
+    cache.delete(HOME_PAGE_CACHE_KEY)
+
+
+# an article is rendered as an article and as a methodology page
+def invalidate_article_pages(article_id):
+    cache.delete_many([article_page_cache_key(template_name, article_id) for template_name in ('Article.html', 'Methodology.html')])
+
+
+@receiver([post_save, post_delete], sender=RasterLayer)
+@receiver([post_save, post_delete], sender=RiskMap)
+def risk_maps_changed(sender, **kwargs):
+    invalidate_home_page()
+
+
+@receiver([post_save, post_delete], sender=Article)
+def article_changed(sender, instance, **kwargs):
+    invalidate_article_pages(instance.id)
@@ -0,0 +1,50 @@
+// Vector risk zones of a risk map: one GeoJSON of dissolved polygons per vigilance level, fetched for the zoom
+// level of the map (the zones of a zoom level are only fetched once, the browser caches them), styled with the
+// colors of the legend and showing the level on hover. When the zones can not be loaded (e.g. the zone set was removed
+// since the page was rendered) the map shows the tiles of tileUrlTemplate instead
+function addRiskZones(map, urlTemplate, tileUrlTemplate) {
+   var loadedZoom = null;
+   var zones = L.geoJSON(null, {
+      style: function (feature) {
+         return {fillColor: feature.properties.color, fillOpacity: 0.6, stroke: false};
+      },
+      onEachFeature: function (feature, layer) {
+         layer.bindTooltip('Vigilance level ' + feature.properties.level, {sticky: true});
+      }
+   }).addTo(map);
+
+   function showTiles(error) {
+      // fetches of several zoom changes may fail, the tiles are added once
+      if (!map.hasLayer(zones)) {
+         return;
+      }
+      console.warn('risk zones not available, showing the tiles of the map instead', error);
+      map.off('zoomend', loadZones);
+      map.removeLayer(zones);
+      L.tileLayer(tileUrlTemplate, {opacity: 0.6}).addTo(map);
+   }
+
+   function loadZones() {
+      var zoom = Math.round(map.getZoom());
+      fetch(urlTemplate.replace('{z}', zoom))
+         .then(function (response) {
+            if (!response.ok) {
+               throw new Error('HTTP ' + response.status);
+            }
+            return response.json();
+         })
+         .then(function (data) {
+            // zoom levels beyond the ones of the map share their zones, a newer zoom change wins
+            if (data.zoom === loadedZoom || Math.round(map.getZoom()) !== zoom) {
+               return;
+            }
+            loadedZoom = data.zoom;
+            zones.clearLayers();
+            zones.addData(data);
+         })
+         .catch(showTiles);
+   }
+   map.on('zoomend', loadZones);
+   loadZones();
+   return zones;
+}
@@ -1,6 +1,60 @@
-from celery import shared_task
+from celery import shared_task, chord
 from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.conf import settings
+from datetime import datetime, timedelta
 
+# a failed run (e.g. the GEOS-FP OPeNDAP server is down or the ECMWF forecast is late) is retried later, the stages
+# that already completed are read from the stage folder of the day
+@shared_task(bind=True, max_retries=settings.RISK_MAP_RETRIES, default_retry_delay=settings.RISK_MAP_RETRY_DELAY)
+def generate_risk_map(self):
+    try:
+        call_command('generate_risk_map')
+    except Exception as exc:
+        raise self.retry(exc=exc)
+    # pre-render the tiles of the new maps, so the home page is served from the tile cache. The maps are published
+    # already, a failed render (e.g. the legend is missing) only leaves them on the django-raster tiles
+    try:
+        call_command('render_risk_map_tiles')
+    except Exception as error:
+        print('rendering the tiles of the new risk maps failed, they are served by django-raster: {!r}'.format(error))
+
+
+# Backfill of the week 1 maps of past dates (see backfill_risk_maps): the assimilation days of the whole range are
+# downloaded and summed once, the dates are then computed in chunks of RISK_MAP_BACKFILL_CHUNK_DAYS by as many workers
+# as are free, and the maps are added to the archive when all chunks are done, also the completed dates of chunks in
+# which some dates failed. Running the task again after a failure only computes the dates that are not checkpointed
+# yet. start and end are YYYY-MM-DD
+@shared_task
+def backfill_risk_maps(start, end):
+    call_command('backfill_risk_maps', start=start, end=end, phase='fetch')
+
+    first = datetime.strptime(start, '%Y-%m-%d').date()
+    last = datetime.strptime(end, '%Y-%m-%d').date()
+    chunks = []
+    while first <= last:
+        chunk_end = min(first + timedelta(days=settings.RISK_MAP_BACKFILL_CHUNK_DAYS - 1), last)
+        chunks.append(backfill_risk_map_dates.si(first.isoformat(), chunk_end.isoformat()))
+        first = chunk_end + timedelta(days=1)
+    chord(chunks)(archive_risk_map_backfill.s(start, end))
+
+
+# celery workers cannot start child processes, so every chunk is computed with one worker
+# a chunk in which dates failed returns the error instead of raising it, otherwise celery would never run the archive
+# task of the chord and no date of the backfill would be archived
+@shared_task
+def backfill_risk_map_dates(start, end):
+    try:
+        call_command('backfill_risk_maps', start=start, end=end, phase='classify', workers=1)
+    except CommandError as error:
+        return '{} - {}: {}'.format(start, end, error)
+    return None
+
+
+# archives the checkpointed dates, then fails with the errors of the chunks (failures, one per chunk or None)
 @shared_task
-def generate_risk_map():
-    call_command('generate_risk_map')
\ No newline at end of file
+def archive_risk_map_backfill(failures, start, end):
+    call_command('backfill_risk_maps', start=start, end=end, phase='archive')
+    failures = [failure for failure in failures if failure]
+    if failures:
+        raise CommandError('{} chunks of the backfill had failed dates, run it again to compute them\n{}'.format(len(failures), '\n'.join(failures)))
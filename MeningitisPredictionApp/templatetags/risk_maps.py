@@ -0,0 +1,33 @@
+from django import template
+from django.conf import settings
+from django.urls import reverse
+
+from MeningitisPredictionApp.models import RiskMap
+
+register = template.Library()
+
+
+# Leaflet url template of the tiles of a risk map (RasterLayer): the pre-rendered tiles when the map is in the
+# tile cache, otherwise the tiles rendered on demand by django-raster
+@register.filter
+def tile_url(raster_layer):
+    try:
+        tile_set = raster_layer.riskMap.tileSet
+    except RiskMap.DoesNotExist:
+        tile_set = None
+    if tile_set:
+        return reverse('tile', args=[tile_set, 0, 0, 0]).replace('/0/0/0.png', '/{z}/{x}/{y}.png')
+    return '/raster/tiles/{}/{{z}}/{{x}}/{{y}}.png?legend={}'.format(raster_layer.id, settings.RISK_MAP_LEGEND)
+
+
+# Url template of the vector risk zones of a risk map (RasterLayer) with {z} for the zoom level, None when the map has
+# no zones (yet), the map then shows its tiles
+@register.filter
+def zone_url(raster_layer):
+    try:
+        zone_set = raster_layer.riskMap.zoneSet
+    except RiskMap.DoesNotExist:
+        zone_set = None
+    if zone_set:
+        return reverse('risk_zones', args=[zone_set, 0]).replace('/0.geojson', '/{z}.geojson')
+    return None
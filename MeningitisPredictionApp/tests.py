@@ -1,3 +1,276 @@
-from django.test import TestCase
+from django.test import SimpleTestCase
+from shapely.geometry import Polygon, mapping
+import numpy as np
+import rasterio
+from rasterio.warp import reproject, Resampling
+from rasterio.transform import from_origin
+from rasterio.crs import CRS
+from datetime import date
+import tempfile
+import fiona
+import os
+from unittest import mock
 
-# Create your tests here.
+from .management.commands.data_processing_fun import Raster, Grid, DIONE_RULES, compute_risk_array, compute_risk_array_by_masks, regrid, regrid_plans
+from .management.commands.benchmark_fun import write_fixtures, offline_pipeline
+from .management.commands import stage_graph_fun
+from .management.commands.stage_graph_fun import run_stage
+from .management.commands.risk_archive_fun import append_risk_map, archive_time_series, archive_maps
+
+
+# thresholds of 2mt, RH and sdc in DIONE_RULES
+THRESHOLDS = [sorted({threshold for _, conditions in DIONE_RULES for variable, _, threshold in conditions if variable == index})
+              for index in range(3)]
+
+
+# Function that generates a random input raster: uniform values, values exactly on the thresholds, nan and +-inf
+def random_raster(rng, shape, thresholds, low, high, dtype):
+    values = rng.uniform(low, high, shape).astype(dtype)
+    pick = rng.random(shape)
+    on_threshold = pick < 0.2
+    values[on_threshold] = rng.choice(thresholds, on_threshold.sum())
+    values[(pick >= 0.9) & (pick < 0.93)] = np.inf
+    values[(pick >= 0.93) & (pick < 0.96)] = -np.inf
+    values[pick >= 0.96] = np.nan
+    return Raster(values, None, None, np.nan)
+
+
+# The single pass classifier (compute_risk_array) has to give the same levels as the mask based reference
+# implementation for every input
+class RiskClassifierTest(SimpleTestCase):
+
+    def assert_same_levels(self, twomt, rh, sdc):
+        expected = compute_risk_array_by_masks(twomt, rh, sdc).array
+        result = compute_risk_array(twomt, rh, sdc).array
+        self.assertEqual(result.dtype, expected.dtype)
+        np.testing.assert_array_equal(result, expected)
+
+    def test_random_inputs(self):
+        rng = np.random.default_rng(0)
+        for dtype in (np.float32, np.float64):
+            for trial in range(50):
+                shape = tuple(rng.integers(1, 200, 2))
+                with self.subTest(dtype=dtype.__name__, trial=trial, shape=shape):
+                    self.assert_same_levels(random_raster(rng, shape, THRESHOLDS[0], -10, 50, dtype),
+                                            random_raster(rng, shape, THRESHOLDS[1], 0, 100, dtype),
+                                            random_raster(rng, shape, THRESHOLDS[2], 0, 1000, dtype))
+
+    def test_every_combination_of_special_values(self):
+        # every threshold, a value just below and above it, nan and +-inf of every variable combined with each other
+        specials = [np.nan, np.inf, -np.inf]
+        values = [sorted(set(thresholds) | {threshold + offset for threshold in thresholds for offset in (-0.5, 0.5)}) + specials
+                  for thresholds in THRESHOLDS]
+        for dtype in (np.float32, np.float64):
+            with self.subTest(dtype=dtype.__name__):
+                grids = np.meshgrid(*[np.array(variable_values, dtype=dtype) for variable_values in values], indexing='ij')
+                self.assert_same_levels(*(Raster(grid.reshape(-1, 1), None, None, np.nan) for grid in grids))
+
+
+# The offline pipeline of the benchmarks runs on the synthetic inputs and gives risk maps of both weeks and the
+# ensemble statistics (coarse grid, so the test is fast)
+class OfflinePipelineTest(SimpleTestCase):
+
+    def test_offline_pipeline(self):
+        with tempfile.TemporaryDirectory() as folder:
+            shapefile = os.path.join(folder, 'africa.shp')
+            schema = {'geometry': 'Polygon', 'properties': {'NAME': 'str'}}
+            with fiona.open(shapefile, 'w', 'ESRI Shapefile', schema, crs='EPSG:4326') as outlines:
+                outlines.write({'geometry': mapping(Polygon([(-17, 15), (10, 37), (35, 30), (51, 12), (40, -34), (18, -35), (9, 0)])),
+                                'properties': {'NAME': 'africa'}})
+
+            fixtures = write_fixtures(os.path.join(folder, 'inputs'), 1.0, members=3, steps=2, timesteps=2)
+            offline_pipeline(fixtures, shapefile, folder, cache_dir=os.path.join(folder, 'cache'))
+
+            levels = set(level for level, _ in DIONE_RULES)
+            for week in ('week1', 'week2'):
+                with rasterio.open(os.path.join(folder, week + '.tif')) as risk_map:
+                    data = risk_map.read(1)
+                    nodata = risk_map.nodata
+                self.assertTrue(set(np.unique(data).tolist()) <= levels | {nodata})
+                self.assertTrue((data != nodata).any())
+            with rasterio.open(os.path.join(folder, 'week2_ensemble.tif')) as ensemble:
+                self.assertGreater(ensemble.count, 1)
+
+
+# Regridding with a cached plan gives the same pixels as a nearest neighbour gdal warp, also when the plan is read back
+# from the cache folder
+class RegridTest(SimpleTestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        # GEOS-FP like source grid (0.3125 x 0.25 degrees) with some pixels without data
+        values = rng.uniform(0, 40, (37, 45)).astype(np.float32)
+        values[rng.random(values.shape) < 0.1] = -9999
+        self.source = Raster(values, from_origin(-10.15625, 20.125, 0.3125, 0.25), CRS.from_epsg(4326), -9999)
+
+    def warp(self, target):
+        expected = np.full(target.shape, self.source.nodata, dtype=self.source.array.dtype)
+        reproject(self.source.array, expected, src_transform=self.source.transform, src_crs=self.source.crs,
+                  src_nodata=self.source.nodata, dst_transform=target.transform, dst_crs=target.crs,
+                  dst_nodata=self.source.nodata, resampling=Resampling.nearest)
+        return expected
+
+    def test_nearest_regrid_matches_warp(self):
+        targets = [
+            # ECMWF like grid that covers the source and more
+            Grid(from_origin(-12.125, 21.125, 0.25, 0.25), (50, 60), CRS.from_epsg(4326)),
+            # finer grid inside of the source
+            Grid(from_origin(-5.05, 15.05, 0.1, 0.1), (40, 50), CRS.from_epsg(4326)),
+            # web mercator tiles
+            Grid(from_origin(-1100000, 2200000, 20000, 20000), (60, 70), CRS.from_epsg(3857)),
+        ]
+        for target in targets:
+            with self.subTest(crs=target.crs.to_string(), shape=target.shape), mock.patch.dict(regrid_plans, clear=True):
+                result = regrid(self.source, target, 'nearest')
+                self.assertEqual(result.array.dtype, self.source.array.dtype)
+                np.testing.assert_array_equal(result.array, self.warp(target))
+
+    def test_plan_read_from_the_cache(self):
+        target = Grid(from_origin(-12.125, 21.125, 0.25, 0.25), (50, 60), CRS.from_epsg(4326))
+        with tempfile.TemporaryDirectory() as cache_dir, mock.patch.dict(regrid_plans, clear=True):
+            built = regrid(self.source, target, 'nearest', cache_dir).array
+            self.assertEqual(len([file_name for file_name in os.listdir(cache_dir) if file_name.endswith('.npz')]), 1)
+            # a new process only has the plan on disk
+            regrid_plans.clear()
+            with mock.patch('MeningitisPredictionApp.management.commands.data_processing_fun.build_regrid_plan') as build:
+                cached = regrid(self.source, target, 'nearest', cache_dir).array
+            build.assert_not_called()
+        np.testing.assert_array_equal(cached, built)
+        np.testing.assert_array_equal(cached, self.warp(target))
+
+
+# Stages of the risk map job are read from the stage folder when their parameters and the content of their inputs are
+# the same, and run again when either changed
+class StageGraphTest(SimpleTestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.stage_dir = os.path.join(self.folder.name, 'stages')
+        self.calls = []
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def count(self, name, function):
+        def counted(*args):
+            self.calls.append(name)
+            return function(*args)
+        return counted
+
+    # stage that copies a source file into the folder, and a stage that reads it
+    def run_copy_and_read(self, source):
+        def copy(source_file):
+            target = os.path.join(self.folder.name, 'copy.txt')
+            with open(source_file) as input_file, open(target, 'w') as output_file:
+                output_file.write(input_file.read())
+            return target
+
+        def read(copy_file):
+            with open(copy_file) as input_file:
+                return input_file.read()
+
+        copied = run_stage(self.stage_dir, 'copy', self.count('copy', copy), params=(source,), files=True,
+                           inputs=[stage_graph_fun.StageOutput(source, stage_graph_fun.file_hash(source))])
+        return run_stage(self.stage_dir, 'read', self.count('read', read), inputs=[copied])
+
+    def test_stage_is_reused_with_the_same_params(self):
+        for _ in range(2):
+            output = run_stage(self.stage_dir, 'square', self.count('square', lambda: 3 ** 2), params=(3,))
+        self.assertEqual(output.value, 9)
+        self.assertEqual(self.calls, ['square'])
+
+    def test_stage_runs_again_when_a_param_changes(self):
+        first = run_stage(self.stage_dir, 'power', self.count('power', lambda: 3 ** 2), params=(2,))
+        second = run_stage(self.stage_dir, 'power', self.count('power', lambda: 3 ** 3), params=(3,))
+        self.assertEqual((first.value, second.value), (9, 27))
+        self.assertEqual(self.calls, ['power', 'power'])
+
+    def test_stage_runs_again_when_the_stage_version_changes(self):
+        run_stage(self.stage_dir, 'square', self.count('square', lambda: 3 ** 2), params=(3,))
+        with mock.patch.object(stage_graph_fun, 'STAGE_VERSION', stage_graph_fun.STAGE_VERSION + 1):
+            run_stage(self.stage_dir, 'square', self.count('square', lambda: 3 ** 2), params=(3,))
+        self.assertEqual(self.calls, ['square', 'square'])
+
+    def test_stage_runs_again_when_an_input_file_changes(self):
+        source = os.path.join(self.folder.name, 'source.txt')
+        with open(source, 'w') as source_file:
+            source_file.write('first')
+        self.assertEqual(self.run_copy_and_read(source).value, 'first')
+        self.assertEqual(self.run_copy_and_read(source).value, 'first')
+        self.assertEqual(self.calls, ['copy', 'read'])
+
+        with open(source, 'w') as source_file:
+            source_file.write('second')
+        self.assertEqual(self.run_copy_and_read(source).value, 'second')
+        self.assertEqual(self.calls, ['copy', 'read', 'copy', 'read'])
+
+    def test_changed_output_file_is_produced_again(self):
+        source = os.path.join(self.folder.name, 'source.txt')
+        with open(source, 'w') as source_file:
+            source_file.write('first')
+        self.run_copy_and_read(source)
+        # the copy was changed after the stage ran: it is copied again, and as its content is the same as before the
+        # downstream stage is still up to date
+        with open(os.path.join(self.folder.name, 'copy.txt'), 'w') as copy_file:
+            copy_file.write('changed')
+        self.assertEqual(self.run_copy_and_read(source).value, 'first')
+        self.assertEqual(self.calls, ['copy', 'read', 'copy'])
+
+    def test_failed_stage_leaves_no_record(self):
+        def fail():
+            raise RuntimeError('download failed')
+
+        with self.assertRaises(RuntimeError):
+            run_stage(self.stage_dir, 'download', fail, params=(1,))
+        self.assertFalse(os.path.exists(self.stage_dir) and os.listdir(self.stage_dir))
+        output = run_stage(self.stage_dir, 'download', self.count('download', lambda: 'data'), params=(1,))
+        self.assertEqual(output.value, 'data')
+        self.assertEqual(self.calls, ['download'])
+
+
+# Risk maps added to the archive in any order (a backfill appends past weeks after the daily maps) are read back by
+# date, a week that is archived again is replaced, and the nodata of the maps is stored as 255 (read as None)
+class RiskArchiveTest(SimpleTestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.archive_file = os.path.join(self.folder.name, 'archive', 'risk_maps.nc')
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    # risk map of 3 x 4 pixels (lon 0 to 4, lat 0 to 3) with nodata 9999 like the classifier output
+    def write_map(self, name, levels):
+        risk_map_file = os.path.join(self.folder.name, name)
+        with rasterio.open(risk_map_file, 'w', driver='GTiff', width=4, height=3, count=1, dtype='int16', nodata=9999,
+                           crs='EPSG:4326', transform=from_origin(0, 3, 1, 1)) as dst:
+            dst.write(np.asarray(levels, dtype=np.int16), 1)
+        return risk_map_file
+
+    def test_append_and_read(self):
+        may13 = self.write_map('may13.tif', np.full((3, 4), 2))
+        may6 = self.write_map('may6.tif', [[1, 2, 3, 4], [5, 6, 7, 8], [9, 9999, 1, 2]])
+        may13_again = self.write_map('may13_again.tif', np.full((3, 4), 4))
+        append_risk_map(self.archive_file, 'week1', date(2024, 5, 13), may13)
+        append_risk_map(self.archive_file, 'week1', date(2024, 5, 6), may6)
+        append_risk_map(self.archive_file, 'week1', date(2024, 5, 13), may13_again)
+        append_risk_map(self.archive_file, 'week2', date(2024, 5, 13), may13)
+
+        # pixel of row 2, column 1 (nodata in the map of May 6)
+        series = archive_time_series(self.archive_file, 'week1', 1.5, 0.5, date(2024, 5, 1), date(2024, 5, 31))
+        self.assertEqual(series, [(date(2024, 5, 6), None), (date(2024, 5, 13), 4)])
+        self.assertEqual(archive_time_series(self.archive_file, 'week2', 1.5, 0.5, date(2024, 5, 1), date(2024, 5, 31)),
+                         [(date(2024, 5, 13), 2)])
+
+        dates, levels, grid = archive_maps(self.archive_file, 'week1', date(2024, 5, 1), date(2024, 5, 31))
+        self.assertEqual(dates, [date(2024, 5, 6), date(2024, 5, 13)])
+        self.assertEqual(grid.shape, (3, 4))
+        self.assertEqual(levels.dtype, np.uint8)
+        np.testing.assert_array_equal(levels[0], [[1, 2, 3, 4], [5, 6, 7, 8], [9, 255, 1, 2]])
+        np.testing.assert_array_equal(levels[1], np.full((3, 4), 4))
+
+        dates, levels, _ = archive_maps(self.archive_file, 'week1', date(2024, 5, 7), date(2024, 5, 31))
+        self.assertEqual(dates, [date(2024, 5, 13)])
+        self.assertEqual(levels.shape, (1, 3, 4))
+        with self.assertRaises(ValueError):
+            archive_time_series(self.archive_file, 'week1', 10, 10, date(2024, 5, 1), date(2024, 5, 31))
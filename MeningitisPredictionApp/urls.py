@@ -5,5 +5,8 @@ urlpatterns = [
     path('', views.mapView, name='RiskMap'),
     path('Article/<int:article_id>/', views.articleView, name='article'),
     path('Methodology/<int:metho_id>/', views.methodologyView, name='methodology'),
+    path('api/risk-query/', views.riskQueryView, name='risk_query'),
+    path('tiles/<slug:tile_set>/<int:z>/<int:x>/<int:y>.png', views.tileView, name='tile'),
+    path('zones/<slug:zone_set>/<int:z>.geojson', views.riskZonesView, name='risk_zones'),
   #  path('Weather', views.weatherView, name='weather'),
 ]
\ No newline at end of file
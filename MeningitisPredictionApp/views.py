@@ -1,44 +1,185 @@
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseNotModified, HttpResponseRedirect, HttpResponsePermanentRedirect, FileResponse, Http404, JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from django.template import loader
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response, quote_etag
+from django.utils.http import http_date
 from raster.models import RasterLayer
 from django.templatetags.static import static
+from django.urls import reverse
 from .models import Article 
+from .signals import HOME_PAGE_CACHE_KEY, article_page_cache_key
+from .management.commands.tile_cache_fun import read_tile_set, blob_path, tile_set_indexes
+from .management.commands.risk_zones_fun import read_zone_set, zone_file_path, zone_set_indexes
+from .management.commands.risk_query_fun import query_risk_maps, risk_query_layers, split_query_geometries
+import hashlib
+import gzip
+import json
+import time
+
+# Returns the response of a page from the cache, the page is rendered by render() when it is not in the cache
+# (invalidated by the save signals in signals.py). The ETag and Last-Modified headers let browsers revalidate
+# their copy and get a 304 as long as the page did not change
+def cached_page_response(request, cache_key, render):
+    page = cache.get(cache_key)
+    if page is None:
+        content = render()
+        page = {
+            'content': content,
+            'etag': quote_etag(hashlib.md5(content.encode()).hexdigest()),
+            'last_modified': int(time.time()),
+        }
+        cache.set(cache_key, page, settings.PAGE_CACHE_TIMEOUT)
+
+    response = HttpResponse(page['content'])
+    response['ETag'] = page['etag']
+    response['Last-Modified'] = http_date(page['last_modified'])
+    # browsers keep the page but ask every time whether it changed
+    response['Cache-Control'] = 'no-cache'
+    return get_conditional_response(request, etag=page['etag'], last_modified=page['last_modified'], response=response)
 
 def mapView(request):
-    # Get the two most recent RasterLayer entries by id
-    risk_maps = RasterLayer.objects.order_by('-id')[:2]
-    template = loader.get_template('HomePage.html')
-    context = {
-       'RiskMaps': risk_maps,
-    }
-    return HttpResponse(template.render(context, request))
+    def render():
+        # Get the two most recent RasterLayer entries by id
+        risk_maps = RasterLayer.objects.select_related('riskMap').order_by('-id')[:2]
+        template = loader.get_template('HomePage.html')
+        context = {
+           'RiskMaps': risk_maps,
+        }
+        return template.render(context, request)
+    return cached_page_response(request, HOME_PAGE_CACHE_KEY, render)
 
 def articleView (request, article_id):
-    apparticle = Article.objects.get(id=article_id)
-    template = loader.get_template('Article.html')
-    context = {
-        'appArticle': apparticle,
-    }
-    return HttpResponse(template.render(context, request))
+    def render():
+        apparticle = Article.objects.get(id=article_id)
+        template = loader.get_template('Article.html')
+        context = {
+            'appArticle': apparticle,
+        }
+        return template.render(context, request)
+    return cached_page_response(request, article_page_cache_key('Article.html', article_id), render)
 
 def methodologyView (request, metho_id):
-    methodology = Article.objects.get(id=metho_id)
-    article_content = methodology.articleContent
-    template = loader.get_template('Methodology.html')
-    placeholder_mappings = {
-        '__THRESHOLDS_IMAGE__': static('thresholds.png'),
-    }
-
-    # Replace all placeholders with their actual values
-    for placeholder, replacement in placeholder_mappings.items():
-        article_content = article_content.replace(placeholder, replacement)
-
-    context = {
-        'methoArticle': methodology,
-        'articleContent': article_content,
-    }
-    return HttpResponse(template.render(context, request))
+    def render():
+        methodology = Article.objects.get(id=metho_id)
+        article_content = methodology.articleContent
+        template = loader.get_template('Methodology.html')
+        placeholder_mappings = {
+            '__THRESHOLDS_IMAGE__': static('thresholds.png'),
+        }
+
+        # Replace all placeholders with their actual values
+        for placeholder, replacement in placeholder_mappings.items():
+            article_content = article_content.replace(placeholder, replacement)
+
+        context = {
+            'methoArticle': methodology,
+            'articleContent': article_content,
+        }
+        return template.render(context, request)
+    return cached_page_response(request, article_page_cache_key('Methodology.html', metho_id), render)
 
 #def weatherView (request):
 #    template = loader.get_template('Weather.html')
-#    return HttpResponse(template.render())
\ No newline at end of file
+#    return HttpResponse(template.render())
+
+# Pre-rendered risk map tiles from the tile cache (see render_risk_map_tiles)
+# the url contains the content hash of the map, so the tiles can be cached by the browser forever
+def tileView(request, tile_set, z, x, y):
+    index = read_tile_set(settings.TILE_CACHE_DIR, tile_set)
+    if index is None:
+        raise Http404
+
+    digest = index['tiles'].get('{}/{}/{}'.format(z, x, y))
+    if digest is None:
+        if z > index['max_zoom']:
+            # zoom levels that are not pre-rendered are rendered by django-raster
+            return HttpResponseRedirect('/raster/tiles/{}/{}/{}/{}.png?legend={}'.format(index['layer'], z, x, y, settings.RISK_MAP_LEGEND))
+        digest = index['empty']
+
+    etag = '"{}"'.format(digest)
+    if etag in request.headers.get('If-None-Match', ''):
+        response = HttpResponseNotModified()
+    else:
+        try:
+            tile = open(blob_path(settings.TILE_CACHE_DIR, digest), 'rb')
+        except FileNotFoundError:
+            # the tile set was evicted after its index was read
+            tile_set_indexes.pop(tile_set, None)
+            raise Http404
+        response = FileResponse(tile, content_type='image/png')
+    response['ETag'] = etag
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+# Vector risk zones of a risk map at a zoom level (see render_risk_map_tiles), as gzipped GeoJSON
+# the url contains the content hash of the map, so the zones can be cached by the browser forever. Zoom levels beyond
+# the ones of the zone set are redirected permanently to the closest one, so the browser fetches every file once
+def riskZonesView(request, zone_set, z):
+    index = read_zone_set(settings.ZONE_CACHE_DIR, zone_set)
+    if index is None:
+        raise Http404
+
+    zoom = min(max(z, index['zoom_levels'][0]), index['zoom_levels'][-1])
+    if zoom != z:
+        return HttpResponsePermanentRedirect(reverse('risk_zones', args=[zone_set, zoom]))
+
+    etag = '"{}-{}"'.format(zone_set, z)
+    try:
+        if etag in request.headers.get('If-None-Match', ''):
+            response = HttpResponseNotModified()
+        elif 'gzip' in request.headers.get('Accept-Encoding', ''):
+            response = FileResponse(open(zone_file_path(settings.ZONE_CACHE_DIR, zone_set, z), 'rb'), content_type='application/geo+json')
+            response['Content-Encoding'] = 'gzip'
+        else:
+            with gzip.open(zone_file_path(settings.ZONE_CACHE_DIR, zone_set, z)) as zones:
+                response = HttpResponse(zones.read(), content_type='application/geo+json')
+    except FileNotFoundError:
+        # the zone set was evicted after its index was read
+        zone_set_indexes.pop(zone_set, None)
+        raise Http404
+    response['ETag'] = etag
+    response['Vary'] = 'Accept-Encoding'
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+# Risk levels at points and in regions, for partners that need the levels of e.g. their health districts.
+# POST a JSON body with any of
+#   "points": [[lon, lat], ...], "regions": [GeoJSON polygons], "features": [GeoJSON point/polygon features]
+#   "layers": [raster layer ids] (default: the two most recent risk maps), "all_touched": true/false
+# Returns for every layer the level at every point (null outside of the map) and the histogram and majority level
+# of every region (points of "features" come after "points", polygons after "regions")
+@csrf_exempt
+@require_POST
+def riskQueryView(request):
+    try:
+        query = json.loads(request.body)
+        points = [point[:2] for point in query.get('points', [])]
+        regions = list(query.get('regions', []))
+        feature_points, feature_regions = split_query_geometries(query.get('features', []))
+        points += feature_points
+        regions += feature_regions
+        layers = query.get('layers') or []
+        # filter() checks the ids right away, a non-numeric id would be a server error
+        if not isinstance(layers, list) or not all(isinstance(layer, int) and not isinstance(layer, bool) for layer in layers):
+            raise ValueError('layers has to be a list of raster layer ids')
+    except (ValueError, KeyError, TypeError, AttributeError) as error:
+        return JsonResponse({'error': 'invalid query: {}'.format(error)}, status=400)
+
+    if len(points) + len(regions) > settings.RISK_QUERY_MAX_ITEMS:
+        return JsonResponse({'error': 'at most {} points and regions per query'.format(settings.RISK_QUERY_MAX_ITEMS)}, status=400)
+
+    if layers:
+        raster_layers = RasterLayer.objects.filter(id__in=layers).order_by('-id')
+    else:
+        raster_layers = RasterLayer.objects.order_by('-id')[:2]
+
+    try:
+        results = query_risk_maps(risk_query_layers(raster_layers), settings.RISK_QUERY_CACHE_DIR, points, regions,
+                                  all_touched=bool(query.get('all_touched', False)))
+    # malformed regions (e.g. a polygon without coordinates) only fail when they are rasterized
+    except (ValueError, KeyError, TypeError, IndexError) as error:
+        return JsonResponse({'error': 'invalid query: {}'.format(error)}, status=400)
+    return JsonResponse({'layers': results})
@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/3.2/ref/settings/
 
 from pathlib import Path
 import os
+from django.core.exceptions import ImproperlyConfigured
 from celery.schedules import crontab
 from celery import Celery
 from dotenv import load_dotenv
@@ -156,9 +157,111 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # for django-raster package 
 RASTER_USE_CELERY = True
 
+# the risk maps are stored as RasterLayer tiles by the risk map job itself (see raster_ingest_fun), from this zoom level
+# up to the native zoom level of the maps (or RISK_MAP_TILE_MAX_ZOOM), in batches of RASTER_INGEST_BATCH_SIZE tiles
+RISK_MAP_TILE_MIN_ZOOM = int(os.getenv("RISK_MAP_TILE_MIN_ZOOM", 2))
+RISK_MAP_TILE_MAX_ZOOM = int(os.getenv("RISK_MAP_TILE_MAX_ZOOM")) if os.getenv("RISK_MAP_TILE_MAX_ZOOM") else None
+RASTER_INGEST_BATCH_SIZE = int(os.getenv("RASTER_INGEST_BATCH_SIZE", 2000))
+
+# Data sources of the risk map job (can be pointed at a local OPeNDAP/HTTP stand-in for testing)
+GEOS_FP_OPENDAP_URL = os.getenv("GEOS_FP_OPENDAP_URL", "https://opendap.nccs.nasa.gov/dods/GEOS-5/fp/0.25_deg")
+ECMWF_OPENDATA_SOURCE = os.getenv("ECMWF_OPENDATA_SOURCE", "ecmwf")
+# number of downloads the risk map job runs at the same time
+RISK_MAP_FETCH_WORKERS = int(os.getenv("RISK_MAP_FETCH_WORKERS", 6))
+# number of GEOS-FP timesteps requested from the OPeNDAP server at once (peak memory is one block)
+GEOS_FP_TIME_BLOCK = int(os.getenv("GEOS_FP_TIME_BLOCK", 1))
+# local cache of the GEOS-FP assimilation timesteps used for the rolling weekly means
+GEOS_FP_CACHE_DIR = os.getenv("GEOS_FP_CACHE_DIR", os.path.join(BASE_DIR, "IntermediateDataFiles", "geos_fp_cache"))
+GEOS_FP_CACHE_MAX_AGE_DAYS = int(os.getenv("GEOS_FP_CACHE_MAX_AGE_DAYS", 10))
+GEOS_FP_CACHE_MAX_BYTES = int(os.getenv("GEOS_FP_CACHE_MAX_BYTES", 2 * 1024**3))
+# rasterized africa outlines by grid, so the shapefile is not rasterized again for every clip
+MASK_CACHE_DIR = os.getenv("MASK_CACHE_DIR", os.path.join(BASE_DIR, "IntermediateDataFiles", "mask_cache"))
+# resolution (degrees) of the global grid the risk maps are computed on, the grid of the ECMWF open data forecasts
+RISK_MAP_GRID_RESOLUTION = float(os.getenv("RISK_MAP_GRID_RESOLUTION", 0.25))
+# source -> target pixel mappings used to regrid the GEOS-FP rasters onto that grid
+REGRID_CACHE_DIR = os.getenv("REGRID_CACHE_DIR", os.path.join(BASE_DIR, "IntermediateDataFiles", "regrid_cache"))
+# forecast horizons of the risk maps as name:first step:last step (hours after 00z of the ECMWF ensemble run), the
+# ensemble is downloaded once for the steps of all horizons and every horizon is one more risk map: the default is the
+# week 2 map, "week2:24:192,week3:198:360" adds a week 3 map from the rest of the ensemble (published up to 360 h)
+ECMWF_FORECAST_HORIZONS = [(name, int(first), int(last)) for name, first, last in
+                           (horizon.split(":") for horizon in os.getenv("ECMWF_FORECAST_HORIZONS", "week2:24:192").split(","))]
+# week1 is the GEOS-FP map, a horizon with that name (or the same name twice) would overwrite a map in the archive
+_horizon_names = [name for name, _, _ in ECMWF_FORECAST_HORIZONS]
+if "week1" in _horizon_names or len(set(_horizon_names)) != len(_horizon_names):
+    raise ImproperlyConfigured("ECMWF_FORECAST_HORIZONS: the names have to be unique and week1 is reserved for the GEOS-FP "
+                               "map, got {}".format(", ".join(_horizon_names)))
+# percentiles of the ECMWF ensemble members stored with the week 2 risk maps
+ECMWF_ENSEMBLE_PERCENTILES = [float(percentile) for percentile in os.getenv("ECMWF_ENSEMBLE_PERCENTILES", "10,50,90").split(",")]
+# pre-rendered risk map tiles, content addressed (see render_risk_map_tiles)
+TILE_CACHE_DIR = os.getenv("TILE_CACHE_DIR", os.path.join(BASE_DIR, "rasters", "tiles"))
+TILE_CACHE_MAX_ZOOM = int(os.getenv("TILE_CACHE_MAX_ZOOM", 8))
+# number of rendered maps kept in the tile cache, the least recently used ones are evicted first
+TILE_CACHE_MAX_SETS = int(os.getenv("TILE_CACHE_MAX_SETS", 10))
+# vector risk zones of the risk maps (one GeoJSON per zoom level), content addressed (see risk_zones_fun)
+ZONE_CACHE_DIR = os.getenv("ZONE_CACHE_DIR", os.path.join(BASE_DIR, "rasters", "zones"))
+# django-raster legend with the colors of the vigilance levels
+RISK_MAP_LEGEND = os.getenv("RISK_MAP_LEGEND", "Vigilence levels")
+# memory the risk classification may use, rasters are processed in windows that fit in it
+RISK_MAP_MEMORY_BUDGET_MB = int(os.getenv("RISK_MAP_MEMORY_BUDGET_MB", 256))
+# processes that classify the windows, has to stay 1 when the job runs inside a celery worker
+RISK_MAP_WORKERS = int(os.getenv("RISK_MAP_WORKERS", 1))
+# compression of the risk map COGs, deflate or zstd
+RISK_MAP_COMPRESSION = os.getenv("RISK_MAP_COMPRESSION", "deflate")
+# uncompressed copies of the risk maps that the point/region query API memory maps
+RISK_QUERY_CACHE_DIR = os.getenv("RISK_QUERY_CACHE_DIR", os.path.join(BASE_DIR, "IntermediateDataFiles", "risk_query_cache"))
+# maximum number of points plus regions in one query
+RISK_QUERY_MAX_ITEMS = int(os.getenv("RISK_QUERY_MAX_ITEMS", 10000))
+# population raster (people per pixel) for the population at risk of the zonal statistics, optional
+POPULATION_RASTER = os.getenv("POPULATION_RASTER")
+# datacube with every risk map by week (see backfill_risk_archive)
+RISK_ARCHIVE_FILE = os.getenv("RISK_ARCHIVE_FILE", os.path.join(BASE_DIR, "rasters", "archive", "risk_maps.nc"))
+# classification inputs of every risk map, used to recompute maps with a new rule set
+RISK_INPUTS_DIR = os.getenv("RISK_INPUTS_DIR", os.path.join(BASE_DIR, "rasters", "inputs"))
+# memoized outputs of the stages of the risk map job, one folder per forecast date (see generate_risk_map)
+RISK_MAP_STAGE_DIR = os.getenv("RISK_MAP_STAGE_DIR", os.path.join(BASE_DIR, "IntermediateDataFiles", "stages"))
+RISK_MAP_STAGE_MAX_AGE_DAYS = int(os.getenv("RISK_MAP_STAGE_MAX_AGE_DAYS", 3))
+# scratch files of every run of the risk map job, one workspace per run (see workspace_fun), set it to a folder on tmpfs
+# (e.g. /dev/shm/risk_map_workspaces) to keep them in memory. Workspaces of runs that were killed are removed after
+RISK_MAP_WORKSPACE_ROOT = os.getenv("RISK_MAP_WORKSPACE_ROOT", os.path.join(BASE_DIR, "IntermediateDataFiles", "workspaces"))
+RISK_MAP_WORKSPACE_MAX_AGE_HOURS = float(os.getenv("RISK_MAP_WORKSPACE_MAX_AGE_HOURS", 24))
+# daily sums of the GEOS-FP assimilation, week 1 maps and checkpoints of the backfill of past dates (see backfill_risk_maps)
+RISK_MAP_BACKFILL_DIR = os.getenv("RISK_MAP_BACKFILL_DIR", os.path.join(BASE_DIR, "IntermediateDataFiles", "backfill"))
+# processes that compute the maps of a backfill, and the dates per task when the backfill is fanned out over celery
+RISK_MAP_BACKFILL_WORKERS = int(os.getenv("RISK_MAP_BACKFILL_WORKERS", 4))
+RISK_MAP_BACKFILL_CHUNK_DAYS = int(os.getenv("RISK_MAP_BACKFILL_CHUNK_DAYS", 7))
+# a failed risk map job is retried, every retry only runs the stages that did not complete
+RISK_MAP_RETRIES = int(os.getenv("RISK_MAP_RETRIES", 4))
+RISK_MAP_RETRY_DELAY = int(os.getenv("RISK_MAP_RETRY_DELAY", 30 * 60))
+# Prometheus metrics of the last risk map run, for the node exporter textfile collector (see instrumentation_fun)
+PIPELINE_METRICS_FILE = os.getenv("PIPELINE_METRICS_FILE", os.path.join(BASE_DIR, "IntermediateDataFiles", "metrics", "risk_map_pipeline.prom"))
+
+# the stages of the risk map job are logged as JSON lines
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'MeningitisPredictionApp.pipeline': {'handlers': ['console'], 'level': os.getenv("PIPELINE_LOG_LEVEL", "INFO")},
+    },
+}
+
 CELERY_BROKER_URL = os.environ['REDIS_URL'] #'redis://localhost:6379/0' 
 CELERY_RESULT_BACKEND = os.environ['REDIS_URL'] #'redis://localhost:6379/0' 
 #CELERY_ACCEPT_CONTENT = ['json']
+
+# rendered pages are cached in the redis that also runs celery, they are invalidated when maps or articles change
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv("CACHE_REDIS_URL", os.environ['REDIS_URL']),
+        'KEY_PREFIX': 'meningitis',
+    }
+}
+# seconds a rendered page is kept at most, pages are invalidated explicitly by the save signals anyway
+PAGE_CACHE_TIMEOUT = int(os.getenv("PAGE_CACHE_TIMEOUT", 24 * 3600))
+
 #CELERY_TASK_SERIALIZER = 'json'
 #CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'UTC' 